@@ -1,19 +1,84 @@
 import os
+import sys
 import json
 import requests
+import httpx
+import asyncio
 import paramiko
 import gradio as gr
 import time
 import logging
+import hashlib
+import threading
+import atexit
+import contextlib
+from collections import deque
+from typing import AsyncIterator, Iterable, Iterator
+
+# agent_common.py está en la raíz del repositorio (en la imagen, junto a app.py)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import agent_common
+from agent_common import (IncrementalJSONExtractor, compress_command_output,
+                          iter_channel_output)
 
 # Configurar logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
+# httpx registra cada petición a Ollama en INFO; con varios usuarios solo es ruido
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # ========= Config desde entorno =========
 OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://ollama:11434/api/chat") 
 OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "deepseek-coder:6.7b")
 
+# Cliente HTTP de Ollama
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_READ_TIMEOUT = float(os.environ.get("OLLAMA_READ_TIMEOUT", "120"))
+OLLAMA_MAX_RETRIES = int(os.environ.get("OLLAMA_MAX_RETRIES", "3"))
+OLLAMA_RETRY_BACKOFF = float(os.environ.get("OLLAMA_RETRY_BACKOFF", "0.5"))
+
+# Modelo siempre caliente: keep_alive y opciones enviados en cada petición.
+# num_ctx debe ser fijo: si cambia entre llamadas Ollama recarga el modelo.
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+OLLAMA_OPTIONS = {
+    "num_ctx": int(os.environ.get("OLLAMA_NUM_CTX", "4096")),
+    "num_predict": int(os.environ.get("OLLAMA_NUM_PREDICT", "1024")),
+}
+OLLAMA_HEARTBEAT_INTERVAL = float(os.environ.get("OLLAMA_HEARTBEAT_INTERVAL", "240"))
+# Sin actividad durante este tiempo (s) se deja de mantener el modelo caliente
+OLLAMA_WARM_IDLE_WINDOW = float(os.environ.get("OLLAMA_WARM_IDLE_WINDOW", "3600"))
+
+# Salida estructurada (`format` con esquema JSON, Ollama >= 0.5): la generación
+# queda restringida al objeto del comando y el reintento casi nunca hace falta
+OLLAMA_STRUCTURED_OUTPUT = os.environ.get("OLLAMA_STRUCTURED_OUTPUT", "true").lower() == "true"
+
+# Modo medición: registra prompt_eval_count/prompt_eval_duration de cada llamada
+# para comprobar la reutilización del prefijo. Deja terminar los streams.
+OLLAMA_MEASURE_PROMPT_EVAL = os.environ.get("OLLAMA_MEASURE_PROMPT_EVAL", "false").lower() == "true"
+
+# Pool de conexiones SSH
+SSH_KEEPALIVE_INTERVAL = int(os.environ.get("SSH_KEEPALIVE_INTERVAL", "30"))
+SSH_POOL_IDLE_TIMEOUT = int(os.environ.get("SSH_POOL_IDLE_TIMEOUT", "600"))
+
+# Intervalo mínimo (s) entre refrescos de la UI mientras llegan tokens o salida
+STREAM_UI_INTERVAL = float(os.environ.get("STREAM_UI_INTERVAL", "0.25"))
+# Líneas finales de salida que se muestran mientras el comando sigue corriendo
+LIVE_OUTPUT_MAX_LINES = int(os.environ.get("LIVE_OUTPUT_MAX_LINES", "200"))
+# Presupuesto por defecto (s) del análisis IA; 0 = sin límite
+ANALYSIS_BUDGET_SECONDS = float(os.environ.get("ANALYSIS_BUDGET_SECONDS", "60"))
+
+# Presupuesto de tokens para la salida del comando que se envía al modelo
+ANALYSIS_CONTEXT_TOKENS = int(os.environ.get("ANALYSIS_CONTEXT_TOKENS", "1500"))
+# (la compresión y sus palabras clave están en agent_common.py, compartidas con rpi_agent.py)
+
+# Concurrencia multiusuario
+GRADIO_CONCURRENCY_COUNT = int(os.environ.get("GRADIO_CONCURRENCY_COUNT", "16"))  # eventos a la vez
+GRADIO_QUEUE_MAX_SIZE = int(os.environ.get("GRADIO_QUEUE_MAX_SIZE", "64"))        # peticiones en cola
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "1"))  # igual que en el servidor Ollama
+SSH_MAX_CONCURRENT = int(os.environ.get("SSH_MAX_CONCURRENT", "8"))    # comandos a la vez en total
+SSH_MAX_PER_HOST = int(os.environ.get("SSH_MAX_PER_HOST", "2"))        # comandos a la vez por host
+QUEUE_FEEDBACK_INTERVAL = float(os.environ.get("QUEUE_FEEDBACK_INTERVAL", "1.0"))
+
 # Suprimir warnings de cryptography (son solo deprecation warnings)
 import warnings
 warnings.filterwarnings("ignore", message=".*TripleDES.*")
@@ -30,21 +95,32 @@ Tu única tarea:
 - NO respondas "no puedo", ni "aquí hay pasos", ni nada fuera del JSON.
 
 INSTRUCCIÓN CRÍTICA:
-Debes devolver la respuesta SIEMPRE DENTRO de:
+Debes devolver SIEMPRE únicamente este objeto JSON:
 
-<json>
 {
   "command": "<comando>",
   "explanation": "<explicación breve en español>",
-  "dangerous": true o false
+  "dangerous": true o false,
+  "reasoning": "<razonamiento breve en español>"
 }
-</json>
 
-- Nada fuera de <json>...</json>
-- Nada después de </json>
-- Nada antes de <json>
+- Nada antes ni después del JSON
 """
 
+# Esquema de la salida estructurada (ver OLLAMA_STRUCTURED_OUTPUT)
+COMMAND_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "command": {"type": "string"},
+        "explanation": {"type": "string"},
+        "dangerous": {"type": "boolean"},
+        "reasoning": {"type": "string"},
+    },
+    "required": ["command", "explanation", "dangerous", "reasoning"],
+}
+
+COMMAND_PLACEHOLDERS = ["<comando>", "[nombre]", "[id]", "[ruta]", "container_name", "nombre-del-contenedor"]
+
 def wait_for_ollama():
     """Espera a que Ollama esté listo antes de iniciar la app"""
     max_retries = 30
@@ -54,12 +130,10 @@ def wait_for_ollama():
     
     for i in range(max_retries):
         try:
-            # Verificar si Ollama responde
-            health_url = OLLAMA_URL.replace('/api/chat', '/api/tags')
-            resp = requests.get(health_url, timeout=10)
-            if resp.status_code == 200:
-                logger.info("✅ Ollama está listo!")
-                return True
+            # Verificar si Ollama responde (este bucle ya reintenta, el cliente no)
+            OLLAMA_CLIENT.tags(max_retries=0)
+            logger.info("✅ Ollama está listo!")
+            return True
         except Exception as e:
             if i < max_retries - 1:
                 logger.info(f"🔄 Ollama no está listo aún (intento {i+1}/{max_retries}), esperando...")
@@ -71,16 +145,240 @@ def wait_for_ollama():
 
 # ========= Lógica de modelo =========
 
-def call_ollama(user_request: str, extra_system: str = "") -> str:
-    system_msg = SYSTEM_PROMPT + extra_system
+class OllamaClient(agent_common.OllamaClient):
+    """agent_common.OllamaClient con la configuración del entorno y avisos en el log.
+
+    Los chats en streaming del núcleo asíncrono usan un httpx.AsyncClient
+    con la misma política de reintentos y las mismas métricas.
+    """
+
+    def __init__(self):
+        super().__init__(OLLAMA_URL, OLLAMA_MODEL, OLLAMA_KEEP_ALIVE, OLLAMA_OPTIONS,
+                         connect_timeout=OLLAMA_CONNECT_TIMEOUT, read_timeout=OLLAMA_READ_TIMEOUT,
+                         max_retries=OLLAMA_MAX_RETRIES, backoff=OLLAMA_RETRY_BACKOFF,
+                         pool_maxsize=32)
+        # Un cliente httpx por bucle de eventos: sus conexiones no se pueden usar
+        # ni cerrar desde otro bucle
+        self._async_sessions: dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self._async_lock = threading.Lock()
+
+    def async_session(self) -> httpx.AsyncClient:
+        """Cliente httpx del bucle de eventos actual (se crea en el primer uso)"""
+        loop = asyncio.get_running_loop()
+        with self._async_lock:
+            session = self._async_sessions.get(loop)
+            if session is None:
+                # Los bucles ya cerrados no pueden ejecutar aclose(): se sueltan
+                # sus clientes para que se liberen los sockets
+                for old_loop in [old for old in self._async_sessions if old.is_closed()]:
+                    logger.warning("⚠️ Cliente httpx de un bucle cerrado sin aclose(), se descarta")
+                    del self._async_sessions[old_loop]
+                session = httpx.AsyncClient(
+                    base_url=self.base_url,
+                    limits=httpx.Limits(max_connections=32, max_keepalive_connections=8),
+                )
+                self._async_sessions[loop] = session
+        return session
+
+    async def aclose(self):
+        """Cierra el cliente httpx del bucle actual (llamar antes de que el bucle termine)"""
+        with self._async_lock:
+            session = self._async_sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session.aclose()
+
+    def close_async_sessions(self, timeout: float = 5):
+        """Cierra al apagar los clientes httpx de todos los bucles que siguen abiertos"""
+        with self._async_lock:
+            sessions = list(self._async_sessions.items())
+            self._async_sessions.clear()
+        for loop, session in sessions:
+            if loop.is_closed():
+                continue
+            try:
+                if loop.is_running():
+                    asyncio.run_coroutine_threadsafe(session.aclose(), loop).result(timeout)
+                else:
+                    loop.run_until_complete(session.aclose())
+            except Exception as e:
+                logger.warning(f"⚠️ No se pudo cerrar el cliente httpx: {e}")
+
+    async def astream(self, path: str, payload: dict, read_timeout: float | None = None,
+                      max_retries: int | None = None) -> tuple[httpx.Response, int]:
+        """Versión asíncrona de request() para streams: devuelve (respuesta abierta, reintentos)"""
+        session = self.async_session()
+        retries = self.max_retries if max_retries is None else max_retries
+        timeout = httpx.Timeout(read_timeout or self.read_timeout, connect=self.connect_timeout)
+        start = time.time()
+        for attempt in range(retries + 1):
+            try:
+                request = session.build_request("POST", path, json=payload, timeout=timeout)
+                resp = await session.send(request, stream=True)
+                if resp.status_code in self.RETRY_STATUS and attempt < retries:
+                    await resp.aclose()
+                    raise httpx.ConnectError(f"HTTP {resp.status_code}")
+                if resp.is_error:
+                    await resp.aread()
+                    resp.raise_for_status()
+                return resp, attempt
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                if attempt >= retries:
+                    self.record(path, time.time() - start, retries=attempt, error=True)
+                    raise
+                self.on_retry(path, e, attempt, retries)
+                await asyncio.sleep(self.backoff * (2 ** attempt))
+            except httpx.HTTPError:
+                self.record(path, time.time() - start, retries=attempt, error=True)
+                raise
+
+    def on_retry(self, path: str, error: Exception, attempt: int, retries: int):
+        logger.warning(f"🔁 Ollama no disponible ({error}), reintento {attempt + 1}/{retries}")
+
+    def on_record(self, path: str, elapsed: float, ttft: float | None, error: bool):
+        logger.info(f"📈 Ollama {path}: {elapsed:.2f}s"
+                    + (f" (primer token {ttft:.2f}s)" if ttft is not None else "")
+                    + (" ❌" if error else ""))
+
+    def on_prompt_eval(self, path: str, count: int, duration: float):
+        logger.info(f"📏 Ollama {path}: prompt_eval {count} tokens en {duration * 1000:.0f} ms")
+
+
+OLLAMA_CLIENT = OllamaClient()
+atexit.register(OLLAMA_CLIENT.close_async_sessions)
+
+
+class ModelKeepWarm:
+    """Mantiene el modelo cargado en Ollama mientras haya sesiones activas.
+
+    Un hilo en segundo plano repite la precarga cada `interval` segundos,
+    pero solo si hubo actividad (`touch`) en los últimos `idle_window`.
+    """
+
+    def __init__(self, client: OllamaClient = OLLAMA_CLIENT,
+                 interval: float = OLLAMA_HEARTBEAT_INTERVAL,
+                 idle_window: float = OLLAMA_WARM_IDLE_WINDOW):
+        self.client = client
+        self.interval = interval
+        self.idle_window = idle_window
+        self.last_activity = time.time()
+        self._thread = None
+
+    def touch(self):
+        self.last_activity = time.time()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            if time.time() - self.last_activity > self.idle_window:
+                continue
+            try:
+                self.client.warm_up()
+            except requests.exceptions.RequestException as e:
+                logger.warning(f"⚠️ Latido de precarga fallido: {e}")
+
+
+KEEP_WARM = ModelKeepWarm()
+
+
+class OllamaStream:
+    """Consume la respuesta NDJSON de Ollama (stream=True) de forma incremental.
+
+    Se recorre con `async for`; cerrar el iterador (`aclose`) corta la conexión
+    y Ollama deja de generar.
+    """
+
+    def __init__(self, payload: dict, timeout: float | None = None,
+                 client: OllamaClient | None = None):
+        self.client = client or OLLAMA_CLIENT
+        self.payload = self.client.with_defaults(dict(payload, stream=True))
+        self.timeout = timeout
+        self.ttft = None
+        self.total_time = None
+        self.final_chunk = {}
+        self._parts = []
+        self._response = None
+        self._retries = 0
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def __aiter__(self) -> AsyncIterator[str]:
+        return self._iterate()
+
+    async def _iterate(self) -> AsyncIterator[str]:
+        start = time.time()
+        self._response, self._retries = await self.client.astream("/api/chat", self.payload,
+                                                                  read_timeout=self.timeout)
+        failed = True
+        try:
+            async for raw in self._response.aiter_lines():
+                if not raw:
+                    continue
+                chunk = json.loads(raw)
+                if "error" in chunk:
+                    raise RuntimeError(chunk["error"])
+                piece = chunk.get("message", {}).get("content", "")
+                if piece:
+                    if self.ttft is None:
+                        self.ttft = time.time() - start
+                    self._parts.append(piece)
+                    yield piece
+                if chunk.get("done"):
+                    self.final_chunk = chunk
+                    break
+            failed = False
+        except GeneratorExit:
+            # Corte intencionado del stream (JSON completo, presupuesto agotado...)
+            failed = False
+            raise
+        finally:
+            self.total_time = time.time() - start
+            self.client.record("/api/chat", self.total_time, self.ttft,
+                               retries=self._retries, error=failed)
+            if OLLAMA_MEASURE_PROMPT_EVAL and self.final_chunk:
+                self.client.record_prompt_eval("/api/chat", self.final_chunk)
+            await self.close()
+
+    async def close(self):
+        """Cierra la conexión HTTP (aborta la generación si aún no terminó)"""
+        if self._response is not None:
+            await self._response.aclose()
+
+
+async def ollama_chat(payload: dict, stop_when=None) -> str:
+    """Envía un chat a Ollama en modo streaming y devuelve el texto completo.
+
+    Si `stop_when(fragmento)` devuelve True se corta el stream HTTP y Ollama
+    deja de generar (salvo en modo medición, que necesita el chunk final).
+    """
+    stream = OllamaStream(payload)
+    tokens = aiter(stream)
+    async for piece in tokens:
+        if stop_when and stop_when(piece) and not OLLAMA_MEASURE_PROMPT_EVAL:
+            await tokens.aclose()
+            logger.info(f"✂️ Generación cortada tras {len(stream.text)} caracteres: JSON completo")
+            break
+    return stream.text.strip()
+
+
+async def call_ollama(user_request: str, extra_user: str = "") -> str:
+    # SYSTEM_PROMPT no cambia nunca: Ollama reutiliza la evaluación de ese prefijo.
+    # Cualquier texto variable (avisos de reintento, contexto) va en el mensaje de usuario.
     payload = {
         "model": OLLAMA_MODEL,
-        "stream": False,
         "messages": [
-            {"role": "system", "content": system_msg},
+            {"role": "system", "content": SYSTEM_PROMPT},
             {
                 "role": "user",
                 "content": (
+                    f"{extra_user}"
                     "Instrucción del usuario:\n"
                     f"{user_request}\n\n"
                     "Recuerda: debes devolver SOLO un JSON con la estructura indicada."
@@ -88,18 +386,18 @@ def call_ollama(user_request: str, extra_system: str = "") -> str:
             },
         ],
     }
+    if OLLAMA_STRUCTURED_OUTPUT:
+        payload["format"] = COMMAND_SCHEMA
     
     logger.info(f"🔍 Llamando a Ollama en: {OLLAMA_URL}")
     logger.info(f"🔍 Modelo: {OLLAMA_MODEL}")
     
+    extractor = IncrementalJSONExtractor(block_parser=try_parse_command)
     try:
-        resp = requests.post(OLLAMA_URL, json=payload, timeout=120)
-        resp.raise_for_status()
-        data = resp.json()
-        return data["message"]["content"].strip()
-    except requests.exceptions.HTTPError as e:
+        return await ollama_chat(payload, stop_when=lambda piece: extractor.feed(piece) is not None)
+    except httpx.HTTPStatusError as e:
         logger.error(f"❌ Error HTTP: {e}")
-        logger.error(f"🔍 Respuesta: {resp.text if 'resp' in locals() else 'No response'}")
+        logger.error(f"🔍 Respuesta: {e.response.text if e.response is not None else 'No response'}")
         raise
     except Exception as e:
         logger.error(f"❌ Error general: {e}")
@@ -130,7 +428,12 @@ def try_parse_command(content: str) -> dict | None:
     except Exception:
         pass
 
-    # 4) recortar primer { y último }
+    # 4) primer objeto balanceado con "command" (ignora texto posterior)
+    obj = IncrementalJSONExtractor().feed(content)
+    if obj is not None:
+        return obj
+
+    # 5) recortar primer { y último }
     start = content.find("{")
     end = content.rfind("}")
     if start != -1 and end != -1 and end > start:
@@ -144,28 +447,115 @@ def try_parse_command(content: str) -> dict | None:
     return None
 
 
-def ask_ollama_for_command(user_request: str) -> dict:
+def validate_command(obj: dict | None) -> dict:
+    """Valida el objeto contra COMMAND_SCHEMA y normaliza tipos; ValueError con el motivo"""
+    if not isinstance(obj, dict):
+        raise ValueError("la respuesta no es un objeto JSON")
+    command = obj.get("command")
+    if not isinstance(command, str) or not command.strip():
+        raise ValueError("falta 'command' o está vacío")
+    if any(placeholder in command for placeholder in COMMAND_PLACEHOLDERS):
+        raise ValueError(f"'command' usa un placeholder: {command}")
+    dangerous = obj.get("dangerous", False)
+    if isinstance(dangerous, str):
+        dangerous = dangerous.strip().lower() in ("true", "sí", "si", "yes", "1")
+    return {
+        "command": command.strip(),
+        "explanation": str(obj.get("explanation") or "").strip(),
+        "dangerous": bool(dangerous),
+        "reasoning": str(obj.get("reasoning") or "").strip(),
+    }
+
+
+async def ask_ollama_for_command(user_request: str) -> dict:
     # Primer intento
-    content1 = call_ollama(user_request)
-    cmd_obj = try_parse_command(content1)
-    if cmd_obj is not None:
-        return cmd_obj
+    content1 = await call_ollama(user_request)
+    try:
+        return validate_command(try_parse_command(content1))
+    except ValueError as e:
+        reason = str(e)
+    logger.warning(f"⚠️ Respuesta rechazada ({reason}), reintentando")
 
     # Segundo intento más estricto
-    extra_system = """
+    extra_user = f"""Tu respuesta anterior fue rechazada: {reason}.
 
 ESTO ES CRÍTICO:
 - Si devuelves algo que no sea EXACTAMENTE un JSON, el sistema fallará.
 - No expliques nada fuera del JSON.
 - No uses backticks ni bloques de código.
 - No escribas pasos ni instrucciones humanas.
+
 """
-    content2 = call_ollama(user_request, extra_system=extra_system)
-    cmd_obj = try_parse_command(content2)
-    if cmd_obj is not None:
-        return cmd_obj
+    content2 = await call_ollama(user_request, extra_user=extra_user)
+    try:
+        return validate_command(try_parse_command(content2))
+    except ValueError as e:
+        raise ValueError(f"No se pudo obtener JSON válido desde el modelo: {e}") from e
+
+# ========= Límites de concurrencia =========
+
+class ConcurrencyGate:
+    """Semáforo asyncio FIFO que informa de la posición en cola de cada espera.
+
+    Uso:
+        async for position in gate.wait_turn():
+            ...  # mostrar "posición N" en la UI
+        try:
+            ...  # trabajo con el permiso
+        finally:
+            gate.release()
+    """
+
+    def __init__(self, name: str, limit: int):
+        self.name = name
+        self.limit = max(1, limit)
+        self.active = 0
+        self._queue: deque[asyncio.Future] = deque()
+
+    @property
+    def waiting(self) -> int:
+        return len(self._queue)
+
+    async def wait_turn(self) -> AsyncIterator[int]:
+        """Emite la posición en cola mientras espera; al terminar, el permiso es del llamador"""
+        if self.active < self.limit and not self._queue:
+            self.active += 1
+            return
+        ticket = asyncio.get_running_loop().create_future()
+        self._queue.append(ticket)
+        try:
+            while not ticket.done():
+                yield self._queue.index(ticket) + 1
+                await asyncio.wait({ticket}, timeout=QUEUE_FEEDBACK_INTERVAL)
+        except BaseException:
+            # Cancelado en la cola: se sale de ella o se cede el permiso recién recibido
+            if ticket.done():
+                self.release()
+            else:
+                self._queue.remove(ticket)
+            raise
+
+    def release(self):
+        """Devuelve el permiso; si hay alguien esperando se le traspasa directamente"""
+        while self._queue:
+            ticket = self._queue.popleft()
+            if not ticket.done():
+                ticket.set_result(None)
+                return
+        self.active -= 1
+
+
+# Ollama procesa como mucho OLLAMA_NUM_PARALLEL peticiones a la vez: el resto haría
+# cola en el servidor sin que el usuario lo sepa y podría agotar el timeout de lectura.
+OLLAMA_GATE = ConcurrencyGate("ollama", OLLAMA_NUM_PARALLEL)
+SSH_GATE = ConcurrencyGate("ssh", SSH_MAX_CONCURRENT)
+HOST_GATES: dict[str, ConcurrencyGate] = {}
+
+
+def host_gate(host: str) -> ConcurrencyGate:
+    """Límite de comandos simultáneos en un mismo host"""
+    return HOST_GATES.setdefault(host, ConcurrencyGate(f"ssh:{host}", SSH_MAX_PER_HOST))
 
-    raise ValueError("No se pudo obtener JSON válido desde el modelo")
 
 # ========= SSH / Ejecución remota =========
 
@@ -195,21 +585,246 @@ def connect_ssh(host: str, user: str, use_ssh_key: bool,
     return client
 
 
+class SSHConnectionPool:
+    """Pool de conexiones SSH reutilizables indexadas por (host, usuario, método de autenticación).
+
+    Mantiene el transporte abierto entre comandos con keepalives, comprueba su salud
+    antes de reutilizarlo, reconecta de forma transparente y cierra las conexiones
+    que llevan más de `idle_timeout` segundos sin usarse. Cada `acquire` debe
+    cerrarse con `release` (o usar `lease`): mientras una conexión tiene usos
+    abiertos, como un `docker logs -f` largo, nunca se considera inactiva.
+    """
+
+    def __init__(self, keepalive_interval: int = SSH_KEEPALIVE_INTERVAL,
+                 idle_timeout: int = SSH_POOL_IDLE_TIMEOUT):
+        self.keepalive_interval = keepalive_interval
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._entries: dict[tuple, dict] = {}
+        self._reaper = None
+
+    @staticmethod
+    def make_key(host: str, user: str, use_ssh_key: bool,
+                 ssh_key_path: str | None, password: str | None) -> tuple:
+        # La credencial forma parte de la clave para no reutilizar una sesión
+        # autenticada con otra contraseña u otra clave privada.
+        if use_ssh_key:
+            return (host, user, "key", ssh_key_path or "")
+        secret = hashlib.sha256((password or "").encode("utf-8")).hexdigest()
+        return (host, user, "password", secret)
+
+    @staticmethod
+    def is_healthy(client: paramiko.SSHClient) -> bool:
+        transport = client.get_transport()
+        if transport is None or not transport.is_active() or not transport.is_authenticated():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def acquire(self, host: str, user: str, use_ssh_key: bool,
+                ssh_key_path: str | None, password: str | None) -> paramiko.SSHClient:
+        """Devuelve un cliente conectado, reutilizando el del pool si sigue sano"""
+        self.evict_idle()
+        self._start_reaper()
+
+        key = self.make_key(host, user, use_ssh_key, ssh_key_path, password)
+        with self._lock:
+            entry = self._entries.setdefault(
+                key, {"client": None, "last_used": 0.0, "in_use": 0, "lock": threading.Lock()}
+            )
+
+        with entry["lock"]:
+            client = entry["client"]
+            if client is not None and not self.is_healthy(client):
+                logger.info(f"♻️ Conexión SSH a {user}@{host} caída, reconectando...")
+                self._close_client(client)
+                client = None
+
+            if client is None:
+                client = connect_ssh(host, user, use_ssh_key, ssh_key_path, password)
+                transport = client.get_transport()
+                if transport is not None and self.keepalive_interval > 0:
+                    transport.set_keepalive(self.keepalive_interval)
+                entry["client"] = client
+                entry["in_use"] = 0  # los usos de la conexión anterior ya no se liberarán
+                logger.info(f"🔗 Nueva conexión SSH en el pool: {user}@{host}")
+
+            with self._lock:
+                entry["in_use"] += 1
+                entry["last_used"] = time.time()
+            return client
+
+    def release(self, transport: paramiko.Transport | None):
+        """Devuelve al pool un uso de la conexión dueña de `transport`"""
+        if transport is None:
+            return
+        with self._lock:
+            for entry in self._entries.values():
+                client = entry["client"]
+                if client is not None and client.get_transport() is transport:
+                    entry["in_use"] = max(0, entry["in_use"] - 1)
+                    entry["last_used"] = time.time()
+                    return
+
+    @contextlib.contextmanager
+    def lease(self, host: str, user: str, use_ssh_key: bool,
+              ssh_key_path: str | None, password: str | None) -> Iterator[paramiko.SSHClient]:
+        """`acquire` + `release` en un bloque with"""
+        client = self.acquire(host, user, use_ssh_key, ssh_key_path, password)
+        transport = client.get_transport()
+        try:
+            yield client
+        finally:
+            self.release(transport)
+
+    def invalidate(self, host: str, user: str, use_ssh_key: bool,
+                   ssh_key_path: str | None, password: str | None):
+        """Descarta la conexión asociada para forzar una reconexión en el próximo uso"""
+        key = self.make_key(host, user, use_ssh_key, ssh_key_path, password)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry and entry["client"] is not None:
+            self._close_client(entry["client"])
+
+    def evict_idle(self):
+        """Cierra las conexiones inactivas durante más de `idle_timeout` segundos"""
+        now = time.time()
+        with self._lock:
+            expired = [
+                key for key, entry in self._entries.items()
+                if entry["in_use"] == 0 and not entry["lock"].locked()
+                and now - entry["last_used"] > self.idle_timeout
+            ]
+            evicted = [self._entries.pop(key) for key in expired]
+        for entry in evicted:
+            if entry["client"] is not None:
+                logger.info("🧹 Cerrando conexión SSH inactiva del pool")
+                self._close_client(entry["client"])
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            if entry["client"] is not None:
+                self._close_client(entry["client"])
+
+    def _start_reaper(self):
+        if self._reaper is not None or self.idle_timeout <= 0:
+            return
+        interval = max(1, min(60, self.idle_timeout))
+
+        def reap():
+            while True:
+                time.sleep(interval)
+                self.evict_idle()
+
+        self._reaper = threading.Thread(target=reap, daemon=True)
+        self._reaper.start()
+
+    @staticmethod
+    def _close_client(client: paramiko.SSHClient):
+        try:
+            client.close()
+        except Exception:
+            pass
+
+
+SSH_POOL = SSHConnectionPool()
+atexit.register(SSH_POOL.close_all)
+
+
+def open_remote_channel(host: str, user: str, use_ssh_key: bool,
+                        ssh_key_path: str | None, password: str | None,
+                        command: str) -> paramiko.Channel:
+    """Lanza el comando sobre una conexión del pool y devuelve su canal.
+
+    La conexión queda en uso hasta cerrar el canal con `close_remote_channel`.
+    """
+    auth = (host, user, use_ssh_key, ssh_key_path, password)
+
+    # Solo se reintenta si falla la apertura del canal: el comando aún no se ha ejecutado
+    for attempt in range(2):
+        client = SSH_POOL.acquire(*auth)
+        try:
+            stdin, stdout, stderr = client.exec_command(command)
+            return stdout.channel
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            SSH_POOL.release(client.get_transport())
+            SSH_POOL.invalidate(*auth)
+            if attempt == 1:
+                raise
+            logger.warning(f"⚠️ Canal SSH no disponible ({e}), reconectando...")
+
+
+def close_remote_channel(channel: paramiko.Channel):
+    """Cierra el canal y libera su conexión en el pool"""
+    transport = channel.get_transport()
+    channel.close()
+    SSH_POOL.release(transport)
+
+
+async def iterate_in_thread(iterable: Iterable) -> AsyncIterator:
+    """Recorre un iterable bloqueante (p. ej. un canal paramiko) en un hilo del pool
+    y entrega sus elementos al bucle de eventos sin bloquearlo.
+
+    Si el consumidor se detiene, el hilo termina en el siguiente elemento; para
+    desbloquear una lectura en curso hay que cerrar la fuente (p. ej. el canal).
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    done = object()
+    stop = threading.Event()
+
+    def put(item, error=None):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, (item, error))
+        except RuntimeError:  # el bucle ya se cerró
+            stop.set()
+
+    def produce():
+        try:
+            for item in iterable:
+                if stop.is_set():
+                    return
+                put(item)
+        except Exception as e:
+            put(done, e)
+        else:
+            put(done)
+
+    loop.run_in_executor(None, produce)
+    try:
+        while True:
+            item, error = await queue.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
 def run_remote_command(host: str, user: str, use_ssh_key: bool,
                        ssh_key_path: str | None, password: str | None,
                        command: str) -> tuple[str, str, int]:
-    client = connect_ssh(host, user, use_ssh_key, ssh_key_path, password)
+    channel = open_remote_channel(host, user, use_ssh_key, ssh_key_path, password, command)
+    out_lines, err_lines = [], []
     try:
-        stdin, stdout, stderr = client.exec_command(command)
-        out = stdout.read().decode("utf-8", errors="ignore")
-        err = stderr.read().decode("utf-8", errors="ignore")
-        exit_code = stdout.channel.recv_exit_status()
-        return out, err, exit_code
+        for stream, line in iter_channel_output(channel):
+            (out_lines if stream == "stdout" else err_lines).append(line)
+        exit_code = channel.recv_exit_status()
     finally:
-        client.close()
+        close_remote_channel(channel)
+    return "\n".join(out_lines), "\n".join(err_lines), exit_code
 
 
-def explain_output(command: str, stdout: str, stderr: str) -> str:
+def build_explain_payload(command: str, stdout: str, stderr: str) -> dict:
+    stdout, stderr = compress_command_output(stdout, stderr, ANALYSIS_CONTEXT_TOKENS)
     user_msg = f"""
 He ejecutado el siguiente comando en una Raspberry Pi:
 
@@ -224,103 +839,43 @@ SALIDA STDERR:
 
 Explícame en español qué significa este resultado y si hay algo que deba corregir o revisar.
 """
-    payload = {
+    return {
         "model": OLLAMA_MODEL,
-        "stream": False,
         "messages": [
             {"role": "system", "content": "Eres un experto en Linux y administración de sistemas. Explica de forma clara y concisa en español."},
             {"role": "user", "content": user_msg},
         ],
     }
-    resp = requests.post(OLLAMA_URL, json=payload, timeout=120)
-    resp.raise_for_status()
-    data = resp.json()
-    return data["message"]["content"].strip()
+
+
+async def explain_output(command: str, stdout: str, stderr: str) -> str:
+    return await ollama_chat(build_explain_payload(command, stdout, stderr))
 
 # ========= Helpers para la UI =========
 
 def test_connection(host: str, user: str, use_ssh_key: bool,
                     ssh_key_path: str, password: str):
     try:
-        client = connect_ssh(
+        with SSH_POOL.lease(
             host=host,
             user=user,
             use_ssh_key=use_ssh_key,
             ssh_key_path=ssh_key_path if use_ssh_key else None,
             password=password if not use_ssh_key else None,
-        )
-        client.close()
+        ):
+            pass
         return "✅ Conexión SSH exitosa"
     except Exception as e:
         return f"❌ Error de conexión: {e}"
 
 
-def chat_agent(chat_history, user_request: str,
-               host: str, user: str, use_ssh_key: bool,
-               ssh_key_path: str, password: str):
-
-    user_request = (user_request or "").strip()
-    if not user_request:
-        return chat_history, ""
-
-    chat_history = chat_history or []
-    chat_history.append((user_request, None))
-
-    if not host or not user:
-        chat_history[-1] = (user_request, "❌ Configura host y usuario en el panel izquierdo.")
-        return chat_history, ""
-
-    if not use_ssh_key and not password:
-        chat_history[-1] = (user_request, "❌ Seleccionaste password pero no ingresaste la contraseña.")
-        return chat_history, ""
-
-    try:
-        cmd_obj = ask_ollama_for_command(user_request)
-    except Exception as e:
-        chat_history[-1] = (user_request, f"❌ Error al generar comando: {e}")
-        return chat_history, ""
-
-    command = cmd_obj.get("command", "").strip()
-    explanation = cmd_obj.get("explanation", "").strip()
-    dangerous = bool(cmd_obj.get("dangerous", False))
-
-    if not command:
-        chat_history[-1] = (user_request, "❌ El modelo no devolvió un comando.")
-        return chat_history, ""
-
-    try:
-        stdout, stderr, exit_code = run_remote_command(
-            host=host,
-            user=user,
-            use_ssh_key=use_ssh_key,
-            ssh_key_path=ssh_key_path if use_ssh_key else None,
-            password=password if not use_ssh_key else None,
-            command=command,
-        )
-    except Exception as e:
-        chat_history[-1] = (user_request, f"❌ Error ejecutando por SSH: {e}")
-        return chat_history, ""
-
-    if exit_code == 0:
-        exit_text = "0 (éxito)"
-        exit_icon = "✅"
-    else:
-        exit_text = f"{exit_code} (error)"
-        exit_icon = "⚠️"
-
-    result_text = stdout.strip() or "(sin salida)"
-    error_text = stderr.strip()
-
-    try:
-        explanation_detail = explain_output(command, stdout, stderr)
-    except Exception as e:
-        explanation_detail = f"⚠️ No se pudo obtener explicación detallada: {e}"
-
-    # Mejor formato para la respuesta
+def render_response_md(command: str, explanation: str, dangerous: bool,
+                       exit_text: str, exit_icon: str, result_text: str,
+                       error_text: str, explanation_detail: str) -> str:
     danger_icon = "🔴" if dangerous else "🟢"
     danger_text = "SÍ - Comando potencialmente peligroso" if dangerous else "NO - Comando seguro"
-    
-    respuesta_md = f"""
+
+    return f"""
 <div style="background: linear-gradient(135deg, #667eea 0%, #764ba2 100%); padding: 20px; border-radius: 15px; margin-bottom: 15px;">
     <h3 style="margin: 0; color: white;">🤖 Comando Ejecutado</h3>
 </div>
@@ -359,8 +914,185 @@ def chat_agent(chat_history, user_request: str,
 </div>
 """
 
-    chat_history[-1] = (user_request, respuesta_md)
-    return chat_history, ""
+
+async def chat_agent(chat_history, user_request: str,
+                     host: str, user: str, use_ssh_key: bool,
+                     ssh_key_path: str, password: str,
+                     analyze: bool = True, analysis_budget: float = ANALYSIS_BUDGET_SECONDS):
+    """Pipeline por etapas: cada etapa se envía al navegador en cuanto termina.
+
+    1. propuesta de comando, 2. salida en vivo de SSH, 3. análisis en streaming
+    (omitible con `analyze=False` o acotado por `analysis_budget` segundos).
+
+    Es un generador asíncrono: Ollama se consume con httpx y paramiko corre en
+    el pool de hilos solo mientras bloquea, así una sesión esperando al modelo
+    o a un comando no ocupa un hilo del servidor.
+    """
+
+    user_request = (user_request or "").strip()
+    if not user_request:
+        yield chat_history, ""
+        return
+
+    chat_history = chat_history or []
+    chat_history.append((user_request, None))
+
+    if not host or not user:
+        chat_history[-1] = (user_request, "❌ Configura host y usuario en el panel izquierdo.")
+        yield chat_history, ""
+        return
+
+    if not use_ssh_key and not password:
+        chat_history[-1] = (user_request, "❌ Seleccionaste password pero no ingresaste la contraseña.")
+        yield chat_history, ""
+        return
+
+    KEEP_WARM.touch()
+    async for position in OLLAMA_GATE.wait_turn():
+        chat_history[-1] = (user_request, f"⏳ En cola para el modelo (posición {position})...")
+        yield chat_history, ""
+    try:
+        chat_history[-1] = (user_request, "⏳ Generando comando...")
+        yield chat_history, ""
+        cmd_obj = await ask_ollama_for_command(user_request)
+    except Exception as e:
+        chat_history[-1] = (user_request, f"❌ Error al generar comando: {e}")
+        yield chat_history, ""
+        return
+    finally:
+        OLLAMA_GATE.release()
+
+    command = cmd_obj.get("command", "").strip()
+    explanation = cmd_obj.get("explanation", "").strip()
+    dangerous = bool(cmd_obj.get("dangerous", False))
+
+    if not command:
+        chat_history[-1] = (user_request, "❌ El modelo no devolvió un comando.")
+        yield chat_history, ""
+        return
+
+    def render(exit_text: str, exit_icon: str, result_text: str,
+               error_text: str, detail: str) -> str:
+        return render_response_md(command, explanation, dangerous, exit_text, exit_icon,
+                                  result_text, error_text, detail)
+
+    # Etapa 1: la propuesta se muestra antes de abrir la sesión SSH
+    chat_history[-1] = (user_request, render("pendiente", "⏳", "(sin salida)", "",
+                                             "⏳ Ejecutando comando..."))
+    yield chat_history, ""
+
+    # Turno de ejecución: primero el límite del host y luego el global (siempre en ese orden)
+    held = []
+    try:
+        for gate, place in ((host_gate(host), f"el host {host}"), (SSH_GATE, "el servidor")):
+            async for position in gate.wait_turn():
+                chat_history[-1] = (user_request, render("en cola", "⏳", "(sin salida)", "",
+                                                         f"⏳ Esperando turno de ejecución en {place} "
+                                                         f"(posición {position})..."))
+                yield chat_history, ""
+            held.append(gate)
+
+        try:
+            channel = await asyncio.to_thread(
+                open_remote_channel,
+                host=host,
+                user=user,
+                use_ssh_key=use_ssh_key,
+                ssh_key_path=ssh_key_path if use_ssh_key else None,
+                password=password if not use_ssh_key else None,
+                command=command,
+            )
+        except Exception as e:
+            chat_history[-1] = (user_request, f"❌ Error ejecutando por SSH: {e}")
+            yield chat_history, ""
+            return
+
+        # La salida se va mostrando mientras el comando corre (⏹️ Detener lo cancela)
+        out_lines, err_lines = [], []
+        last_refresh = 0.0
+        try:
+            async for stream_name, line in iterate_in_thread(iter_channel_output(channel)):
+                (out_lines if stream_name == "stdout" else err_lines).append(line)
+                if time.time() - last_refresh >= STREAM_UI_INTERVAL:
+                    live_out = "\n".join(out_lines[-LIVE_OUTPUT_MAX_LINES:]).strip() or "(sin salida)"
+                    live_err = "\n".join(err_lines[-LIVE_OUTPUT_MAX_LINES:]).strip()
+                    chat_history[-1] = (user_request, render("en curso", "⏳", live_out, live_err,
+                                                             "⏳ Esperando a que termine el comando..."))
+                    yield chat_history, ""
+                    last_refresh = time.time()
+            exit_code = await asyncio.to_thread(channel.recv_exit_status)
+        except Exception as e:
+            chat_history[-1] = (user_request, f"❌ Error ejecutando por SSH: {e}")
+            yield chat_history, ""
+            return
+        finally:
+            close_remote_channel(channel)
+    finally:
+        for gate in reversed(held):
+            gate.release()
+
+    stdout = "\n".join(out_lines)
+    stderr = "\n".join(err_lines)
+
+    if exit_code == 0:
+        exit_text = "0 (éxito)"
+        exit_icon = "✅"
+    else:
+        exit_text = f"{exit_code} (error)"
+        exit_icon = "⚠️"
+
+    result_text = stdout.strip() or "(sin salida)"
+    error_text = stderr.strip()
+
+    if not analyze:
+        chat_history[-1] = (user_request, render(exit_text, exit_icon, result_text,
+                                                 error_text, "Análisis IA desactivado."))
+        yield chat_history, ""
+        return
+
+    # Etapa 2: salida final visible mientras arranca el análisis
+    chat_history[-1] = (user_request, render(exit_text, exit_icon, result_text,
+                                             error_text, "🧠 Analizando..."))
+    yield chat_history, ""
+
+    # Etapa 3: el análisis se va mostrando a medida que llegan los tokens
+    async for position in OLLAMA_GATE.wait_turn():
+        chat_history[-1] = (user_request, render(exit_text, exit_icon, result_text, error_text,
+                                                 f"⏳ En cola para el análisis (posición {position})..."))
+        yield chat_history, ""
+    try:
+        budget = float(analysis_budget or 0)
+        deadline = time.time() + budget if budget > 0 else None
+        # Con presupuesto, el timeout de lectura también corta la espera del primer token
+        stream = OllamaStream(build_explain_payload(command, stdout, stderr),
+                              timeout=min(OLLAMA_READ_TIMEOUT, budget) if deadline else None)
+        tokens = aiter(stream)
+        last_refresh = 0.0
+        try:
+            async for _ in tokens:
+                if deadline and time.time() > deadline:
+                    await tokens.aclose()
+                    explanation_detail = (stream.text.strip()
+                                          + f"\n\n⏱️ Análisis cortado: se agotó el presupuesto de {budget:.0f}s.")
+                    break
+                if time.time() - last_refresh >= STREAM_UI_INTERVAL:
+                    chat_history[-1] = (user_request, render(exit_text, exit_icon, result_text,
+                                                             error_text, stream.text + " ▌"))
+                    yield chat_history, ""
+                    last_refresh = time.time()
+            else:
+                explanation_detail = stream.text.strip()
+        except httpx.TimeoutException:
+            explanation_detail = (stream.text.strip()
+                                  + f"\n\n⏱️ Análisis omitido: el modelo no respondió en {budget:.0f}s.")
+        except Exception as e:
+            explanation_detail = f"⚠️ No se pudo obtener explicación detallada: {e}"
+    finally:
+        OLLAMA_GATE.release()
+
+    chat_history[-1] = (user_request, render(exit_text, exit_icon, result_text,
+                                             error_text, explanation_detail))
+    yield chat_history, ""
 
 
 def toggle_auth_fields(use_ssh_key: bool):
@@ -623,6 +1355,7 @@ with gr.Blocks(title="Agente Raspberry Pi IA", theme=gr.themes.Soft(primary_hue=
                 
                 with gr.Row(elem_classes="buttons-row"):
                     send_btn = gr.Button("🚀 Ejecutar Comando", variant="primary", elem_classes="primary-btn")
+                    stop_btn = gr.Button("⏹️ Detener", variant="secondary", elem_classes="secondary-btn")
                     clear_btn = gr.Button("🗑️ Limpiar Chat", variant="secondary", elem_classes="secondary-btn")
         
         # Sidebar de configuración
@@ -662,6 +1395,21 @@ with gr.Blocks(title="Agente Raspberry Pi IA", theme=gr.themes.Soft(primary_hue=
                     visible=False
                 )
             
+            with gr.Group(elem_classes="config-group"):
+                analyze_checkbox = gr.Checkbox(
+                    label="🧠 Análisis IA de la salida",
+                    value=True,
+                    info="Desmarca para ver solo la salida del comando"
+                )
+                analysis_budget_slider = gr.Slider(
+                    label="⏱️ Presupuesto del análisis (s)",
+                    minimum=0,
+                    maximum=300,
+                    step=5,
+                    value=ANALYSIS_BUDGET_SECONDS,
+                    info="0 = sin límite"
+                )
+
             with gr.Group(elem_classes="config-group"):
                 test_btn = gr.Button("🔌 Probar Conexión", variant="primary", elem_classes="test-btn")
                 test_result = gr.Markdown("", elem_id="test-result")
@@ -682,7 +1430,7 @@ with gr.Blocks(title="Agente Raspberry Pi IA", theme=gr.themes.Soft(primary_hue=
         outputs=[ssh_key_path_box, password_box],
     )
 
-    send_btn.click(
+    send_event = send_btn.click(
         fn=chat_agent,
         inputs=[
             chat_state,
@@ -692,6 +1440,8 @@ with gr.Blocks(title="Agente Raspberry Pi IA", theme=gr.themes.Soft(primary_hue=
             use_key_checkbox,
             ssh_key_path_box,
             password_box,
+            analyze_checkbox,
+            analysis_budget_slider,
         ],
         outputs=[chatbot, user_input],
     )
@@ -703,7 +1453,7 @@ with gr.Blocks(title="Agente Raspberry Pi IA", theme=gr.themes.Soft(primary_hue=
     )
 
     # Enter para enviar
-    user_input.submit(
+    submit_event = user_input.submit(
         fn=chat_agent,
         inputs=[
             chat_state,
@@ -713,16 +1463,27 @@ with gr.Blocks(title="Agente Raspberry Pi IA", theme=gr.themes.Soft(primary_hue=
             use_key_checkbox,
             ssh_key_path_box,
             password_box,
+            analyze_checkbox,
+            analysis_budget_slider,
         ],
         outputs=[chatbot, user_input],
     )
 
+    # Cancela la ejecución en curso (p. ej. `docker logs -f`); el canal SSH se cierra
+    stop_btn.click(fn=None, inputs=None, outputs=None, cancels=[send_event, submit_event])
+
 if __name__ == "__main__":
     logger.info("🚀 Iniciando Agente Raspberry Pi IA...")
     
     # Esperar a que Ollama esté listo
     if wait_for_ollama():
+        try:
+            logger.info(f"🔥 Modelo {OLLAMA_MODEL} precargado en {OLLAMA_CLIENT.warm_up():.2f}s")
+        except requests.exceptions.RequestException as e:
+            logger.warning(f"⚠️ No se pudo precargar el modelo: {e}")
+        KEEP_WARM.start()
         logger.info("🌐 Iniciando servidor Gradio...")
+        demo.queue(concurrency_count=GRADIO_CONCURRENCY_COUNT, max_size=GRADIO_QUEUE_MAX_SIZE)
         demo.launch(server_name="0.0.0.0", server_port=7860, share=False)
     else:
         logger.error("❌ No se pudo conectar con Ollama. Saliendo...")
@@ -0,0 +1,238 @@
+"""Prueba de carga del agente web con N usuarios simulados.
+
+Levanta un Ollama simulado (HTTP local con streaming NDJSON) y sustituye la
+ejecución SSH por canales simulados, así que no necesita ni modelo ni
+Raspberry Pi. Lanza N sesiones concurrentes de `chat_agent` y comprueba que
+se respetan OLLAMA_NUM_PARALLEL, SSH_MAX_CONCURRENT y SSH_MAX_PER_HOST.
+
+Uso:
+    python loadtest.py --users 20 --hosts 3 --ollama-latency 0.5 --command-time 2
+    OLLAMA_NUM_PARALLEL=2 SSH_MAX_PER_HOST=1 python loadtest.py --users 10
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class Gauge:
+    """Contador de operaciones simultáneas con su máximo"""
+
+    def __init__(self):
+        self.current = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        with self._lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def leave(self):
+        with self._lock:
+            self.current -= 1
+
+
+OLLAMA_GAUGE = Gauge()
+SSH_GAUGE = Gauge()
+HOST_GAUGES: dict[str, Gauge] = {}
+
+COMMAND_REPLY = json.dumps({
+    "command": "uptime",
+    "explanation": "Muestra el tiempo encendido y la carga",
+    "dangerous": False,
+    "reasoning": "Petición de prueba",
+})
+ANALYSIS_REPLY = "El sistema responde con normalidad y la carga es baja. " * 8
+
+
+def make_ollama_handler(latency: float, token_delay: float):
+    class StubOllamaHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = json.dumps({"models": [{"name": "stub"}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            messages = payload.get("messages") or [{}]
+            is_command = "Instrucción del usuario" in messages[-1].get("content", "")
+            text = COMMAND_REPLY if is_command else ANALYSIS_REPLY
+
+            OLLAMA_GAUGE.enter()
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(latency)  # evaluación del prompt
+                for i in range(0, len(text), 8):
+                    time.sleep(token_delay)
+                    self._chunk({"message": {"role": "assistant", "content": text[i:i + 8]}, "done": False})
+            except (BrokenPipeError, ConnectionResetError):
+                return  # el cliente cortó el stream (JSON completo o presupuesto agotado)
+            finally:
+                # Como en Ollama, el hueco de generación se libera con el último token
+                OLLAMA_GAUGE.leave()
+            try:
+                self._chunk({"message": {"role": "assistant", "content": ""}, "done": True})
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def _chunk(self, obj: dict):
+            data = (json.dumps(obj) + "\n").encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+    return StubOllamaHandler
+
+
+class StubChannel:
+    """Canal SSH simulado: emite `lines` líneas repartidas en `duration` segundos"""
+
+    def __init__(self, host: str, duration: float, lines: int = 20):
+        self.host = host
+        self.duration = duration
+        self.lines = lines
+        self.sent = 0
+        self.closed = False
+        self.start = time.time()
+        SSH_GAUGE.enter()
+        HOST_GAUGES.setdefault(host, Gauge()).enter()
+
+    def _due(self) -> int:
+        if self.duration <= 0:
+            return self.lines
+        return min(self.lines, int((time.time() - self.start) / self.duration * self.lines))
+
+    def recv_ready(self) -> bool:
+        return self.sent < self._due()
+
+    def recv(self, size: int) -> bytes:
+        due = self._due()
+        data = "".join(f"línea {i} de {self.host}\n" for i in range(self.sent, due))
+        self.sent = due
+        return data.encode()
+
+    def recv_stderr_ready(self) -> bool:
+        return False
+
+    def get_transport(self):
+        return None
+
+    def recv_stderr(self, size: int) -> bytes:
+        return b""
+
+    @property
+    def eof_received(self) -> bool:
+        return self.sent >= self.lines
+
+    def exit_status_ready(self) -> bool:
+        return self.eof_received
+
+    def recv_exit_status(self) -> int:
+        while not self.exit_status_ready() and not self.closed:
+            time.sleep(0.01)
+        return 0
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            SSH_GAUGE.leave()
+            HOST_GAUGES[self.host].leave()
+
+
+async def simulate_user(app, index: int, hosts: int, analyze: bool) -> dict:
+    host = f"pi{index % hosts}"
+    start = time.time()
+    first_update = None
+    max_position = 0
+    message = ""
+    async for history, _ in app.chat_agent([], f"petición {index}", host, "pi", False, "", "x",
+                                           analyze, 0):
+        first_update = first_update or time.time() - start
+        message = history[-1][1] or ""
+        for position in re.findall(r"posición (\d+)", message):
+            max_position = max(max_position, int(position))
+    return {
+        "host": host,
+        "total": time.time() - start,
+        "first_update": first_update,
+        "max_position": max_position,
+        "ok": not message.startswith("❌"),
+    }
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="usuarios simultáneos")
+    parser.add_argument("--hosts", type=int, default=2, help="hosts distintos entre los que se reparten")
+    parser.add_argument("--ollama-latency", type=float, default=0.5, help="segundos hasta el primer token")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="segundos entre fragmentos")
+    parser.add_argument("--command-time", type=float, default=1.0, help="duración de cada comando SSH")
+    parser.add_argument("--no-analysis", action="store_true", help="omitir la etapa de análisis")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), make_ollama_handler(args.ollama_latency, args.token_delay))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    os.environ["OLLAMA_URL"] = f"http://127.0.0.1:{server.server_port}/api/chat"
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+    logging.getLogger(app.__name__).setLevel(logging.WARNING)
+    app.open_remote_channel = lambda host, **kwargs: StubChannel(host, args.command_time)
+
+    async def run_all():
+        try:
+            return await asyncio.gather(*(simulate_user(app, i, args.hosts, not args.no_analysis)
+                                          for i in range(args.users)))
+        finally:
+            await app.OLLAMA_CLIENT.aclose()
+
+    start = time.time()
+    results = asyncio.run(run_all())
+    wall = time.time() - start
+    server.shutdown()
+
+    totals = [r["total"] for r in results]
+    firsts = [r["first_update"] for r in results]
+    print(f"Usuarios: {args.users} en {args.hosts} hosts | tiempo total {wall:.2f}s")
+    print(f"Sesión completa: p50 {percentile(totals, 50):.2f}s  p95 {percentile(totals, 95):.2f}s  "
+          f"máx {max(totals):.2f}s  media {statistics.mean(totals):.2f}s")
+    print(f"Primera respuesta en la UI: máx {max(firsts) * 1000:.0f} ms")
+    print(f"Posición máxima en cola mostrada: {max(r['max_position'] for r in results)}")
+    print(f"Completadas sin error: {sum(r['ok'] for r in results)}/{len(results)}")
+    print(f"Ollama simultáneas: {OLLAMA_GAUGE.peak} (límite {app.OLLAMA_NUM_PARALLEL})")
+    print(f"SSH simultáneas: {SSH_GAUGE.peak} (límite {app.SSH_MAX_CONCURRENT})")
+    for host, gauge in sorted(HOST_GAUGES.items()):
+        print(f"  {host}: {gauge.peak} (límite {app.SSH_MAX_PER_HOST})")
+
+    violations = (OLLAMA_GAUGE.peak > app.OLLAMA_NUM_PARALLEL
+                  or SSH_GAUGE.peak > app.SSH_MAX_CONCURRENT
+                  or any(g.peak > app.SSH_MAX_PER_HOST for g in HOST_GAUGES.values()))
+    sys.exit(1 if violations or not all(r["ok"] for r in results) else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,381 @@
+"""Lógica común del agente de terminal (rpi_agent.py) y del agente web (agent-ui/app.py).
+
+Compresión de salidas para el LLM, cliente HTTP de Ollama, extracción
+incremental del JSON del comando y lectura multiplexada de canales SSH. La
+configuración de cada interfaz (constantes del script o variables de entorno)
+se pasa como argumento; aquí no se lee ninguna.
+"""
+import codecs
+import json
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterator, List
+
+import paramiko
+import requests
+
+
+# ========= Compresión de contexto para el LLM =========
+
+# Palabras clave de líneas relevantes en salidas largas
+IMPORTANT_KEYWORDS = [
+    'error', 'warn', 'fail', 'denied', 'refused', 'timeout', 'active:', 'loaded:',
+    'main pid', 'tunnel:', 'ingress:', 'hostname:', 'service:'
+]
+CONTEXT_CHARS_PER_TOKEN = 3.5    # estimación sin tokenizador (logs y español)
+CONTEXT_MAX_LINE_CHARS = 300     # líneas más largas se recortan
+
+# Números, hex y timestamps se ignoran al buscar líneas de log repetidas
+LOG_NOISE_RE = re.compile(r"0x[0-9a-fA-F]+|[0-9a-fA-F]{12,}|\d+")
+
+
+def estimate_tokens(text: str) -> int:
+    """Estimación rápida de tokens (sin tokenizador): ~CONTEXT_CHARS_PER_TOKEN caracteres por token"""
+    return int(len(text) / CONTEXT_CHARS_PER_TOKEN) + 1
+
+
+def compress_output(text: str, max_tokens: int) -> str:
+    """Ajusta la salida de un comando a unos `max_tokens` antes de meterla en un prompt.
+
+    1. Colapsa líneas repetidas (ignorando números) en la última de ellas con su contador.
+    2. Si aún no cabe, conserva las líneas con palabras clave (las más recientes
+       primero), el principio y el final, marcando los huecos omitidos.
+    """
+    if estimate_tokens(text) <= max_tokens:
+        return text
+
+    # Cada línea repetida queda en la posición de su última aparición (con su
+    # texto más reciente) para no perder el orden temporal de los eventos
+    entries = {}   # clave -> [línea, repeticiones]
+    for line in text.splitlines():
+        stripped = line.strip()
+        if not stripped:
+            continue
+        key = LOG_NOISE_RE.sub("#", stripped)
+        previous = entries.pop(key, None)
+        entries[key] = [line.rstrip(), previous[1] + 1 if previous else 1]
+
+    lines = []
+    for line, count in entries.values():
+        if len(line) > CONTEXT_MAX_LINE_CHARS:
+            line = line[:CONTEXT_MAX_LINE_CHARS] + "…"
+        lines.append(f"{line}  (×{count})" if count > 1 else line)
+
+    budget = int(max_tokens * CONTEXT_CHARS_PER_TOKEN)
+    if sum(len(line) + 1 for line in lines) <= budget:
+        return "\n".join(lines)
+
+    # Selección: ~10% del presupuesto queda para los marcadores de omisión
+    budget = int(budget * 0.9)
+    keep = set()
+    used = 0
+
+    def take(i: int) -> bool:
+        nonlocal used
+        cost = len(lines[i]) + 1
+        if used + cost > budget:
+            return False
+        keep.add(i)
+        used += cost
+        return True
+
+    important = [i for i, line in enumerate(lines)
+                 if any(keyword in line.lower() for keyword in IMPORTANT_KEYWORDS)]
+    for i in reversed(important):
+        if used > budget // 2 or not take(i):
+            break
+    for i in range(len(lines)):
+        if used > budget // 2 + budget // 6:
+            break
+        if i not in keep and not take(i):
+            break
+    for i in range(len(lines) - 1, -1, -1):
+        if i not in keep and not take(i):
+            break
+
+    result = []
+    gap = 0
+    for i, line in enumerate(lines):
+        if i in keep:
+            if gap:
+                result.append(f"... [{gap} líneas omitidas] ...")
+                gap = 0
+            result.append(line)
+        else:
+            gap += 1
+    if gap:
+        result.append(f"... [{gap} líneas omitidas] ...")
+    return "\n".join(result)
+
+
+def compress_command_output(stdout: str, stderr: str, max_tokens: int) -> tuple[str, str]:
+    """Reparte el presupuesto entre stdout y stderr (stderr hasta un tercio)"""
+    stderr = compress_output(stderr, max_tokens // 3)
+    stdout = compress_output(stdout, max(max_tokens - estimate_tokens(stderr), max_tokens // 3))
+    return stdout, stderr
+
+
+# ========= Cliente Ollama =========
+
+class OllamaClient:
+    """Cliente HTTP compartido para Ollama.
+
+    Reutiliza conexiones (requests.Session con keep-alive), separa los
+    timeouts de conexión y lectura, reintenta con backoff exponencial los
+    errores transitorios y acumula métricas de latencia por endpoint. Cada
+    interfaz informa a su manera redefiniendo `on_retry`, `on_record` y
+    `on_prompt_eval`.
+    """
+    RETRY_STATUS = (502, 503, 504)
+
+    def __init__(self, chat_url: str, model: str, keep_alive: str, options: Dict[str, int],
+                 connect_timeout: float = 5, read_timeout: float = 120, max_retries: int = 3,
+                 backoff: float = 0.5, pool_maxsize: int = 8):
+        self.base_url = chat_url.split("/api/", 1)[0]
+        self.model = model
+        self.keep_alive = keep_alive
+        self.options = options
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.metrics: Dict[str, Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    def request(self, method: str, path: str, payload: dict | None = None, stream: bool = False,
+                read_timeout: float | None = None, max_retries: int | None = None) -> requests.Response:
+        """Petición con reintentos; los errores de lectura no se reintentan (la generación pudo empezar)"""
+        retries = self.max_retries if max_retries is None else max_retries
+        timeout = (self.connect_timeout, read_timeout or self.read_timeout)
+        start = time.time()
+        for attempt in range(retries + 1):
+            try:
+                resp = self.session.request(method, self.base_url + path, json=payload,
+                                            stream=stream, timeout=timeout)
+                if resp.status_code in self.RETRY_STATUS and attempt < retries:
+                    resp.close()
+                    raise requests.exceptions.ConnectionError(f"HTTP {resp.status_code}")
+                resp.raise_for_status()
+                if stream:
+                    resp.retries = attempt  # el stream registra la métrica al terminar
+                else:
+                    self.record(path, time.time() - start, retries=attempt)
+                return resp
+            except requests.exceptions.ConnectionError as e:
+                if attempt >= retries:
+                    self.record(path, time.time() - start, retries=attempt, error=True)
+                    raise
+                self.on_retry(path, e, attempt, retries)
+                time.sleep(self.backoff * (2 ** attempt))
+            except requests.exceptions.RequestException:
+                self.record(path, time.time() - start, retries=attempt, error=True)
+                raise
+
+    def record(self, path: str, elapsed: float, ttft: float | None = None,
+               retries: int = 0, error: bool = False):
+        with self._lock:
+            m = self.metrics.setdefault(path, {"calls": 0, "errors": 0, "retries": 0,
+                                               "total_time": 0.0, "max_time": 0.0,
+                                               "ttft_total": 0.0, "ttft_calls": 0,
+                                               "prompt_tokens": 0, "prompt_eval_time": 0.0,
+                                               "prompt_eval_calls": 0})
+            m["calls"] += 1
+            m["errors"] += int(error)
+            m["retries"] += retries
+            m["total_time"] += elapsed
+            m["max_time"] = max(m["max_time"], elapsed)
+            if ttft is not None:
+                m["ttft_total"] += ttft
+                m["ttft_calls"] += 1
+        self.on_record(path, elapsed, ttft, error)
+
+    def record_prompt_eval(self, path: str, final_chunk: dict):
+        """Registra cuántos tokens del prompt evaluó Ollama (los del prefijo reutilizado no cuentan)"""
+        count = final_chunk.get("prompt_eval_count", 0)
+        duration = final_chunk.get("prompt_eval_duration", 0) / 1e9
+        with self._lock:
+            m = self.metrics[path]
+            m["prompt_tokens"] += count
+            m["prompt_eval_time"] += duration
+            m["prompt_eval_calls"] += 1
+        self.on_prompt_eval(path, count, duration)
+
+    def on_retry(self, path: str, error: Exception, attempt: int, retries: int):
+        """Aviso antes de reintentar una petición (por defecto, nada)"""
+
+    def on_record(self, path: str, elapsed: float, ttft: float | None, error: bool):
+        """Aviso de cada llamada terminada (por defecto, nada)"""
+
+    def on_prompt_eval(self, path: str, count: int, duration: float):
+        """Aviso de los tokens de prompt evaluados (por defecto, nada)"""
+
+    def tags(self, max_retries: int | None = None) -> dict:
+        return self.request("GET", "/api/tags", max_retries=max_retries).json()
+
+    def embed(self, text: str, model: str) -> List[float]:
+        """Embedding de `text` con el endpoint /api/embed de Ollama"""
+        resp = self.request("POST", "/api/embed", {"model": model, "input": text,
+                                                   "keep_alive": self.keep_alive})
+        return resp.json()["embeddings"][0]
+
+    def with_defaults(self, payload: dict) -> dict:
+        """Añade keep_alive y el bloque de opciones común (el payload tiene prioridad)"""
+        merged = dict(payload)
+        merged.setdefault("keep_alive", self.keep_alive)
+        merged["options"] = {**self.options, **payload.get("options", {})}
+        return merged
+
+    def warm_up(self, model: str | None = None) -> float:
+        """Precarga el modelo en memoria (chat sin mensajes) y devuelve lo que tardó"""
+        start = time.time()
+        resp = self.request("POST", "/api/chat",
+                            self.with_defaults({"model": model or self.model, "messages": [],
+                                                "stream": False}))
+        resp.close()
+        return time.time() - start
+
+    def metrics_summary(self) -> List[str]:
+        lines = []
+        with self._lock:
+            for path, m in self.metrics.items():
+                avg = m["total_time"] / m["calls"] if m["calls"] else 0.0
+                line = (f"{path}: {m['calls']} llamadas, media {avg:.2f}s, máx {m['max_time']:.2f}s, "
+                        f"{m['retries']} reintentos, {m['errors']} errores")
+                if m["ttft_calls"]:
+                    line += f", primer token medio {m['ttft_total'] / m['ttft_calls']:.2f}s"
+                if m["prompt_eval_calls"]:
+                    line += (f", prompt_eval medio {m['prompt_tokens'] / m['prompt_eval_calls']:.0f} tokens"
+                             f" / {m['prompt_eval_time'] * 1000 / m['prompt_eval_calls']:.0f} ms")
+                lines.append(line)
+        return lines
+
+
+class IncrementalJSONExtractor:
+    """Detecta en un flujo de texto el primer objeto JSON balanceado que contiene `required_key`.
+
+    Ignora las llaves dentro de cadenas. Con `block_parser` reconoce además un
+    bloque <json>...</json> cerrado y lo interpreta con esa función.
+    """
+    def __init__(self, required_key: str = "command",
+                 block_parser: Callable[[str], dict | None] | None = None):
+        self.required_key = required_key
+        self.block_parser = block_parser
+        self.result = None
+        self._text = ""
+        self._candidate = []
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> dict | None:
+        """Procesa un fragmento; devuelve el objeto en cuanto se completa"""
+        if self.result is not None:
+            return self.result
+
+        if self.block_parser is not None:
+            self._text += chunk
+        for ch in chunk:
+            if self._depth == 0:
+                if ch == '{':
+                    self._depth = 1
+                    self._candidate = [ch]
+                continue
+
+            self._candidate.append(ch)
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+            elif ch == '"':
+                self._in_string = True
+            elif ch == '{':
+                self._depth += 1
+            elif ch == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        obj = json.loads("".join(self._candidate))
+                    except json.JSONDecodeError:
+                        obj = None
+                    self._candidate = []
+                    if self._accept(obj):
+                        return self.result
+
+        # Cierre de bloque <json>...</json> (la etiqueta puede llegar partida entre fragmentos)
+        if (self.block_parser is not None and "</json>" in self._text[-(len(chunk) + 6):]
+                and "<json>" in self._text):
+            self._accept(self.block_parser(self._text))
+        return self.result
+
+    def _accept(self, obj) -> bool:
+        if isinstance(obj, dict) and self.required_key in obj:
+            self.result = obj
+            return True
+        return False
+
+
+# ========= Canales SSH =========
+
+def iter_channel_output(channel: paramiko.Channel, chunk_size: int = 32768,
+                        poll_interval: float = 0.05, pty: bool = False,
+                        counters: Dict[str, int] | None = None,
+                        registry=None) -> Iterator[tuple[str, str]]:
+    """Multiplexa stdout/stderr de un canal y emite (flujo, línea) a medida que llegan.
+
+    Leer ambos flujos por turnos evita el bloqueo que se produce cuando stderr
+    llena su ventana mientras se vacía stdout con read(). Con `pty=True` las
+    líneas llegan terminadas en CRLF (y stderr mezclado en stdout). En
+    `counters` se acumulan los bytes recibidos por flujo. Si se pasa
+    `registry` (con `add`/`discard`), el canal queda registrado mientras se lee.
+    """
+    decoders = {
+        "stdout": codecs.getincrementaldecoder("utf-8")(errors="ignore"),
+        "stderr": codecs.getincrementaldecoder("utf-8")(errors="ignore"),
+    }
+    pending = {"stdout": "", "stderr": ""}
+
+    def split_lines(name: str, data: bytes) -> List[str]:
+        if counters is not None:
+            counters[name] = counters.get(name, 0) + len(data)
+        text = pending[name] + decoders[name].decode(data)
+        *lines, pending[name] = text.split('\n')
+        if pty:
+            return [line.rstrip('\r') for line in lines]
+        return lines
+
+    if registry is not None:
+        registry.add(channel)
+    try:
+        while True:
+            received = False
+            if channel.recv_ready():
+                received = True
+                for line in split_lines("stdout", channel.recv(chunk_size)):
+                    yield "stdout", line
+            if channel.recv_stderr_ready():
+                received = True
+                for line in split_lines("stderr", channel.recv_stderr(chunk_size)):
+                    yield "stderr", line
+            if received:
+                continue
+            if channel.closed or (channel.eof_received and channel.exit_status_ready()):
+                break
+            time.sleep(poll_interval)
+    finally:
+        if registry is not None:
+            registry.discard(channel)
+
+    for name in ("stdout", "stderr"):
+        rest = pending[name] + decoders[name].decode(b"", final=True)
+        if pty:
+            rest = rest.rstrip('\r')
+        if rest:
+            yield name, rest
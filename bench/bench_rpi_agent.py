@@ -0,0 +1,188 @@
+"""Benchmarks del agente CLI (rpi_agent.py).
+
+Renderizado de salidas largas y resaltado del análisis no necesitan ni
+Raspberry Pi ni modelo. La comparación de generación de comandos con y sin
+esquema JSON llama a Ollama, así que solo se ejecuta con --commands.
+
+Uso:
+    python bench/bench_rpi_agent.py
+    python bench/bench_rpi_agent.py --lines 20000 --repeat 5
+    python bench/bench_rpi_agent.py --commands
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+from typing import Callable, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import rpi_agent as agent  # noqa: E402
+from rpi_agent import BLUE, RESET, WHITE, IMPORTANT_KEYWORDS, print_kv, print_section  # noqa: E402
+
+
+def original_print_output_block(content: str, title: str = "SALIDA", max_lines: int = 50):
+    """print_output_block original, solo como referencia.
+
+    Elegía las líneas a mostrar pero formateaba la salida completa y buscaba
+    'systemctl status' en todo el texto una vez por línea (coste cuadrático).
+    """
+    if not content.strip():
+        return
+
+    lines = content.strip().split('\n')
+    if len(lines) > max_lines:
+        important_lines = [line for line in lines
+                           if any(keyword in line.lower() for keyword in IMPORTANT_KEYWORDS)]
+        if important_lines:
+            lines = important_lines[:max_lines]
+        else:
+            lines = lines[:max_lines//2] + lines[-(max_lines//2):]
+
+    print(f"{BLUE}│{RESET}")
+    print(f"{BLUE}│{WHITE} 📋 {title}:{RESET}")
+
+    formatted_lines = []
+    yaml_lines = []
+    current_section = None
+    for line in content.strip().split('\n'):
+        if line.strip().endswith('.yml:') or line.strip() in ['cloudflare-tunnel.yml', 'production-tunnel.yml']:
+            if yaml_lines and current_section:
+                formatted_lines.extend(yaml_lines)
+                yaml_lines = []
+            current_section = line.strip()
+            formatted_lines.append(f"{BLUE}│{WHITE} 📄 {current_section}{RESET}")
+            continue
+        if 'systemctl status' in content and any(x in line for x in ['●', 'Loaded:', 'Active:', 'Main PID:']):
+            if yaml_lines:
+                formatted_lines.extend(yaml_lines)
+                yaml_lines = []
+            formatted_lines.append(f"{BLUE}│{RESET}   {line}")
+            continue
+        if line.strip() and (':' in line or line.strip().startswith('- ') or line.strip().startswith('  ')):
+            yaml_lines.append(f"{BLUE}│{RESET}   {line}")
+        else:
+            if yaml_lines:
+                formatted_lines.extend(yaml_lines)
+                yaml_lines = []
+            if line.strip():
+                formatted_lines.append(f"{BLUE}│{RESET}   {line}")
+    formatted_lines.extend(yaml_lines)
+    for line in formatted_lines[:max_lines + 10]:
+        print(line)
+
+
+def benchmark_output_rendering(n_lines: int = 100_000, repeat: int = 3, original_lines: int = 10_000):
+    """Mide print_output_block sobre salidas de `n_lines` líneas y lo compara con el original.
+
+    El original es cuadrático (minutos con cien mil líneas), así que la
+    comparación se hace sobre las primeras `original_lines` líneas.
+    """
+    samples = {
+        "log plano": [f"2024-01-01 12:00:{i % 60:02d} request {i} served in {i % 97}ms" for i in range(n_lines)],
+        "log con errores": [f"2024-01-01 12:00:{i % 60:02d} {'ERROR' if i % 50 == 0 else 'INFO'} item={i}"
+                            for i in range(n_lines)],
+        "systemctl status": ["● cloudflared.service - Cloudflare Tunnel", "   Loaded: loaded", "   Active: active (running)"]
+                            + [f"jun 01 12:00:00 rpi cloudflared[{i}]: conn {i}" for i in range(n_lines)]
+                            + ["systemctl status cloudflared"],
+    }
+
+    def best_time(render: Callable[[str], None], content: str, runs: int) -> float:
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                render(content)
+            timings.append(time.perf_counter() - start)
+        return min(timings) * 1000
+
+    print_section(f"BENCHMARK RENDERIZADO ({n_lines} líneas)", "⏱️ ")
+    for name, lines in samples.items():
+        content = '\n'.join(lines)
+        full = best_time(agent.print_output_block, content, repeat)
+        format_all = best_time(agent.format_output_with_sections, content, 1)
+        # La muestra reducida conserva la línea final (la del systemctl status)
+        small_content = '\n'.join(lines[:original_lines - 1] + lines[-1:])
+        small = best_time(agent.print_output_block, small_content, repeat)
+        original = best_time(original_print_output_block, small_content, 1)
+        print_kv(name, f"print_output_block {full:.1f} ms (formatear todo {format_all:.1f} ms) | "
+                       f"con {original_lines} líneas: "
+                       f"{small:.1f} ms frente a {original:.0f} ms del original (x{original / small:.0f})")
+
+
+def benchmark_highlighting(n_paragraphs: int = 2_000, repeat: int = 3):
+    """Mide highlight_important_text sobre un análisis largo"""
+    paragraph = (
+        "**Estado del sistema**\n"
+        "- El contenedor arkanops-frontend está running y healthy desde 2024-05-01 10:22:13.\n"
+        "- Se detectó un error de conexión hacia 192.168.1.96:3000 (warning: reintentos fallidos).\n"
+        "- Es important revisar el ID 3f2a9c1b7d4e y la MAC b8:27:eb:12:34:56; recommend reiniciar.\n"
+    )
+    text = paragraph * n_paragraphs
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        agent.highlight_important_text(text)
+        timings.append(time.perf_counter() - start)
+
+    best = min(timings)
+    matches = sum(1 for match in agent.HIGHLIGHT_RE.finditer(text) if match.lastgroup != "ansi")
+    print_section(f"BENCHMARK RESALTADO ({len(text) // 1024} KB)", "⏱️ ")
+    print_kv("una pasada", f"{best * 1000:.1f} ms ({len(text) / best / 1_048_576:.1f} MB/s)")
+    print_kv("coincidencias", str(matches))
+
+
+BENCH_COMMAND_PROMPTS = [
+    "muestra el uso de disco",
+    "lista los contenedores en ejecución",
+    "revisa los logs del contenedor frontend",
+    "cuánta memoria libre queda",
+    "estado del servicio ssh",
+    "qué puertos están escuchando",
+    "temperatura de la cpu",
+    "reinicia el contenedor gateway",
+]
+
+
+def benchmark_command_generation(prompts: List[str] = BENCH_COMMAND_PROMPTS):
+    """Compara la generación de comandos con y sin esquema JSON (requiere Ollama)"""
+    original = agent.COMMAND_SCHEMA_ENABLED
+    print_section(f"BENCHMARK GENERACIÓN DE COMANDOS ({len(prompts)} peticiones)", "⏱️ ")
+    try:
+        for enabled in (False, True):
+            agent.COMMAND_SCHEMA_ENABLED = enabled
+            agent.COMMAND_GENERATION_STATS.update(requests=0, retries=0, failures=0)
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for prompt in prompts:
+                    agent.generate_command_with_ollama(prompt)
+            elapsed = time.perf_counter() - start
+            stats = agent.COMMAND_GENERATION_STATS
+            inferences = stats["requests"] + stats["retries"]
+            print_kv("con esquema" if enabled else "solo prompt",
+                     f"{stats['retries']} reintentos, {stats['failures']} fallos, "
+                     f"{inferences / len(prompts):.2f} inferencias/petición, "
+                     f"{elapsed / len(prompts):.2f} s/petición")
+    finally:
+        agent.COMMAND_SCHEMA_ENABLED = original
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=100_000, help="líneas de las salidas simuladas")
+    parser.add_argument("--repeat", type=int, default=3, help="repeticiones (se toma la mejor)")
+    parser.add_argument("--commands", action="store_true",
+                        help="compara la generación de comandos con y sin esquema (requiere Ollama)")
+    args = parser.parse_args()
+
+    if args.commands:
+        benchmark_command_generation()
+        return
+    benchmark_output_rendering(args.lines, args.repeat, min(args.lines, 10_000))
+    benchmark_highlighting(repeat=args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 #pip install --user requests paramiko colorama
 #!/usr/bin/env python3
+import abc
 import json
 import getpass
 import requests
@@ -7,8 +8,36 @@ import paramiko
 import time
 import re
 import sys
+import os
+import sqlite3
+import hashlib
+import unicodedata
+import base64
+import gzip
+import zlib
+import tempfile
+import itertools
+import contextlib
 import threading
-from typing import List, Dict, Any
+import asyncio
+import functools
+import difflib
+import secrets
+import shlex
+import signal
+import weakref
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Dict, Any, Callable, Iterable, Iterator
+
+import agent_common
+from agent_common import (IMPORTANT_KEYWORDS, CONTEXT_CHARS_PER_TOKEN, IncrementalJSONExtractor,
+                          compress_command_output, compress_output, estimate_tokens)
+
+try:
+    import numpy as np
+except ImportError:  # la caché semántica es opcional
+    np = None
 
 # Colores y estilos (con fallback si no hay colorama)
 try:
@@ -33,20 +62,116 @@ except ImportError:
 OLLAMA_URL = "http://localhost:11434/api/chat"
 OLLAMA_MODEL = "deepseek-coder:6.7b"
 
+# Cliente HTTP de Ollama
+OLLAMA_CONNECT_TIMEOUT = 5       # segundos para establecer la conexión
+OLLAMA_READ_TIMEOUT = 120        # segundos máximos entre fragmentos de respuesta
+OLLAMA_MAX_RETRIES = 3           # reintentos ante errores transitorios
+OLLAMA_RETRY_BACKOFF = 0.5       # espera base (se duplica en cada reintento)
+
+# Modelo siempre caliente: keep_alive y opciones enviados en cada petición
+OLLAMA_KEEP_ALIVE = "30m"        # tiempo que Ollama mantiene el modelo cargado tras cada uso
+OLLAMA_OPTIONS = {
+    "num_ctx": 4096,             # fijo: cambiarlo entre llamadas obliga a recargar el modelo
+    "num_predict": 1024,
+}
+OLLAMA_HEARTBEAT_INTERVAL = 240  # segundos entre pings de mantenimiento durante la sesión
+
+# Salida estructurada: Ollama restringe la generación al esquema JSON del comando
+# (parámetro `format`, Ollama >= 0.5). Con False se vuelve a confiar solo en el prompt.
+COMMAND_SCHEMA_ENABLED = True
+
+# Modo plan: en diagnósticos el modelo puede devolver varios comandos de solo lectura
+# que se ejecutan en un único canal SSH y se analizan en una sola llamada
+PLAN_MODE_ENABLED = True
+PLAN_MAX_STEPS = 5
+PLAN_PARALLEL = True             # pasos independientes en canales simultáneos de la misma conexión
+SSH_MAX_CHANNELS_PER_HOST = 4    # canales simultáneos por host (MaxSessions de OpenSSH es 10)
+
+# Modo medición: muestra prompt_eval_count/prompt_eval_duration de cada llamada
+# (también con --measure-prompt). Deja terminar los streams para recibir las cifras.
+MEASURE_PROMPT_EVAL = False
+
 # Datos del servidor
 RPI_HOST = "192.168.1.96"
 RPI_USER = "pfranco"
 USE_SUDO = False
 SUDO_PASSWORD = None
 
+# Sudo con PTY: se detecta el prompt en el flujo y se envía la contraseña una sola vez
+SUDO_PROMPT_MARKER = "[rpi-agent sudo]"   # se le añade un sufijo aleatorio por proceso
+SUDO_TIMESTAMP_TTL = 15 * 60     # validez de las credenciales sudo (timestamp_timeout de Debian)
+SUDO_LEGACY_WAIT = 0.5           # espera fija del método anterior (para medir el ahorro)
+
 USE_SSH_KEY = False
 SSH_KEY_PATH = r"C:\Users\opi\.ssh\id_ed25519"
 
+# Conexiones SSH reutilizables
+SSH_KEEPALIVE_INTERVAL = 30      # segundos (0 = sin keepalive)
+
+# Inventario de hosts para ejecutar en varias Raspberry a la vez ("@grupo petición")
+HOST_INVENTORY_PATH = os.path.join(os.path.expanduser("~"), ".rpi_agent", "hosts.json")
+FANOUT_MAX_WORKERS = 8
+
+# Descubrimiento de contenedores y servicios en segundo plano durante la sesión
+INVENTORY_DISCOVERY_INTERVAL = 60    # segundos entre refrescos del inventario
+INVENTORY_DISCOVERY_WAIT = 1.0       # espera máxima por el primer descubrimiento
+INVENTORY_PROMPT_MAX_SERVICES = 25   # servicios listados en el contexto del modelo
+
+# Mostrar stdout/stderr en vivo mientras el comando se ejecuta (Ctrl+C lo cancela)
+STREAM_OUTPUT = True
+
+# Pedir docker ps, systemctl status, ss y df en formato para máquinas y guardarlos en el inventario
+STRUCTURED_OUTPUT_ENABLED = True
+
+# Captura acotada de salidas grandes (docker logs, journalctl...)
+CAPTURE_HEAD_LINES = 200
+CAPTURE_TAIL_LINES = 500
+CAPTURE_MAX_KEYWORD_LINES = 300
+CAPTURE_SPILL_TO_FILE = False    # guardar además la salida completa en un fichero temporal
+
+# Filtrado en la Pi de salidas grandes antes de transferirlas (docker logs por Wi-Fi)
+REMOTE_FILTER_ENABLED = True
+REMOTE_FILTER_MIN_BYTES = 256 * 1024          # tamaño estimado a partir del cual se filtra en remoto
+REMOTE_COMPRESS_MIN_BYTES = 1024 * 1024       # ... y a partir del cual además se comprime (gzip + base64)
+REMOTE_FILTER_LOG_ESTIMATE = 2 * 1024 * 1024  # estimación para logs sin límite (--tail, -n, --since)
+
+# Las palabras clave de líneas relevantes (IMPORTANT_KEYWORDS) y la compresión
+# de salidas para el modelo están en agent_common.py, compartidas con agent-ui
+
+# Presupuesto de tokens para la salida que se envía al modelo (num_ctx es 4096)
+ANALYSIS_CONTEXT_TOKENS = 1500   # stdout + stderr en el análisis
+FOLLOWUP_OUTPUT_TOKENS = 400     # salida anterior en preguntas de seguimiento
+FOLLOWUP_ANALYSIS_TOKENS = 250   # análisis anterior en preguntas de seguimiento
+
+# Caché persistente de comandos generados
+COMMAND_CACHE_ENABLED = True
+COMMAND_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".rpi_agent", "command_cache.sqlite3")
+COMMAND_CACHE_TTL = 24 * 3600        # segundos
+COMMAND_CACHE_MAX_ENTRIES = 500
+
+# Caché semántica: reutiliza comandos aprobados para peticiones parecidas (requiere numpy)
+SEMANTIC_CACHE_ENABLED = True
+SEMANTIC_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".rpi_agent", "semantic_cache")
+SEMANTIC_CACHE_THRESHOLD = 0.92      # similitud coseno mínima para reutilizar
+SEMANTIC_CACHE_MAX_ENTRIES = 1000
+OLLAMA_EMBED_MODEL = "nomic-embed-text"
+
+# Incrementar al cambiar get_system_prompt() para invalidar la caché
+SYSTEM_PROMPT_VERSION = "6"
+
+# Ruta rápida: reglas locales para peticiones frecuentes (sin llamar al LLM)
+INTENT_ROUTER_ENABLED = True
+
+# Memoria de conversación: últimos turnos literales y resumen (con el LLM) de los anteriores
+MEMORY_RECENT_TURNS = 3              # turnos que se conservan literalmente
+MEMORY_COMMAND_TOKENS = 500          # memoria en el prompt de generación de comandos
+MEMORY_FOLLOWUP_TOKENS = 1200        # memoria en las preguntas de seguimiento
+MEMORY_SUMMARY_TOKENS = 250          # longitud máxima del resumen
+MEMORY_SUMMARY_INPUT_TOKENS = 400    # de cada turno que se resume (salida + análisis)
+MEMORY_SUMMARIZE_IN_BACKGROUND = True
+
 # Memoria de contexto
 conversation_context = {
-    "last_command": "",
-    "last_output": "",
-    "last_analysis": "",
     "follow_up_count": 0,
     "discovered_containers": [],
     "discovered_services": [],
@@ -58,11 +183,14 @@ conversation_context = {
 # ANIMACIONES Y EFECTOS VISUALES
 # ==========================
 
+SPINNER_CHARS = ["⣾", "⣽", "⣻", "⢿", "⡿", "⣟", "⣯", "⣷"]
+
+
 class Spinner:
     """Animación de spinner para operaciones en progreso"""
     def __init__(self, message="Cargando"):
         self.message = message
-        self.spinner_chars = ["⣾", "⣽", "⣻", "⢿", "⡿", "⣟", "⣯", "⣷"]
+        self.spinner_chars = SPINNER_CHARS
         self.done = False
         self.thread = None
 
@@ -102,28 +230,36 @@ def print_loading(message, func, *args, **kwargs):
         raise e
 
 
+# Reglas de resaltado: el orden define la prioridad cuando dos patrones coinciden
+HIGHLIGHT_RULES = [
+    (r'\b(?:error|fail|failed|failure|crash)\b', RED),
+    (r'\b(?:warn|warning|attention|careful)\b', YELLOW),
+    (r'\b(?:success|ok|correct|healthy|running)\b', GREEN),
+    (r'\b(?:important|critical|urgent|priority)\b', MAGENTA),
+    (r'\b(?:recommend|suggest|advise|should)\b', CYAN),
+    (r'\b(?:\d{4}-\d{2}-\d{2}|\d{2}:\d{2}:\d{2})\b', BLUE),
+    # IPs, números e identificadores hex/MAC/IPv6 (con al menos un dígito)
+    (r'\b(?:\d+\.\d+\.\d+\.\d+|[a-f0-9:]*\d[a-f0-9:]*)\b', BLUE),
+]
+
+# Una sola expresión: las secuencias ANSI existentes se reconocen primero y se copian intactas
+HIGHLIGHT_RE = re.compile(
+    "|".join([r"(?P<ansi>\x1b\[[0-9;]*[A-Za-z])"]
+             + [f"(?P<rule{i}>{pattern})" for i, (pattern, _) in enumerate(HIGHLIGHT_RULES)]),
+    re.IGNORECASE,
+)
+
+
 def highlight_important_text(text: str) -> str:
-    """Resalta texto importante en el análisis con colores"""
-    highlight_patterns = {
-        r'\b(error|fail|failed|failure|crash)\b': RED,
-        r'\b(warn|warning|attention|careful)\b': YELLOW,
-        r'\b(success|ok|correct|healthy|running)\b': GREEN,
-        r'\b(important|critical|urgent|priority)\b': MAGENTA,
-        r'\b(recommend|suggest|advise|should)\b': CYAN,
-        r'\b(\d+\.\d+\.\d+\.\d+|[a-f0-9:]+)\b': BLUE,
-        r'\b(\d{4}-\d{2}-\d{2}|\d{2}:\d{2}:\d{2})\b': BLUE,
-    }
-    
-    highlighted = text
-    for pattern, color in highlight_patterns.items():
-        highlighted = re.sub(
-            pattern, 
-            lambda m: f"{color}{m.group(0)}{RESET}", 
-            highlighted, 
-            flags=re.IGNORECASE
-        )
-    
-    return highlighted
+    """Resalta texto importante en el análisis con colores (una sola pasada)"""
+    def colorize(match: re.Match) -> str:
+        group = match.lastgroup
+        if group == "ansi":
+            return match.group(0)
+        color = HIGHLIGHT_RULES[int(group[4:])][1]
+        return f"{color}{match.group(0)}{RESET}"
+
+    return HIGHLIGHT_RE.sub(colorize, text)
 
 
 def print_banner():
@@ -167,14 +303,31 @@ def print_result_header():
     print(f"{BLUE}│{RESET}")
 
 
-def print_footer(exit_code: int, execution_time: float):
-    """Footer mejorado"""
+def format_bytes(size: float) -> str:
+    """Tamaño legible (B, KB, MB, GB)"""
+    if size < 1024:
+        return f"{size:.0f} B"
+    for unit in ("KB", "MB"):
+        size /= 1024
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+    return f"{size / 1024:.1f} GB"
+
+
+def print_footer(exit_code: int, execution_time: float, wire_bytes: int | None = None,
+                 remote_bytes: int | None = None):
+    """Footer mejorado (con `wire_bytes` muestra lo transferido por la red)"""
     status_emoji = "✅" if exit_code == 0 else "❌"
     status = f"{GREEN}ÉXITO{status_emoji}" if exit_code == 0 else f"{RED}FALLÓ{status_emoji}"
     tiempo = f"{execution_time:.2f}s"
+    red = ""
+    if wire_bytes is not None:
+        red = f" | Red: {format_bytes(wire_bytes)}"
+        if remote_bytes is not None:
+            red += f" de {format_bytes(remote_bytes)} (filtrado en remoto)"
     
     print(f"{BLUE}│{RESET}")
-    print(f"{BLUE}└{WHITE} {status} {WHITE}| Código: {exit_code} | Tiempo: {tiempo} {' ' * 20}{RESET}")
+    print(f"{BLUE}└{WHITE} {status} {WHITE}| Código: {exit_code} | Tiempo: {tiempo}{red} {' ' * 20}{RESET}")
 
 
 def print_kv(label: str, value: str, color=WHITE, indent=0):
@@ -203,109 +356,202 @@ def print_success(message: str):
     print(f"{BLUE}│{RESET} {GREEN}✅ {message}{RESET}")
 
 
-def format_output_with_sections(content: str, title: str = "SALIDA") -> List[str]:
-    """Formatea la salida con mejoras visuales"""
-    lines = content.strip().split('\n')
-    formatted_lines = []
-    
+def format_output_lines(lines: Iterable[str], is_service_status: bool = False) -> Iterator[str]:
+    """Formatea perezosamente las líneas de salida con mejoras visuales.
+
+    `is_service_status` se calcula una sola vez por salida (antes se buscaba
+    'systemctl status' en todo el texto por cada línea).
+    """
     current_section = None
-    in_yaml_block = False
     yaml_lines = []
     
     for line in lines:
-        if line.strip().endswith('.yml:') or line.strip() in ['cloudflare-tunnel.yml', 'production-tunnel.yml']:
+        stripped = line.strip()
+        if stripped.endswith('.yml:') or stripped in ('cloudflare-tunnel.yml', 'production-tunnel.yml'):
             if yaml_lines and current_section:
-                formatted_lines.extend(yaml_lines)
+                yield from yaml_lines
                 yaml_lines = []
-            current_section = line.strip()
-            formatted_lines.append(f"{BLUE}│{RESET}")
-            formatted_lines.append(f"{BLUE}│{WHITE} 📄 {current_section}{RESET}")
+            current_section = stripped
+            yield f"{BLUE}│{RESET}"
+            yield f"{BLUE}│{WHITE} 📄 {current_section}{RESET}"
             continue
             
-        if 'systemctl status' in content and any(x in line for x in ['●', 'Loaded:', 'Active:', 'Main PID:']):
+        if is_service_status and any(x in line for x in ('●', 'Loaded:', 'Active:', 'Main PID:')):
             if yaml_lines:
-                formatted_lines.extend(yaml_lines)
+                yield from yaml_lines
                 yaml_lines = []
             if '●' in line and current_section != 'ESTADO DEL SERVICIO':
                 current_section = 'ESTADO DEL SERVICIO'
-                formatted_lines.append(f"{BLUE}│{RESET}")
-                formatted_lines.append(f"{BLUE}│{WHITE} ⚙️  {current_section}{RESET}")
-            formatted_lines.append(f"{BLUE}│{RESET}   {line}")
+                yield f"{BLUE}│{RESET}"
+                yield f"{BLUE}│{WHITE} ⚙️  {current_section}{RESET}"
+            yield f"{BLUE}│{RESET}   {line}"
             continue
             
-        if line.strip() and (':' in line or line.strip().startswith('- ') or line.strip().startswith('  ')):
+        if stripped and (':' in line or stripped.startswith('- ')):
             yaml_lines.append(f"{BLUE}│{RESET}   {line}")
         else:
             if yaml_lines:
-                formatted_lines.extend(yaml_lines)
+                yield from yaml_lines
                 yaml_lines = []
-            if line.strip():
-                formatted_lines.append(f"{BLUE}│{RESET}   {line}")
+            if stripped:
+                yield f"{BLUE}│{RESET}   {line}"
     
     if yaml_lines:
-        formatted_lines.extend(yaml_lines)
-    
-    return formatted_lines
+        yield from yaml_lines
+
+
+def format_output_with_sections(content: str, title: str = "SALIDA") -> List[str]:
+    """Formatea la salida con mejoras visuales"""
+    return list(format_output_lines(content.strip().split('\n'), 'systemctl status' in content))
+
+
+def find_important_lines(text: str) -> List[str]:
+    """Líneas con alguna de IMPORTANT_KEYWORDS, en orden.
+
+    Cada palabra clave se busca con str.find sobre el texto completo en
+    minúsculas y solo se visitan las líneas donde aparece: en un log de cien mil
+    líneas sin coincidencias no se recorre ninguna línea en Python.
+    """
+    lowered = text.lower()
+    if len(lowered) != len(text):
+        # Algún carácter cambia de longitud al pasar a minúsculas (İ): línea a línea
+        return [line for line in text.split('\n')
+                if any(keyword in line.lower() for keyword in IMPORTANT_KEYWORDS)]
+
+    spans = {}
+    for keyword in IMPORTANT_KEYWORDS:
+        position = lowered.find(keyword)
+        while position != -1:
+            start = lowered.rfind('\n', 0, position) + 1
+            end = lowered.find('\n', position)
+            end = len(lowered) if end == -1 else end
+            spans[start] = end
+            position = lowered.find(keyword, end)
+    return [text[start:spans[start]] for start in sorted(spans)]
+
+
+def select_output_lines(text: str, max_lines: int) -> List[str]:
+    """Elige las líneas a mostrar: las relevantes o cabecera y cola si no hay.
+
+    Solo se parte en líneas lo que se va a mostrar.
+    """
+    total = text.count('\n') + 1
+    if total <= max_lines:
+        return text.split('\n')
+
+    important_lines = find_important_lines(text)
+    important_count = len(important_lines)
+    del important_lines[max_lines:]
+
+    if important_lines:
+        if important_count > max_lines:
+            important_lines.append(f"{CYAN}... [{important_count - max_lines} líneas adicionales omitidas] ...{RESET}")
+        return important_lines
+
+    half = max_lines // 2
+    head = text.split('\n', half)[:half]
+    tail = text.rsplit('\n', half)[-half:] if half else []
+    return head + [f"{CYAN}... [{total - max_lines} líneas omitidas] ...{RESET}"] + tail
 
 
 def print_output_block(content: str, title: str = "SALIDA", max_lines: int = 50):
-    """Bloque de output con mejoras visuales"""
+    """Bloque de output con mejoras visuales (solo se formatean las líneas mostradas)"""
     if not content.strip():
         return
     
-    lines = content.strip().split('\n')
-    
-    if len(lines) > max_lines:
-        important_lines = []
-        for line in lines:
-            if any(keyword in line.lower() for keyword in [
-                'error', 'warn', 'fail', 'active:', 'loaded:', 'main pid', 
-                'tunnel:', 'ingress:', 'hostname:', 'service:'
-            ]):
-                important_lines.append(line)
-        
-        if important_lines:
-            lines = important_lines[:max_lines]
-            if len(important_lines) > max_lines:
-                lines.append(f"{CYAN}... [{len(important_lines) - max_lines} líneas adicionales omitidas] ...{RESET}")
-        else:
-            lines = lines[:max_lines//2] + [f"{CYAN}... [{len(lines) - max_lines} líneas omitidas] ...{RESET}"] + lines[-(max_lines//2):]
+    content = content.strip()
+    is_service_status = 'systemctl status' in content
+    lines = select_output_lines(content, max_lines)
     
     print(f"{BLUE}│{RESET}")
     print(f"{BLUE}│{WHITE} 📋 {title}:{RESET}")
     
-    formatted_lines = format_output_with_sections(content)
-    for line in formatted_lines[:max_lines + 10]:
+    for line in itertools.islice(format_output_lines(lines, is_service_status), max_lines + 10):
         print(line)
 
 
-def print_analysis_block(content: str, title: str = "ANÁLISIS"):
-    """Bloque de análisis con texto resaltado"""
-    if not content.strip():
+def print_analysis_line(line: str):
+    """Imprime una línea de análisis resaltada según su formato markdown"""
+    stripped = line.strip()
+    if not stripped:
         return
-    
-    highlighted_content = highlight_important_text(content)
-    lines = highlighted_content.strip().split('\n')
-    
+    # El formato se decide sobre el texto original; el resaltado se aplica al final
+    if stripped.startswith('**') and stripped.endswith('**'):
+        clean_line = highlight_important_text(stripped.strip('* ').strip())
+        print(f"{BLUE}│{RESET}   {CYAN}🔹 {clean_line}{RESET}")
+    elif stripped.startswith('- **'):
+        clean_line = highlight_important_text(stripped.strip('-* ').strip())
+        print(f"{BLUE}│{RESET}     {GREEN}• {clean_line}{RESET}")
+    elif stripped.startswith('-'):
+        clean_line = highlight_important_text(stripped.strip('- ').strip())
+        print(f"{BLUE}│{RESET}     {WHITE}• {clean_line}{RESET}")
+    elif re.match(r'^\d+\.', stripped):
+        print(f"{BLUE}│{RESET}     {WHITE}{highlight_important_text(stripped)}{RESET}")
+    else:
+        print(f"{BLUE}│{RESET}   {highlight_important_text(line)}")
+
+
+def print_analysis_header(title: str = "ANÁLISIS"):
     print(f"{BLUE}│{RESET}")
     print(f"{BLUE}│{MAGENTA} 🧠 {title}:{RESET}")
     print(f"{BLUE}│{RESET}")
-    
-    for line in lines:
-        if line.strip():
-            if line.strip().startswith('**') and line.strip().endswith('**'):
-                clean_line = line.strip('* ').strip()
-                print(f"{BLUE}│{RESET}   {CYAN}🔹 {clean_line}{RESET}")
-            elif line.strip().startswith('- **'):
-                clean_line = line.strip('-* ').strip()
-                print(f"{BLUE}│{RESET}     {GREEN}• {clean_line}{RESET}")
-            elif line.strip().startswith('-'):
-                clean_line = line.strip('- ').strip()
-                print(f"{BLUE}│{RESET}     {WHITE}• {clean_line}{RESET}")
-            elif re.match(r'^\d+\.', line.strip()):
-                print(f"{BLUE}│{RESET}     {WHITE}{line.strip()}{RESET}")
-            else:
-                print(f"{BLUE}│{RESET}   {line}")
+
+
+def print_analysis_block(content: str, title: str = "ANÁLISIS"):
+    """Bloque de análisis con texto resaltado"""
+    if not content.strip():
+        return
+
+    print_analysis_header(title)
+    for line in content.strip().split('\n'):
+        print_analysis_line(line)
+
+
+class StreamingAnalysisPrinter:
+    """Renderiza el análisis línea a línea a medida que llegan los tokens de Ollama"""
+    def __init__(self, section_title: str, section_emoji: str = "🧠",
+                 title: str = "ANÁLISIS", spinner_message: str = "Analizando..."):
+        self.section_title = section_title
+        self.section_emoji = section_emoji
+        self.title = title
+        self.spinner = Spinner(spinner_message)
+        self.start_time = None
+        self.ttft = None
+        self._received = []
+        self._pending = ""
+
+    def start(self):
+        self.start_time = time.time()
+        self.spinner.start()
+
+    def feed(self, piece: str):
+        if self.ttft is None:
+            self.ttft = time.time() - self.start_time
+            self.spinner.stop(f"Primer token en {self.ttft:.2f}s")
+            print_section(self.section_title, self.section_emoji)
+            print_analysis_header(self.title)
+
+        self._received.append(piece)
+        self._pending += piece
+        *complete, self._pending = self._pending.split('\n')
+        for line in complete:
+            print_analysis_line(line)
+
+    def finish(self, full_text: str = ""):
+        """Vacía la última línea; si no llegó ningún token imprime el texto completo"""
+        if self.ttft is None:
+            self.spinner.stop("Listo!")
+            print_section(self.section_title, self.section_emoji)
+            print_analysis_block(full_text, self.title)
+            return
+        if self._pending:
+            print_analysis_line(self._pending)
+            self._pending = ""
+        if full_text.strip() != "".join(self._received).strip():
+            # La generación se interrumpió a mitad: mostrar el error devuelto
+            print_warning(full_text)
+        total = time.time() - self.start_time
+        print_info(f"Primer token: {self.ttft:.2f}s | Total: {total:.2f}s", "⏱️ ")
 
 
 def user_prompt() -> str:
@@ -325,75 +571,805 @@ def yes_no_prompt(msg: str, default_no: bool = True) -> bool:
 
 
 # ==========================
-# FUNCIONES DE EXTRACCIÓN DE INFORMACIÓN
+# SALIDAS ESTRUCTURADAS: REGISTROS Y PARSERS
+# ==========================
+
+def classify_container(name: str, image: str, ports: str = "") -> str:
+    """Tipo de contenedor (postgres, frontend, nginx...) según nombre, imagen y puertos"""
+    name, image = name.lower(), image.lower()
+    if 'postgres' in name or 'postgres' in image:
+        return "postgres"
+    if 'frontend' in name or '3000' in ports:
+        return "frontend"
+    if 'backend' in name:
+        return "backend"
+    if 'nginx' in name or 'nginx' in image:
+        return "nginx"
+    if 'redis' in name or 'redis' in image:
+        return "redis"
+    if 'gateway' in name:
+        return "gateway"
+    if 'cloudflare' in name:
+        return "cloudflared"
+    return "unknown"
+
+
+class Record:
+    """Registro tipado de una salida estructurada.
+
+    Las subclases declaran sus campos en __slots__ (sin __dict__ por instancia)
+    y el primero es la clave. Los campos de `volatile` cambian solos con el
+    tiempo (uptime, PID) y no cuentan al comparar: así un refresco del
+    inventario no marca cambios que no lo son.
+    """
+    __slots__ = ()
+    volatile: tuple = ()
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name, ""))
+
+    @property
+    def key(self) -> str:
+        return getattr(self, self.__slots__[0])
+
+    def stable_values(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__ if name not in self.volatile)
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self.stable_values() == other.stable_values()
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+    def summary(self) -> str:
+        """Una línea para el contexto del modelo"""
+        return self.key
+
+
+class ContainerRecord(Record):
+    __slots__ = ("name", "image", "state", "status", "ports", "type")
+    volatile = ("status",)
+
+    def summary(self) -> str:
+        details = [self.image, self.state] + ([self.ports] if self.ports else [])
+        prefix = f"{self.type}: " if self.type != "unknown" else ""
+        return f"{prefix}{self.name} ({', '.join(details)})"
+
+
+class ServiceRecord(Record):
+    __slots__ = ("name", "active", "sub", "description", "load", "main_pid", "since", "result")
+    volatile = ("load", "main_pid", "since", "result")
+
+    def summary(self) -> str:
+        return self.name if self.active == "active" else f"{self.name} ({self.active})"
+
+
+class SocketRecord(Record):
+    __slots__ = ("local", "netid", "state", "peer", "process")
+
+    @property
+    def key(self) -> str:
+        # La misma dirección puede estar en tcp y en udp (p. ej. el puerto 53)
+        return f"{self.netid}:{self.local}" if self.netid else self.local
+
+    @property
+    def port(self) -> str:
+        return self.local.rsplit(":", 1)[-1]
+
+    def summary(self) -> str:
+        process = PROCESS_NAME_RE.search(self.process)
+        return f"{self.netid or 'tcp'} {self.local}" + (f" ({process.group(1)})" if process else "")
+
+
+class FilesystemRecord(Record):
+    __slots__ = ("target", "source", "fstype", "size", "used", "avail", "pcent")
+
+    def summary(self) -> str:
+        return f"{self.target}: {self.pcent} usado de {self.size} ({self.avail} libres, {self.source})"
+
+
+# Nombre del proceso en la columna de `ss -p`: users:(("nginx",pid=123,fd=6))
+PROCESS_NAME_RE = re.compile(r'\(\("([^"]+)"')
+# Puertos publicados por docker: 0.0.0.0:3000->80/tcp, :::3000->80/tcp
+CONTAINER_PORT_RE = re.compile(r":(\d+)->|(\d+)/(?:tcp|udp)")
+# Operadores del shell: solo se reescriben comandos simples
+SHELL_OPERATORS_RE = re.compile(r"[|;&<>`$()\n]")
+
+
+def render_table(headers: List[str], rows: List[List[str]]) -> str:
+    """Tabla de texto alineada (la última columna sin relleno)"""
+    widths = [max(len(str(row[i])) for row in [headers] + rows) for i in range(len(headers) - 1)]
+    lines = []
+    for row in [headers] + rows:
+        cells = [str(cell).ljust(width) for cell, width in zip(row, widths)] + [str(row[-1])]
+        lines.append("  ".join(cells).rstrip())
+    return "\n".join(lines)
+
+
+class OutputParser(abc.ABC):
+    """Reescribe un comando conocido a un formato para máquinas y analiza su salida.
+
+    `rewrite` recibe los argumentos que siguen al comando y devuelve el comando
+    reescrito (None si alguna opción lo impide); `parse` devuelve los registros
+    y las líneas que no forman parte de ellos; `render` vuelve a una tabla
+    legible para el usuario y para el análisis. Un analizador incompleto falla
+    al instanciarse en OUTPUT_PARSERS, no con el comando de un usuario.
+    """
+    section = ""    # apartado del inventario que actualizan sus registros
+
+    @abc.abstractmethod
+    def rewrite(self, args: List[str]) -> str | None:
+        ...
+
+    @abc.abstractmethod
+    def parse(self, text: str) -> tuple[List[Record], List[str]]:
+        ...
+
+    @abc.abstractmethod
+    def render(self, records: List[Record]) -> str:
+        ...
+
+    def is_complete(self, args: List[str]) -> bool:
+        """Si la salida lista todo el apartado (sin filtros) y puede sustituirlo"""
+        return False
+
+
+class DockerPsParser(OutputParser):
+    section = "containers"
+
+    def rewrite(self, args: List[str]) -> str | None:
+        # Un --format del usuario se respeta tal cual
+        if {"-q", "--quiet", "--format"} & set(args) or any(arg.startswith("--format=") for arg in args):
+            return None
+        return shlex.join(["docker", "ps", *args, "--format", "{{json .}}"])
+
+    def parse(self, text: str) -> tuple[List[Record], List[str]]:
+        lines = text.splitlines()
+        extra = [line for line in lines if line.strip() and not line.lstrip().startswith('{')]
+        return list(parse_docker_ps_json(lines).values()), extra
+
+    def render(self, records: List[Record]) -> str:
+        return render_table(["NAMES", "IMAGE", "STATUS", "PORTS"],
+                            [[r.name, r.image, r.status or r.state, r.ports] for r in records])
+
+    def is_complete(self, args: List[str]) -> bool:
+        return (("-a" in args or "--all" in args)
+                and not any(arg.split("=")[0] in ("-f", "--filter", "-n", "--last", "-l", "--latest")
+                            for arg in args))
+
+
+class SystemctlStatusParser(OutputParser):
+    """`systemctl status UNIDAD...` como `systemctl show -p` más las últimas líneas del journal.
+
+    Termina con `systemctl is-active` para conservar el código de salida de
+    `systemctl status`: distinto de 0 si alguna unidad no está activa.
+    """
+    section = "services"
+    separator = "--- rpi-agent: journal ---"
+    properties = ("Id", "Description", "LoadState", "ActiveState", "SubState",
+                  "MainPID", "ActiveEnterTimestamp", "Result")
+
+    def rewrite(self, args: List[str]) -> str | None:
+        units, lines = [], "10"
+        options = iter(args)
+        for arg in options:
+            if arg in ("-n", "--lines"):
+                lines = next(options, lines)
+            elif arg.startswith("--lines="):
+                lines = arg.split("=", 1)[1]
+            elif not arg.startswith("-"):
+                units.append(arg)
+        if not units or not lines.isdigit():
+            return None  # sin unidad es el estado general del sistema
+        journal_units = " ".join(f"-u {shlex.quote(unit)}" for unit in units)
+        return (f"systemctl show -p {','.join(self.properties)} -- {shlex.join(units)}; "
+                f"echo '{self.separator}'; journalctl {journal_units} -n {lines} --no-pager; "
+                f"systemctl is-active --quiet -- {shlex.join(units)}")
+
+    def parse(self, text: str) -> tuple[List[Record], List[str]]:
+        show, _, journal = text.partition(self.separator)
+        records = []
+        for block in re.split(r"\n\s*\n", show.strip()):
+            props = dict(line.split("=", 1) for line in block.splitlines() if "=" in line)
+            if not props.get("Id"):
+                continue
+            records.append(ServiceRecord(
+                name=props["Id"].removesuffix(".service"),
+                active=props.get("ActiveState", ""),
+                sub=props.get("SubState", ""),
+                description=props.get("Description", ""),
+                load=props.get("LoadState", ""),
+                main_pid=props.get("MainPID", ""),
+                since=props.get("ActiveEnterTimestamp", ""),
+                result=props.get("Result", ""),
+            ))
+        return records, [line for line in journal.splitlines() if line.strip()]
+
+    def render(self, records: List[Record]) -> str:
+        # Mismas etiquetas que `systemctl status` (IMPORTANT_KEYWORDS las destacan)
+        blocks = []
+        for r in records:
+            since = f" since {r.since}" if r.since and r.active == "active" else ""
+            lines = [f"● {r.name}.service - {r.description}",
+                     f"     Loaded: {r.load}",
+                     f"     Active: {r.active} ({r.sub}){since}"]
+            if r.main_pid not in ("", "0"):
+                lines.append(f"   Main PID: {r.main_pid}")
+            if r.result and r.result != "success":
+                lines.append(f"     Result: {r.result}")
+            blocks.append("\n".join(lines))
+        return "\n\n".join(blocks)
+
+
+class SsParser(OutputParser):
+    section = "sockets"
+    netids = {"tcp", "udp", "raw", "u_str", "u_dgr", "u_seq", "nl", "p_raw", "p_dgr", "sctp", "mptcp"}
+
+    def rewrite(self, args: List[str]) -> str | None:
+        if {"-H", "--no-header"} & set(args):
+            return shlex.join(["ss", *args])
+        return shlex.join(["ss", "-H", *args])
+
+    def parse(self, text: str) -> tuple[List[Record], List[str]]:
+        records, extra = [], []
+        for line in text.splitlines():
+            parts = line.split(None, 6)
+            netid = parts.pop(0) if parts and parts[0] in self.netids else ""
+            if len(parts) < 5 or not parts[1].isdigit():
+                if line.strip():
+                    extra.append(line)
+                continue
+            records.append(SocketRecord(netid=netid, state=parts[0], local=parts[3], peer=parts[4],
+                                        process=" ".join(parts[5:])))
+        return records, extra
+
+    def render(self, records: List[Record]) -> str:
+        return render_table(["NETID", "STATE", "LOCAL", "PEER", "PROCESS"],
+                            [[r.netid or "-", r.state, r.local, r.peer, r.process] for r in records])
+
+    def is_complete(self, args: List[str]) -> bool:
+        return all(arg.startswith("-") for arg in args)
+
+
+class DfParser(OutputParser):
+    section = "filesystems"
+    columns = "source,fstype,size,used,avail,pcent,target"
+
+    def rewrite(self, args: List[str]) -> str | None:
+        # --output no se puede combinar con -i, -P ni -T
+        if any(arg in ("-i", "--inodes", "-P", "--portability", "-T", "--print-type")
+               or arg.startswith("--output") for arg in args):
+            return None
+        return shlex.join(["df", f"--output={self.columns}", *args])
+
+    def parse(self, text: str) -> tuple[List[Record], List[str]]:
+        records, extra = [], []
+        for line in text.splitlines()[1:]:  # la primera es la cabecera (traducida según el locale)
+            parts = line.split(None, 6)
+            if len(parts) < 7 or not parts[5].endswith("%"):
+                if line.strip():
+                    extra.append(line)
+                continue
+            records.append(FilesystemRecord(**dict(zip(self.columns.split(","), parts))))
+        return records, extra
+
+    def render(self, records: List[Record]) -> str:
+        return render_table(["FILESYSTEM", "TYPE", "SIZE", "USED", "AVAIL", "USE%", "MOUNTED ON"],
+                            [[r.source, r.fstype, r.size, r.used, r.avail, r.pcent, r.target] for r in records])
+
+    def is_complete(self, args: List[str]) -> bool:
+        return all(arg.startswith("-") for arg in args)
+
+
+# Registro de parsers por comando (primeras palabras, sin sudo)
+OUTPUT_PARSERS: Dict[str, OutputParser] = {
+    "docker ps": DockerPsParser(),
+    "docker container ls": DockerPsParser(),
+    "systemctl status": SystemctlStatusParser(),
+    "ss": SsParser(),
+    "df": DfParser(),
+}
+
+
+def find_output_parser(command: str) -> tuple[OutputParser, List[str], str] | None:
+    """(parser, argumentos, comando reescrito) si el comando tiene un formato estructurado"""
+    if SHELL_OPERATORS_RE.search(command):
+        return None
+    try:
+        words = shlex.split(command)
+    except ValueError:
+        return None
+    prefix = []
+    if words[:1] == ["sudo"]:
+        prefix, words = ["sudo"], words[1:]
+    for size in (3, 2, 1):
+        parser = OUTPUT_PARSERS.get(" ".join(words[:size]))
+        if parser and len(words) >= size:
+            args = words[size:]
+            rewritten = parser.rewrite(args)
+            if rewritten is None:
+                return None
+            # El sudo del usuario vale para cada comando de la reescritura (salvo los separadores)
+            parts = split_command_list(rewritten)
+            return parser, args, "; ".join(part if part.startswith("echo ") else " ".join(prefix + [part])
+                                           for part in parts)
+    return None
+
+
+def apply_structured_output(parser: OutputParser, args: List[str], text: str) -> tuple[str | None, int]:
+    """Analiza la salida, actualiza el inventario y devuelve (texto legible, registros).
+
+    El texto es None si no salió ningún registro (error del comando): entonces
+    se muestra la salida tal cual.
+    """
+    records, extra = parser.parse(text)
+    if not records:
+        return None, 0
+    INVENTORY.update({parser.section: {record.key: record for record in records}},
+                     complete=parser.is_complete(args))
+    if parser.section == "containers":
+        conversation_context["extracted_info"]["containers"] = INVENTORY.container_map()
+    return "\n".join([parser.render(records)] + ([""] + extra if extra else [])), len(records)
+
+
+# ==========================
+# INVENTARIO DE CONTENEDORES Y SERVICIOS
 # ==========================
 
-def extract_container_info(output: str) -> Dict[str, str]:
-    """Extrae información de contenedores de la salida de docker ps"""
+# Una sola ejecución remota: contenedores y servicios en JSON, separados por un marcador
+INVENTORY_SEPARATOR = "--- rpi-agent: servicios ---"
+INVENTORY_DISCOVERY_COMMAND = (
+    "docker ps -a --format '{{json .}}'; "
+    f"echo '{INVENTORY_SEPARATOR}'; "
+    "systemctl list-units --type=service --output=json --plain --no-legend --no-pager"
+)
+
+# Servicios del sistema que no aportan al modelo (salvo que fallen)
+INVENTORY_SERVICE_NOISE_RE = re.compile(
+    r"^(?:systemd-|user@|user-runtime-dir@|getty@|serial-getty@|plymouth|keyboard-setup|"
+    r"kmod|console-setup|ifupdown|rc-local)"
+)
+# Sistemas de ficheros virtuales que no se listan en el contexto
+INVENTORY_VIRTUAL_FS = {"tmpfs", "devtmpfs", "overlay", "squashfs", "udev", "efivarfs"}
+# Docker incluye el código de salida en el estado: "Exited (1) 3 minutes ago"
+DOCKER_EXIT_CODE_RE = re.compile(r"^Exited \((-?\d+)\)")
+
+
+def parse_docker_ps_json(lines: Iterable[str]) -> Dict[str, ContainerRecord]:
+    """Contenedores de `docker ps --format '{{json .}}'` (una línea JSON por contenedor)"""
     containers = {}
-    lines = output.strip().split('\n')
-    
-    header_line = None
-    for i, line in enumerate(lines):
-        if 'CONTAINER ID' in line and 'IMAGE' in line and 'NAMES' in line:
-            header_line = line
-            data_start = i + 1
-            break
-    
-    if not header_line:
-        return containers
-    
-    for line in lines[data_start:]:
-        if not line.strip():
+    for line in lines:
+        line = line.strip()
+        if not line.startswith('{'):
+            continue  # avisos o errores mezclados en la salida (PTY)
+        try:
+            entry = json.loads(line)
+        except json.JSONDecodeError:
             continue
-            
-        parts = line.split()
-        if len(parts) >= 2:
-            container_name = parts[-1]
-            image_parts = []
-            for part in parts:
-                if '/' in part or ':' in part:
-                    image_parts.append(part)
-            
-            image_name = ' '.join(image_parts) if image_parts else parts[1]
-            
-            container_type = "unknown"
-            if 'postgres' in container_name.lower() or 'postgres' in image_name.lower():
-                container_type = "postgres"
-            elif 'frontend' in container_name.lower() or '3000' in line:
-                container_type = "frontend"
-            elif 'backend' in container_name.lower():
-                container_type = "backend"
-            elif 'nginx' in container_name.lower() or 'nginx' in image_name.lower():
-                container_type = "nginx"
-            elif 'redis' in container_name.lower() or 'redis' in image_name.lower():
-                container_type = "redis"
-            elif 'gateway' in container_name.lower():
-                container_type = "gateway"
-            elif 'cloudflare' in container_name.lower():
-                container_type = "cloudflared"
-            
-            containers[container_type] = container_name
-    
+        name = entry.get("Names", "").split(',')[0]
+        if not name:
+            continue
+        status = entry.get("Status", "")
+        # "State" solo existe en versiones recientes de docker
+        state = entry.get("State") or ("running" if status.startswith("Up") else "exited")
+        exit_code = DOCKER_EXIT_CODE_RE.match(status)
+        if exit_code:
+            state = f"{state} ({exit_code.group(1)})"
+        ports = entry.get("Ports", "")
+        containers[name] = ContainerRecord(
+            name=name,
+            image=entry.get("Image", ""),
+            state=state,
+            status=status,
+            ports=ports,
+            type=classify_container(name, entry.get("Image", ""), ports),
+        )
     return containers
 
 
-def update_context_with_extracted_info(output: str, command: str):
-    """Actualiza el contexto con información extraída"""
-    if 'docker ps' in command:
-        containers = extract_container_info(output)
-        conversation_context["extracted_info"]["containers"] = containers
-        print_info(f"Extraídos {len(containers)} contenedores del contexto")
+def parse_systemctl_units(lines: Iterable[str]) -> Dict[str, ServiceRecord]:
+    """Servicios de `systemctl list-units`: JSON (systemd reciente) o tabla --plain"""
+    lines = [line.strip() for line in lines if line.strip()]
+    try:
+        units = json.loads(''.join(lines))
+    except json.JSONDecodeError:
+        # systemd antiguo: ignora --output=json y muestra la tabla
+        units = []
+        for line in lines:
+            parts = line.lstrip('●* ').split(None, 4)
+            if len(parts) >= 4 and parts[0].endswith(".service"):
+                units.append({"unit": parts[0], "load": parts[1], "active": parts[2], "sub": parts[3],
+                              "description": parts[4] if len(parts) > 4 else ""})
+
+    services = {}
+    for unit in units if isinstance(units, list) else []:
+        name = unit.get("unit", "")
+        if not name.endswith(".service"):
+            continue
+        name = name[:-len(".service")]
+        services[name] = ServiceRecord(
+            name=name,
+            active=unit.get("active", ""),
+            sub=unit.get("sub", ""),
+            description=unit.get("description", ""),
+            load=unit.get("load", ""),
+        )
+    return services
+
+
+def parse_discovery_output(text: str) -> tuple[Dict | None, Dict | None]:
+    """Separa y analiza la salida de INVENTORY_DISCOVERY_COMMAND.
+
+    Devuelve None en la parte que no se pudo obtener (sin docker, sin systemd)
+    para no borrar del inventario lo que ya se conocía.
+    """
+    docker_part, separator, systemctl_part = text.partition(INVENTORY_SEPARATOR)
+    if not separator:
+        return None, None  # el comando no llegó a ejecutarse
+    docker_lines = docker_part.splitlines()
+    containers = parse_docker_ps_json(docker_lines)
+    if not containers and any(line.strip() and not line.startswith('{') for line in docker_lines):
+        containers = None  # docker falló (no instalado, sin permisos)
+    services = parse_systemctl_units(systemctl_part.splitlines())
+    return containers, services or None
+
+
+class InventoryCache:
+    """Inventario del host (contenedores, servicios, puertos y discos), actualizado por diferencias.
+
+    Cada refresco solo toca las entradas que cambian y `version` solo avanza si
+    hubo cambios: mientras el host no cambie, el contexto que se envía al modelo
+    es idéntico byte a byte. Los índices por tipo, puerto y nombre se rehacen
+    solo cuando cambia la versión.
+    """
+    SECTIONS = ("containers", "services", "sockets", "filesystems")
+
+    def __init__(self):
+        self.containers: Dict[str, ContainerRecord] = {}
+        self.services: Dict[str, ServiceRecord] = {}
+        self.sockets: Dict[str, SocketRecord] = {}
+        self.filesystems: Dict[str, FilesystemRecord] = {}
+        self.version = 0
+        self.refreshes = 0
+        self.updated_at = 0.0
+        self._lock = threading.Lock()
+        self._indexed_version = -1
+        self._by_type: Dict[str, List[str]] = {}
+        self._by_port: Dict[str, List[Record]] = {}
+        self._by_name: Dict[str, Record] = {}
+
+    def apply(self, containers: Dict | None, services: Dict | None) -> Dict[str, List[str]]:
+        """Aplica un descubrimiento; devuelve los nombres añadidos, eliminados y cambiados"""
+        changes = self.update({"containers": containers, "services": services}, complete=True)
+        with self._lock:
+            self.refreshes += 1
+        return changes
+
+    def update(self, sections: Dict[str, Dict[str, Record] | None],
+               complete: bool = True) -> Dict[str, List[str]]:
+        """Aplica registros por apartado; con `complete` se eliminan los que ya no aparecen"""
+        changes = {"added": [], "removed": [], "changed": []}
+        with self._lock:
+            for section, fresh in sections.items():
+                if fresh is None:
+                    continue
+                known = getattr(self, section)
+                for name in fresh.keys() - known.keys():
+                    changes["added"].append(name)
+                if complete:
+                    for name in known.keys() - fresh.keys():
+                        changes["removed"].append(name)
+                        del known[name]
+                for name, entry in fresh.items():
+                    if name in known and known[name] != entry:
+                        changes["changed"].append(name)
+                    known[name] = entry
+            if any(changes.values()):
+                self.version += 1
+            self.updated_at = time.time()
+        return changes
+
+    def _reindex(self):
+        """Rehace los índices si el inventario cambió (con el lock tomado)"""
+        if self._indexed_version == self.version:
+            return
+        by_type, by_port, by_name = {}, {}, {}
+        for name, record in sorted(self.containers.items()):
+            by_type.setdefault(record.type, []).append(name)
+            for host_port, container_port in CONTAINER_PORT_RE.findall(record.ports):
+                port_records = by_port.setdefault(host_port or container_port, [])
+                if record not in port_records:
+                    port_records.append(record)
+            by_name[name.lower()] = record
+        for name, record in sorted(self.services.items()):
+            by_name.setdefault(name.lower(), record)
+        for _, record in sorted(self.sockets.items()):
+            by_port.setdefault(record.port, []).append(record)
+        self._by_type, self._by_port, self._by_name = by_type, by_port, by_name
+        self._indexed_version = self.version
+
+    def container_map(self) -> Dict[str, str]:
+        """{tipo: nombre} para la ruta rápida; si el tipo se repite, cada contenedor por su nombre"""
+        result = {}
+        with self._lock:
+            self._reindex()
+            for container_type, names in sorted(self._by_type.items()):
+                for name in names:
+                    key = container_type if container_type != "unknown" and container_type not in result else name
+                    result[key] = name
+        return result
+
+    def lookup(self, text: str, limit: int = 10) -> List[Record]:
+        """Registros mencionados en el texto: por nombre, tipo de contenedor o puerto"""
+        found = []
+        with self._lock:
+            self._reindex()
+            for word in re.findall(r"[\w.@-]+", text.lower()):
+                if word in self._by_name:
+                    candidates = [self._by_name[word]]
+                elif word in self._by_type and word != "unknown":
+                    candidates = [self.containers[name] for name in self._by_type[word]]
+                else:
+                    candidates = self._by_port.get(word, [])
+                for record in candidates:
+                    if record not in found:
+                        found.append(record)
+        return found[:limit]
+
+    def prompt_section(self, max_services: int = INVENTORY_PROMPT_MAX_SERVICES) -> str:
+        """Bloque de contexto para el mensaje de usuario (orden estable)"""
+        with self._lock:
+            containers = sorted(self.containers.items())
+            failed = sorted(name for name, unit in self.services.items() if unit.active == "failed")
+            running = sorted(name for name, unit in self.services.items()
+                             if unit.active == "active" and not INVENTORY_SERVICE_NOISE_RE.match(name))
+            listening = [record for _, record in sorted(self.sockets.items())
+                         if record.state in ("LISTEN", "UNCONN")]
+            disks = [record for _, record in sorted(self.filesystems.items())
+                     if record.fstype not in INVENTORY_VIRTUAL_FS]
+
+        text = ""
+        if containers:
+            text += "\n\n**CONTENEDORES CONOCIDOS:**\n"
+            text += "".join(f"- {record.summary()}\n" for _, record in containers)
+        if failed or running:
+            shown = running[:max(0, max_services - len(failed))]
+            text += "\n**SERVICIOS SYSTEMD:**\n"
+            text += "".join(f"- {name} (failed)\n" for name in failed)
+            text += "".join(f"- {name}\n" for name in shown)
+            if len(running) > len(shown):
+                text += f"- ... y {len(running) - len(shown)} servicios activos más\n"
+        if listening:
+            text += "\n**PUERTOS EN ESCUCHA:**\n"
+            text += "".join(f"- {record.summary()}\n" for record in listening[:max_services])
+        if disks:
+            text += "\n**DISCOS:**\n"
+            text += "".join(f"- {record.summary()}\n" for record in disks[:max_services])
+        return text
+
+    def __bool__(self) -> bool:
+        return any(getattr(self, section) for section in self.SECTIONS)
+
+
+INVENTORY = InventoryCache()
+
+
+def discover_inventory(client: paramiko.SSHClient) -> Dict[str, List[str]] | None:
+    """Ejecuta el descubrimiento en el host y lo aplica al inventario y al contexto"""
+    out, _, exit_code, _ = run_remote_command(client, INVENTORY_DISCOVERY_COMMAND, quiet=True)
+    if exit_code == -1:
+        return None  # cancelado a medias: la salida no es el inventario completo
+    containers, services = parse_discovery_output(out.text())
+    if containers is None and services is None:
+        return None
+    changes = INVENTORY.apply(containers, services)
+    if containers is not None:
+        conversation_context["extracted_info"]["containers"] = INVENTORY.container_map()
+    return changes
+
+
+# ==========================
+# LECTURA EN VIVO DE CANALES SSH
+# ==========================
+
+class ChannelRegistry:
+    """Canales SSH que se están leyendo, para cancelar sus comandos desde otro hilo.
+
+    Cerrar el canal termina la lectura en iter_channel_output (el código de
+    salida queda en -1) y el servidor SSH cierra la sesión del comando remoto.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._channels = set()
+        self.cancelled = 0
+
+    def add(self, channel: paramiko.Channel):
+        with self._lock:
+            self._channels.add(channel)
+
+    def discard(self, channel: paramiko.Channel):
+        with self._lock:
+            self._channels.discard(channel)
+
+    def close_all(self, transport: paramiko.Transport | None = None) -> int:
+        """Cierra los canales abiertos (solo los de `transport` si se indica)"""
+        with self._lock:
+            channels = [channel for channel in self._channels
+                        if transport is None or channel.get_transport() is transport]
+            self._channels.difference_update(channels)
+            self.cancelled += 1
+        for channel in channels:
+            try:
+                channel.close()
+            except Exception:
+                pass
+        return len(channels)
+
+
+OPEN_CHANNELS = ChannelRegistry()
+
+
+def iter_channel_output(channel: paramiko.Channel, **kwargs) -> Iterator[tuple[str, str]]:
+    """agent_common.iter_channel_output con el canal registrado en OPEN_CHANNELS mientras se lee:
+    Ctrl+C en la sesión asíncrona lo cierra desde otro hilo"""
+    return agent_common.iter_channel_output(channel, registry=OPEN_CHANNELS, **kwargs)
+
+
+class OutputCapture:
+    """Captura de salida con memoria acotada.
+
+    Conserva las primeras `head_lines` líneas, un buffer circular con las
+    últimas `tail_lines`, las líneas intermedias que contienen palabras
+    clave relevantes y los contadores de bytes/líneas. Con `spill=True` la
+    salida completa se vuelca además a un fichero temporal.
+    """
+    def __init__(self, head_lines: int = CAPTURE_HEAD_LINES, tail_lines: int = CAPTURE_TAIL_LINES,
+                 max_keyword_lines: int = CAPTURE_MAX_KEYWORD_LINES, spill: bool = CAPTURE_SPILL_TO_FILE):
+        self.head_lines = head_lines
+        self.max_keyword_lines = max_keyword_lines
+        self.head: List[str] = []
+        self.tail = deque(maxlen=tail_lines)
+        self.keyword_lines: List[tuple[int, str]] = []
+        self.line_count = 0
+        self.byte_count = 0
+        self.wire_bytes = 0          # bytes recibidos por el canal
+        self.remote_bytes = None     # bytes generados en la Pi si se filtró en remoto
+        self.spill_path = None
+        self._spill_file = None
+        if spill:
+            self._spill_file = tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", prefix="rpi_agent_", suffix=".log", delete=False
+            )
+            self.spill_path = self._spill_file.name
+
+    def add(self, line: str):
+        self.line_count += 1
+        self.byte_count += len(line.encode("utf-8", errors="ignore")) + 1
+        if self._spill_file:
+            self._spill_file.write(line + '\n')
+
+        if len(self.head) < self.head_lines:
+            self.head.append(line)
+            return
+
+        if len(self.tail) == self.tail.maxlen:
+            # La línea más antigua sale del buffer: se conserva solo si es relevante
+            evicted_number = self.line_count - len(self.tail)
+            evicted = self.tail[0]
+            if (len(self.keyword_lines) < self.max_keyword_lines
+                    and any(keyword in evicted.lower() for keyword in IMPORTANT_KEYWORDS)):
+                self.keyword_lines.append((evicted_number, evicted))
+        self.tail.append(line)
+
+    def close(self):
+        if self._spill_file:
+            self._spill_file.close()
+            self._spill_file = None
+
+    @property
+    def omitted_lines(self) -> int:
+        return self.line_count - len(self.head) - len(self.tail) - len(self.keyword_lines)
+
+    def text(self) -> str:
+        """Texto acotado: cabecera, líneas relevantes omitidas y cola"""
+        if self.omitted_lines <= 0:
+            return '\n'.join(self.head + self.keyword_lines_text() + list(self.tail))
+
+        marker = f"... [{self.omitted_lines} líneas omitidas de {self.line_count}"
+        if self.keyword_lines:
+            marker += f", se conservan {len(self.keyword_lines)} líneas relevantes"
+        marker += "] ..."
+        return '\n'.join(self.head + [marker] + self.keyword_lines_text() + list(self.tail))
+
+    def keyword_lines_text(self) -> List[str]:
+        return [line for _, line in self.keyword_lines]
+
+    def __bool__(self) -> bool:
+        return self.line_count > 0
+
+
+def print_live_line(stream: str, line: str):
+    """Imprime una línea de salida remota en cuanto llega"""
+    color = RED if stream == "stderr" else RESET
+    print(f"{BLUE}│{RESET}   {color}{line}{RESET}")
+
+
+def collect_channel_output(channel: paramiko.Channel, live: bool = True,
+                           pty: bool = False) -> tuple[OutputCapture, OutputCapture, int]:
+    """Lee el canal hasta que termina el comando; Ctrl+C lo cancela"""
+    captures = {"stdout": OutputCapture(), "stderr": OutputCapture()}
+    on_line = print_live_line if live and STREAM_OUTPUT else None
+    wire = {}
+    try:
+        for stream, line in iter_channel_output(channel, pty=pty, counters=wire):
+            captures[stream].add(line)
+            if on_line:
+                on_line(stream, line)
+        exit_code = channel.recv_exit_status()
+    except KeyboardInterrupt:
+        channel.close()
+        print_warning("Comando cancelado por el usuario (Ctrl+C)")
+        exit_code = -1
+    finally:
+        for stream, capture in captures.items():
+            capture.wire_bytes = wire.get(stream, 0)
+            capture.close()
+    return captures["stdout"], captures["stderr"], exit_code
 
 
 # ==========================
 # MANEJO DE SUDO
 # ==========================
 
-def wrap_command_with_sudo(command: str) -> str:
-    """Envuelve el comando con sudo si es necesario"""
+# Prompt único por proceso (no puede confundirse con la salida del comando) y
+# numerado por invocación de sudo: repetir un número indica contraseña rechazada
+SUDO_PROMPT_PREFIX = f"{SUDO_PROMPT_MARKER} {secrets.token_hex(4)}"
+
+
+def sudo_prompt(step: int = 0) -> str:
+    return f"{SUDO_PROMPT_PREFIX} {step}: "
+
+
+# Código de salida con el que la prueba `sudo -n true` indica que hace falta contraseña
+SUDO_PROBE_EXIT_CODE = 213
+
+
+def split_command_list(command: str) -> List[str]:
+    """Separa una lista de comandos por `;` fuera de comillas y de escapes (`find -exec ... \\;`)"""
+    parts, current, quote = [], [], None
+    chars = iter(command)
+    for ch in chars:
+        if ch == "\\" and quote != "'":
+            current.append(ch + next(chars, ""))
+            continue
+        if quote:
+            quote = None if ch == quote else quote
+        elif ch in "'\"":
+            quote = ch
+        elif ch == ";":
+            parts.append("".join(current))
+            current = []
+            continue
+        current.append(ch)
+    parts.append("".join(current))
+    return [part.strip() for part in parts if part.strip()]
+
+
+def wrap_command_with_sudo(command: str, non_interactive: bool = False, step: int = 0) -> str:
+    """Envuelve el comando con sudo si es necesario.
+
+    Se fija el prompt con -p para detectarlo en el flujo; con `non_interactive`
+    se usa -n (falla en vez de preguntar si las credenciales ya no valen).
+    En una lista `a; b` se envuelve cada comando por separado.
+    """
     if not USE_SUDO:
         return command
+
+    segments = split_command_list(command)
+    if len(segments) > 1:
+        return "; ".join(wrap_command_with_sudo(segment, non_interactive, step) for segment in segments)
     
     sudo_commands = [
         'apt', 'dnf', 'yum', 'systemctl', 'service', 'journalctl',
@@ -402,74 +1378,850 @@ def wrap_command_with_sudo(command: str) -> str:
         'mount', 'umount', 'fdisk', 'lsblk', 'blkid'
     ]
     
-    first_word = command.split()[0] if command.split() else ""
+    parts = command.split(None, 1)
+    first_word = parts[0] if parts else ""
+    sudo = "sudo -n" if non_interactive else f"sudo -p {shlex.quote(sudo_prompt(step))}"
+
+    if first_word == "sudo" and len(parts) > 1:
+        # El comando ya trae sudo: solo se cambia la forma de pedir la contraseña
+        return f"{sudo} {parts[1]}"
+
     needs_sudo = any(first_word.startswith(cmd) for cmd in sudo_commands)
     
     if needs_sudo:
-        return f"sudo -S {command}"
+        return f"{sudo} {command}"
     else:
         return command
 
 
-def handle_sudo_password(client: paramiko.SSHClient, command: str) -> tuple[str, str, int, float]:
+class SudoPromptChannel:
+    """Canal con PTY que vigila los prompts de sudo en la salida.
+
+    Envía la contraseña una sola vez por prompt; si el mismo prompt vuelve a
+    aparecer es que sudo la rechazó y se cierra el canal en lugar de quedarse
+    esperando. Los prompts se eliminan de la salida aunque lleguen partidos
+    entre dos lecturas.
+    """
+    def __init__(self, channel: paramiko.Channel, password: str, prefix: str = SUDO_PROMPT_PREFIX):
+        self.channel = channel
+        self.password = password
+        self.prefix = prefix.encode("utf-8")
+        self.prompt_re = re.compile(re.escape(self.prefix) + rb" (\d+): ")
+        self.answered = set()
+        self.started_at = time.time()
+        self.prompts = 0
+        self.prompt_delay = None     # segundos hasta que sudo pidió la contraseña
+        self.rejected = False
+        self._held = b""
+        self._skip_newline = False
+
+    def __getattr__(self, name):
+        return getattr(self.channel, name)
+
+    def recv_ready(self) -> bool:
+        return self.channel.recv_ready() or (bool(self._held) and self.channel.eof_received)
+
+    def recv(self, size: int) -> bytes:
+        data = self._held + self.channel.recv(size)
+        self._held = b""
+        data = self.prompt_re.sub(self._on_prompt, data)
+        if self._skip_newline and data:
+            # Salto de línea que sudo escribe tras leer la contraseña (sin eco)
+            data = data[2:] if data.startswith(b"\r\n") else data.lstrip(b"\n")
+            self._skip_newline = not data
+        if not self.channel.eof_received:
+            # Prompt incompleto al final: se retiene hasta la siguiente lectura
+            start = data.rfind(self.prefix)
+            if start == -1:
+                start = next((len(data) - size for size in range(min(len(self.prefix) - 1, len(data)), 0, -1)
+                              if self.prefix.startswith(data[-size:])), len(data))
+            data, self._held = data[:start], data[start:]
+        return data
+
+    def _on_prompt(self, match: re.Match) -> bytes:
+        if match.group(1) in self.answered:
+            self.rejected = True
+            self.channel.close()
+            return b""
+        self.answered.add(match.group(1))
+        self.prompts += 1
+        if self.prompt_delay is None:
+            self.prompt_delay = time.time() - self.started_at
+        self.channel.sendall((self.password + "\n").encode("utf-8"))
+        self._skip_newline = True
+        return b""
+
+
+class SudoExecutor:
+    """Ejecuta comandos con sudo y recuerda el estado de las credenciales por conexión.
+
+    Tras validar la contraseña en una conexión del pool, mientras dure
+    SUDO_TIMESTAMP_TTL se prueba `sudo -n` sin PTY (stdout y stderr separados,
+    sin contraseña). Si sudo aún exige contraseña (timestamps por terminal) la
+    conexión se marca y a partir de ahí siempre se usa el PTY. Cuenta además el
+    tiempo ahorrado frente a la espera fija de SUDO_LEGACY_WAIT segundos.
+    """
+    def __init__(self, ttl: float = SUDO_TIMESTAMP_TTL, legacy_wait: float = SUDO_LEGACY_WAIT):
+        self.ttl = ttl
+        self.legacy_wait = legacy_wait
+        self._lock = threading.Lock()
+        self._connections = weakref.WeakKeyDictionary()  # transporte -> estado sudo
+        self.commands = 0
+        self.passwords_sent = 0
+        self.cached = 0              # comandos que no necesitaron contraseña
+        self.rejected = 0
+        self.saved = 0.0
+
+    def _state(self, client: paramiko.SSHClient) -> Dict[str, Any]:
+        with self._lock:
+            return self._connections.setdefault(client.get_transport(),
+                                                {"validated_at": 0.0, "needs_pty": False})
+
+    def run(self, client: paramiko.SSHClient, command: str,
+            quiet: bool = False) -> tuple[OutputCapture, OutputCapture, int, float]:
+        if not quiet:
+            print_command_header(command if command.startswith("sudo ") else f"sudo {command}")
+
+        def collect(channel, pty: bool):
+            out, err, exit_code = collect_channel_output(channel, live=not quiet, pty=pty)
+            return (out, err), exit_code, bool(out or err)
+
+        start_time = time.time()
+        (out, err), exit_code, rejected = self.execute(
+            client, functools.partial(wrap_command_with_sudo, command), collect, quiet)
+        if rejected:
+            err.add("sudo: contraseña rechazada (revisa la contraseña sudo)")
+            exit_code = 1
+        return out, err, exit_code, time.time() - start_time
+
+    def execute(self, client: paramiko.SSHClient, build: Callable[[bool], str],
+                collect: Callable, quiet: bool = False) -> tuple[Any, int, bool]:
+        """Ejecuta `build(non_interactive)` y lee el canal con `collect(canal, pty)`.
+
+        `collect` devuelve (resultado, código de salida, si llegó salida). Se
+        devuelve (resultado, código de salida, contraseña rechazada).
+        """
+        state = self._state(client)
+        self._count(commands=1)
+        if not state["needs_pty"] and time.time() - state["validated_at"] < self.ttl:
+            # La prueba corta antes de ejecutar nada si sudo pediría contraseña
+            probe = f"sudo -n true 2>/dev/null || exit {SUDO_PROBE_EXIT_CODE}; "
+            stdin, stdout, stderr = client.exec_command(probe + build(True))
+            result, exit_code, received = collect(stdout.channel, False)
+            if exit_code != SUDO_PROBE_EXIT_CODE or received:
+                state["validated_at"] = time.time()
+                self._count(cached=1, saved=self.legacy_wait)
+                return result, exit_code, False
+            state["needs_pty"] = True
+            if not quiet:
+                print_info("sudo pide la contraseña en cada terminal: se usará PTY en esta conexión")
+
+        channel = client.get_transport().open_session()
+        # Terminal "dumb" y ancho: sin paginador, sin colores y sin recortar líneas
+        channel.get_pty(term="dumb", width=512)
+        channel.exec_command(build(False))
+        watcher = SudoPromptChannel(channel, SUDO_PASSWORD)
+        result, exit_code, _ = collect(watcher, True)
+
+        if watcher.rejected:
+            self._count(rejected=1)
+            return result, exit_code, True
+        if watcher.prompts:
+            self._count(passwords_sent=watcher.prompts, saved=max(0.0, self.legacy_wait - watcher.prompt_delay))
+        elif exit_code == -1:
+            return result, exit_code, False  # cancelado antes de saber si sudo pedía contraseña
+        else:
+            self._count(cached=1, saved=self.legacy_wait)
+        state["validated_at"] = time.time()
+        return result, exit_code, False
+
+    def _count(self, **increments):
+        # Los pasos de un plan en paralelo ejecutan sudo desde varios hilos
+        with self._lock:
+            for name, amount in increments.items():
+                setattr(self, name, getattr(self, name) + amount)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "commands": self.commands,
+            "passwords_sent": self.passwords_sent,
+            "cached": self.cached,
+            "rejected": self.rejected,
+            "saved": self.saved,
+        }
+
+
+SUDO_EXECUTOR = SudoExecutor()
+
+
+def handle_sudo_password(client: paramiko.SSHClient, command: str,
+                         quiet: bool = False) -> tuple[OutputCapture, OutputCapture, int, float]:
     """Maneja la ejecución de comandos con sudo"""
     if not USE_SUDO or not SUDO_PASSWORD:
-        return run_remote_command_basic(client, command)
+        return run_remote_command_basic(client, command, quiet)
     
-    sudo_command = wrap_command_with_sudo(command)
+    if wrap_command_with_sudo(command) == command:
+        return run_remote_command_basic(client, command, quiet)
     
-    if 'sudo' not in sudo_command:
-        return run_remote_command_basic(client, command)
-    
-    print_command_header(sudo_command)
-    
-    start_time = time.time()
-    stdin, stdout, stderr = client.exec_command(sudo_command)
-    
-    time.sleep(0.5)
-    if stdout.channel.recv_ready():
-        stdin.write(SUDO_PASSWORD + '\n')
-        stdin.flush()
-    
-    out = stdout.read().decode("utf-8", errors="ignore")
-    err = stderr.read().decode("utf-8", errors="ignore")
-    exit_code = stdout.channel.recv_exit_status()
-    execution_time = time.time() - start_time
-    
-    return out, err, exit_code, execution_time
+    return SUDO_EXECUTOR.run(client, command, quiet)
 
 
-def run_remote_command_basic(client: paramiko.SSHClient, command: str) -> tuple[str, str, int, float]:
+def run_remote_command_basic(client: paramiko.SSHClient, command: str,
+                             quiet: bool = False) -> tuple[OutputCapture, OutputCapture, int, float]:
     """Ejecuta comando básico sin manejo de sudo"""
-    print_command_header(command)
+    if not quiet:
+        print_command_header(command)
     
     start_time = time.time()
     stdin, stdout, stderr = client.exec_command(command)
-    out = stdout.read().decode("utf-8", errors="ignore")
-    err = stderr.read().decode("utf-8", errors="ignore")
-    exit_code = stdout.channel.recv_exit_status()
+    out, err, exit_code = collect_channel_output(stdout.channel, live=not quiet)
     execution_time = time.time() - start_time
     
     return out, err, exit_code, execution_time
 
 
-def run_remote_command(client: paramiko.SSHClient, command: str) -> tuple[str, str, int, float]:
-    """Ejecuta comando con soporte para sudo"""
-    return handle_sudo_password(client, command)
+def run_remote_command(client: paramiko.SSHClient, command: str,
+                       quiet: bool = False) -> tuple[OutputCapture, OutputCapture, int, float]:
+    """Ejecuta comando con soporte para sudo (`quiet` omite cabecera y salida en vivo)"""
+    return handle_sudo_password(client, command, quiet)
+
+
+# ==========================
+# FILTRADO REMOTO DE SALIDAS GRANDES
+# ==========================
+
+# Logs sin límite de líneas o de tiempo: su tamaño crece con el tiempo de vida del servicio
+UNBOUNDED_LOG_RE = re.compile(
+    r"^(?:sudo\s+(?:-\S+\s+)*)?(?:docker(?:\s+compose|-compose)?\s+(?:container\s+)?logs|journalctl|cat\s+\S*\.log)\b"
+)
+BOUNDED_LOG_RE = re.compile(r"(?:--tail|--lines|--since|--until|-n\s*\d|-b\b|\||\bhead\b|\btail\b)")
+# Seguimiento en vivo (-f, --follow, -F, también agrupado como -fu): no termina solo,
+# así que awk y gzip no llegarían a volcar nada; siempre va por la salida en vivo
+FOLLOW_LOG_RE = re.compile(r"(?:^|\s)(?:--follow\b|-[A-Za-z]*[fF])")
+
+# Réplica en awk de OutputCapture: cabecera, líneas relevantes que salen del
+# buffer circular y cola. La última línea lleva el código de salida del comando
+# y los contadores (bytes, líneas y líneas relevantes conservadas).
+REMOTE_FILTER_AWK = r"""
+index($0, m) { rc = $NF; sub(m " [0-9]*$", ""); if ($0 == "") next }
+{
+  total++; bytes += length($0) + 1
+  if (total <= h) { print; next }
+  if (total - h > n) {
+    old = ring[total % n]
+    if (kept < k && tolower(old) ~ re) { print old; kept++ }
+  }
+  ring[total % n] = $0
+}
+END {
+  start = total - n + 1
+  if (start <= h) start = h + 1
+  for (i = start; i <= total; i++) print ring[i % n]
+  printf "%s %s %d %d %d\n", m, (rc == "" ? "-" : rc), bytes, total, kept
+}
+"""
+# Sin gzip o base64 en la Pi se envía el texto filtrado tal cual
+REMOTE_COMPRESS_PIPE = (
+    "{ if command -v gzip >/dev/null 2>&1 && command -v base64 >/dev/null 2>&1; "
+    "then gzip -c | base64; else cat; fi; }"
+)
+# Cabecera de gzip (1f 8b 08) codificada en base64
+GZIP_BASE64_MAGIC = "H4sI"
+
+
+def keywords_ere(keywords: Iterable[str] = IMPORTANT_KEYWORDS) -> str:
+    """Palabras clave como expresión regular extendida (grep -E / awk)"""
+    def escape(keyword: str) -> str:
+        return "".join(f"[{c}]" if c in ".[]()*+?{}|^$\\" else c for c in keyword)
+    return "|".join(escape(keyword) for keyword in keywords)
+
+
+def build_remote_filter(command: str, marker: str, compress: bool = False) -> str:
+    """Envuelve el comando para filtrar (y opcionalmente comprimir) su salida en la Pi.
+
+    stderr se une a stdout para filtrarse igual. El comando va en un subshell
+    (un `exit` no se salta la línea final) y su código de salida viaja en esa
+    línea, porque el de la tubería sería el de awk o base64.
+    """
+    script = (
+        f"{{ ( {command}\n) 2>&1; echo \"{marker} $?\"; }} | "
+        f"awk -v m={marker} -v h={CAPTURE_HEAD_LINES} -v n={CAPTURE_TAIL_LINES} "
+        f"-v k={CAPTURE_MAX_KEYWORD_LINES} -v re={shlex.quote(keywords_ere())} "
+        f"{shlex.quote(REMOTE_FILTER_AWK)}"
+    )
+    if compress:
+        script += f" | {REMOTE_COMPRESS_PIPE}"
+    return script
+
+
+def decode_remote_payload(lines: List[str]) -> List[str]:
+    """Descomprime la salida si llegó como gzip + base64; si no, la deja como está"""
+    payload = "".join(line.strip() for line in lines)
+    if not payload.startswith(GZIP_BASE64_MAGIC):
+        return lines
+    try:
+        text = gzip.decompress(base64.b64decode(payload)).decode("utf-8", errors="ignore")
+    except (ValueError, OSError, EOFError, zlib.error):
+        return lines  # transferencia incompleta (Ctrl+C): se muestra lo recibido
+    return text.split('\n')[:-1] if text.endswith('\n') else text.split('\n')
+
+
+def collect_filtered_output(channel: paramiko.Channel, marker: str, compress: bool = False,
+                            pty: bool = False) -> tuple[OutputCapture, OutputCapture, int, int | None]:
+    """Lee la salida filtrada en remoto y reconstruye las capturas (no hay salida en vivo).
+
+    Devuelve (stdout, stderr, código del canal, código del comando); el del
+    comando es None si no llegó la línea final (comando cancelado).
+    """
+    lines = {"stdout": [], "stderr": []}
+    wire = {}
+    try:
+        for stream, line in iter_channel_output(channel, pty=pty, counters=wire):
+            lines[stream].append(line)
+        channel_exit = channel.recv_exit_status()
+    except KeyboardInterrupt:
+        channel.close()
+        print_warning("Comando cancelado por el usuario (Ctrl+C)")
+        channel_exit = -1
+
+    filtered = decode_remote_payload(lines["stdout"]) if compress else lines["stdout"]
+    command_exit, remote_bytes = None, None
+    if filtered and filtered[-1].startswith(marker + " "):
+        rc, remote_bytes, total, kept = filtered.pop().split()[1:5]
+        command_exit = int(rc) if rc.isdigit() else None
+        remote_bytes, total, kept = int(remote_bytes), int(total), int(kept)
+        head = min(total, CAPTURE_HEAD_LINES)
+        omitted = total - head - min(CAPTURE_TAIL_LINES, total - head) - kept
+        if omitted > 0:
+            marker_line = f"... [{omitted} líneas omitidas en remoto de {total}"
+            if kept:
+                marker_line += f", se conservan {kept} líneas relevantes"
+            filtered.insert(head, marker_line + "] ...")
+
+    # Todo lo recibido ya está acotado: las capturas lo conservan entero
+    out = OutputCapture(head_lines=len(filtered), spill=False)
+    err = OutputCapture(head_lines=len(lines["stderr"]), spill=False)
+    for line in filtered:
+        out.add(line)
+    for line in lines["stderr"]:
+        err.add(line)
+    out.wire_bytes, err.wire_bytes = wire.get("stdout", 0), wire.get("stderr", 0)
+    out.remote_bytes = remote_bytes
+    return out, err, channel_exit, command_exit
+
+
+def run_remote_command_filtered(client: paramiko.SSHClient, command: str, compress: bool = False,
+                                quiet: bool = False) -> tuple[OutputCapture, OutputCapture, int, float]:
+    """Como run_remote_command, pero filtrando (y comprimiendo) la salida en la Pi"""
+    marker = f"__RPI_FILTER_{secrets.token_hex(4)}__"
+    use_sudo = USE_SUDO and SUDO_PASSWORD and wrap_command_with_sudo(command) != command
+    if not quiet:
+        print_command_header(f"sudo {command}" if use_sudo and not command.startswith("sudo ") else command)
+
+    def collect(channel, pty: bool):
+        out, err, channel_exit, command_exit = collect_filtered_output(channel, marker, compress, pty)
+        return (out, err, command_exit), channel_exit, bool(out or err)
+
+    start_time = time.time()
+    if use_sudo:
+        (out, err, command_exit), exit_code, rejected = SUDO_EXECUTOR.execute(
+            client, lambda non_interactive: build_remote_filter(
+                wrap_command_with_sudo(command, non_interactive), marker, compress),
+            collect, quiet)
+    else:
+        stdin, stdout, stderr = client.exec_command(build_remote_filter(command, marker, compress))
+        (out, err, command_exit), exit_code, _ = collect(stdout.channel, False)
+        rejected = False
+
+    if rejected:
+        err.add("sudo: contraseña rechazada (revisa la contraseña sudo)")
+        exit_code = 1
+    elif command_exit is not None and exit_code != -1:
+        exit_code = command_exit
+    return out, err, exit_code, time.time() - start_time
+
+
+class OutputSizeEstimator:
+    """Estima el tamaño de la salida de un comando antes de ejecutarlo.
+
+    Recuerda los bytes que generó cada comando en ejecuciones anteriores; para
+    uno nuevo solo se supone grande un log sin límite (docker logs sin --tail,
+    journalctl sin -n...). Con la estimación se decide si filtrar en remoto; los
+    comandos con -f/--follow nunca se filtran porque no terminan.
+    """
+    def __init__(self, max_entries: int = 200, log_estimate: int = REMOTE_FILTER_LOG_ESTIMATE):
+        self.max_entries = max_entries
+        self.log_estimate = log_estimate
+        self._sizes: Dict[str, int] = {}
+        self.filtered = 0
+        self.wire_bytes = 0
+        self.remote_bytes = 0
+
+    @staticmethod
+    def normalize(command: str) -> str:
+        return " ".join(command.split())
+
+    def estimate(self, command: str) -> int:
+        key = self.normalize(command)
+        if FOLLOW_LOG_RE.search(key):
+            return 0
+        if key in self._sizes:
+            return self._sizes[key]
+        if UNBOUNDED_LOG_RE.match(key) and not BOUNDED_LOG_RE.search(key):
+            return self.log_estimate
+        return 0
+
+    def record(self, command: str, size: int):
+        key = self.normalize(command)
+        self._sizes.pop(key, None)
+        self._sizes[key] = size
+        while len(self._sizes) > self.max_entries:
+            self._sizes.pop(next(iter(self._sizes)))
+
+    def choose(self, command: str) -> dict | None:
+        """Modo de transferencia: None (salida completa) o {"estimate", "compress"}"""
+        if not REMOTE_FILTER_ENABLED:
+            return None
+        estimate = self.estimate(command)
+        if estimate < REMOTE_FILTER_MIN_BYTES:
+            return None
+        return {"estimate": estimate, "compress": estimate >= REMOTE_COMPRESS_MIN_BYTES}
+
+    def record_transfer(self, wire_bytes: int, remote_bytes: int):
+        self.filtered += 1
+        self.wire_bytes += wire_bytes
+        self.remote_bytes += remote_bytes
+
+
+OUTPUT_SIZE_ESTIMATOR = OutputSizeEstimator()
+
+
+# ==========================
+# CLIENTE OLLAMA CON STREAMING
+# ==========================
+
+class OllamaClient(agent_common.OllamaClient):
+    """agent_common.OllamaClient con la configuración del script.
+
+    En modo medición (--measure-prompt) muestra los tokens de prompt evaluados.
+    """
+    def __init__(self):
+        super().__init__(OLLAMA_URL, OLLAMA_MODEL, OLLAMA_KEEP_ALIVE, OLLAMA_OPTIONS,
+                         connect_timeout=OLLAMA_CONNECT_TIMEOUT, read_timeout=OLLAMA_READ_TIMEOUT,
+                         max_retries=OLLAMA_MAX_RETRIES, backoff=OLLAMA_RETRY_BACKOFF)
+
+    def on_prompt_eval(self, path: str, count: int, duration: float):
+        print_info(f"prompt_eval: {count} tokens en {duration * 1000:.0f} ms", "📏")
+
+    def embed(self, text: str, model: str = OLLAMA_EMBED_MODEL) -> List[float]:
+        return super().embed(text, model)
+
+
+OLLAMA_CLIENT = OllamaClient()
+
+
+class ModelKeepWarm:
+    """Precarga el modelo al iniciar y lo mantiene cargado mientras dura la sesión"""
+    def __init__(self, client: OllamaClient = OLLAMA_CLIENT,
+                 interval: float = OLLAMA_HEARTBEAT_INTERVAL):
+        self.client = client
+        self.interval = interval
+        self.warm_up_time = None
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Lanza la precarga y el latido en segundo plano (no bloquea el arranque)"""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self.warm_up_time = self.client.warm_up()
+        except requests.exceptions.RequestException as e:
+            self.error = e
+        while not self._stop.wait(self.interval):
+            try:
+                self.client.warm_up()
+            except requests.exceptions.RequestException as e:
+                self.error = e
+
+    def stop(self):
+        self._stop.set()
+
+
+KEEP_WARM = ModelKeepWarm()
+
+
+class OllamaStream:
+    """Consume la respuesta NDJSON de Ollama (stream=True) de forma incremental"""
+    def __init__(self, payload: dict, timeout: float | None = None,
+                 client: OllamaClient | None = None):
+        self.client = client or OLLAMA_CLIENT
+        self.payload = self.client.with_defaults(dict(payload, stream=True))
+        self.timeout = timeout
+        self.ttft = None
+        self.total_time = None
+        self.final_chunk = {}
+        self.cancelled = False
+        self._parts = []
+        self._response = None
+
+    @property
+    def text(self) -> str:
+        return "".join(self._parts)
+
+    def __iter__(self) -> Iterator[str]:
+        start = time.time()
+        self._response = self.client.request("POST", "/api/chat", self.payload, stream=True,
+                                             read_timeout=self.timeout)
+        if self.cancelled:
+            self._response.close()
+            raise OllamaPreempted()
+        failed = True
+        try:
+            for raw in self._response.iter_lines():
+                if not raw:
+                    continue
+                chunk = json.loads(raw)
+                if "error" in chunk:
+                    raise RuntimeError(chunk["error"])
+                piece = chunk.get("message", {}).get("content", "")
+                if piece:
+                    if self.ttft is None:
+                        self.ttft = time.time() - start
+                    self._parts.append(piece)
+                    yield piece
+                if chunk.get("done"):
+                    self.final_chunk = chunk
+                    break
+            failed = False
+        except GeneratorExit:
+            # Corte intencionado del stream (p. ej. JSON ya completo)
+            failed = False
+            raise
+        finally:
+            self.total_time = time.time() - start
+            self.client.record("/api/chat", self.total_time, self.ttft,
+                               retries=self._response.retries, error=failed)
+            if MEASURE_PROMPT_EVAL and self.final_chunk:
+                self.client.record_prompt_eval("/api/chat", self.final_chunk)
+            self.close()
+
+    def close(self):
+        """Cierra la conexión HTTP (aborta la generación si aún no terminó)"""
+        if self._response is not None:
+            self._response.close()
+
+    def cancel(self):
+        """Aborta el stream desde otro hilo, también si aún no ha empezado"""
+        self.cancelled = True
+        self.close()
+
+
+class OllamaPreempted(Exception):
+    """Una petición interactiva interrumpió una generación de fondo"""
+
+
+class OllamaSlot:
+    """Reparte el único hueco de generación de Ollama entre el usuario y el trabajo de fondo.
+
+    Las peticiones interactivas nunca esperan: si hay una generación de fondo
+    (el resumen de la memoria) en curso, se aborta su stream y Ollama queda libre;
+    el trabajo de fondo solo arranca con el modelo ocioso y se repite después.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._interactive = 0
+        self._background: OllamaStream | None = None
+        self.preempted = 0
+
+    @contextlib.contextmanager
+    def interactive(self):
+        with self._cond:
+            self._interactive += 1
+            background, self._background = self._background, None
+            if background is not None:
+                self.preempted += 1
+        if background is not None:
+            background.cancel()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._interactive -= 1
+                self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def background(self, stream: OllamaStream):
+        with self._cond:
+            while self._interactive:
+                self._cond.wait()
+            self._background = stream
+        try:
+            yield
+        finally:
+            with self._cond:
+                if self._background is stream:
+                    self._background = None
+
+
+OLLAMA_SLOT = OllamaSlot()
+
+
+def ollama_chat(payload: dict, on_token: Callable[[str], None] | None = None,
+                stop_when: Callable[[str], bool] | None = None, background: bool = False) -> str:
+    """Envía un chat a Ollama en modo streaming y devuelve el texto completo.
+
+    Si `stop_when` devuelve True para un fragmento, se corta el stream HTTP y
+    Ollama deja de generar (salvo en modo medición, que necesita el chunk final).
+    Con `background` espera a que el modelo esté libre y lanza OllamaPreempted
+    si una petición interactiva lo interrumpe.
+    """
+    stream = OllamaStream(payload)
+    slot = OLLAMA_SLOT.background(stream) if background else OLLAMA_SLOT.interactive()
+    with slot:
+        tokens = iter(stream)
+        try:
+            for piece in tokens:
+                if on_token:
+                    on_token(piece)
+                if stop_when and stop_when(piece) and not MEASURE_PROMPT_EVAL:
+                    tokens.close()
+                    break
+        except Exception:
+            if stream.cancelled:
+                raise OllamaPreempted() from None
+            raise
+    if stream.cancelled:
+        raise OllamaPreempted()
+    return stream.text.strip()
+
+
+# ==========================
+# MEMORIA DE CONVERSACIÓN
+# ==========================
+
+def clip_text(text: str, max_tokens: int) -> str:
+    """Recorta texto en prosa (análisis, respuestas) por el final; compress_output es para logs"""
+    text = text.strip()
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    return text[:int(max_tokens * CONTEXT_CHARS_PER_TOKEN)].rstrip() + "…"
+
+
+def format_turn(turn: Dict[str, str], output_tokens: int = 0, analysis_tokens: int = 0) -> str:
+    """Texto de un turno; con 0 tokens de salida y análisis queda en una sola línea"""
+    if "answer" in turn:
+        text = f"Pregunta: {turn['request']}"
+        if analysis_tokens and turn["answer"]:
+            text += f"\nRespuesta: {clip_text(turn['answer'], analysis_tokens)}"
+        return text
+    if not (output_tokens or analysis_tokens):
+        return f"Petición: {turn['request']} | Comando: {turn['command']}"
+    text = f"Petición: {turn['request']}\nComando: {turn['command']}"
+    if output_tokens and turn["output"].strip():
+        text += f"\nSalida: {compress_output(turn['output'].strip(), output_tokens)}"
+    if analysis_tokens and turn["analysis"]:
+        text += f"\nAnálisis: {clip_text(turn['analysis'], analysis_tokens)}"
+    return text
+
+
+def summarize_turns(previous: str, turns: List[Dict[str, str]],
+                    max_tokens: int = MEMORY_SUMMARY_TOKENS) -> str:
+    """Pide al modelo el resumen anterior ampliado con los turnos nuevos"""
+    new_turns = "\n\n".join(format_turn(turn, MEMORY_SUMMARY_INPUT_TOKENS // 2, MEMORY_SUMMARY_INPUT_TOKENS // 2)
+                            for turn in turns)
+    user_msg = f"""
+Resumen actual de la sesión:
+{previous or "(vacío)"}
+
+Turnos nuevos:
+{new_turns}
+
+Actualiza el resumen incorporando los turnos nuevos. Conserva nombres de contenedores
+y servicios, comandos ejecutados, errores encontrados y conclusiones; omite lo demás.
+Máximo {max_tokens * 2 // 3} palabras, sin introducción.
+"""
+
+    payload = {
+        "model": OLLAMA_MODEL,
+        "messages": [
+            {"role": "system", "content": "Resumes sesiones de diagnóstico DevOps de forma breve y factual."},
+            {"role": "user", "content": user_msg},
+        ],
+        "options": {"num_predict": max_tokens * 2},
+    }
+    return ollama_chat(payload, background=True)
+
+
+class ConversationMemory:
+    """Memoria de la conversación ajustada a un presupuesto de tokens.
+
+    Conserva literalmente los últimos `recent_turns` turnos (petición, comando,
+    salida y análisis, o pregunta y respuesta). Los que salen de esa ventana se
+    incorporan al resumen con el LLM en un hilo de fondo; mientras tanto se
+    muestran en una línea cada uno. `render` reserva sitio para el resumen y
+    reparte el resto empezando por el turno más reciente, con la mitad de
+    detalle en cada turno anterior.
+    """
+    def __init__(self, recent_turns: int = MEMORY_RECENT_TURNS, summary_tokens: int = MEMORY_SUMMARY_TOKENS,
+                 background: bool = MEMORY_SUMMARIZE_IN_BACKGROUND):
+        self.recent_turns = recent_turns
+        self.summary_tokens = summary_tokens
+        self.background = background
+        self.turns = deque()
+        self.pending: List[Dict[str, str]] = []   # fuera de la ventana, aún sin resumir
+        self.summary = ""
+        self.summarized = 0
+        self.summary_errors = 0
+        self._lock = threading.Lock()
+        self._worker = None
+
+    def add_command(self, request: str, command: str, output: str) -> Dict[str, str]:
+        return self._add({"request": request, "command": command, "output": output, "analysis": ""})
+
+    def add_followup(self, question: str, answer: str) -> Dict[str, str]:
+        return self._add({"request": question, "answer": answer})
+
+    def set_analysis(self, analysis: str):
+        with self._lock:
+            if self.turns and "analysis" in self.turns[-1]:
+                self.turns[-1]["analysis"] = analysis
+
+    @property
+    def latest(self) -> Dict[str, str] | None:
+        with self._lock:
+            return self.turns[-1] if self.turns else None
+
+    def recent_commands(self) -> List[str]:
+        with self._lock:
+            return [turn["command"] for turn in self.turns if "command" in turn]
+
+    def has_analysis(self) -> bool:
+        """Si el último turno tiene análisis o respuesta sobre los que preguntar"""
+        latest = self.latest
+        return bool(latest and (latest.get("analysis") or latest.get("answer")))
+
+    def _add(self, turn: Dict[str, str]) -> Dict[str, str]:
+        with self._lock:
+            self.turns.append(turn)
+            while len(self.turns) > self.recent_turns:
+                self.pending.append(self.turns.popleft())
+            start = bool(self.pending) and not (self._worker and self._worker.is_alive())
+            if start and self.background:
+                self._worker = threading.Thread(target=self._summarize, daemon=True)
+                self._worker.start()
+        if start and not self.background:
+            self._summarize()
+        return turn
+
+    def _summarize(self):
+        """Incorpora los turnos pendientes al resumen hasta que no quede ninguno"""
+        while True:
+            with self._lock:
+                batch, previous = list(self.pending), self.summary
+            if not batch:
+                return
+            try:
+                summary = summarize_turns(previous, batch, self.summary_tokens)
+            except OllamaPreempted:
+                continue  # se repite cuando el modelo vuelva a estar libre
+            except Exception:
+                # Se reintenta cuando otro turno salga de la ventana
+                with self._lock:
+                    self.summary_errors += 1
+                return
+            with self._lock:
+                if summary:
+                    self.summary = summary
+                    del self.pending[:len(batch)]
+                    self.summarized += len(batch)
+                else:
+                    self.summary_errors += 1
+                    return
+
+    def render(self, budget: int) -> str:
+        """Resumen, turnos pendientes y turnos recientes en unos `budget` tokens"""
+        with self._lock:
+            summary, pending, turns = self.summary, list(self.pending), list(self.turns)
+
+        def cost(text: str) -> int:
+            return estimate_tokens(text) + 4   # más la etiqueta y la separación del bloque
+
+        remaining = budget
+        if summary:
+            summary = clip_text(summary, min(self.summary_tokens, budget // 3))
+            remaining -= cost(summary)
+
+        recent = []
+        for age, turn in enumerate(reversed(turns)):
+            for shift in range(age, age + 4):
+                text = format_turn(turn, FOLLOWUP_OUTPUT_TOKENS >> shift, FOLLOWUP_ANALYSIS_TOKENS >> shift)
+                if cost(text) <= remaining:
+                    break
+            else:
+                text = format_turn(turn)
+            if cost(text) > remaining:
+                break
+            recent.insert(0, text)
+            remaining -= cost(text)
+
+        older = []
+        if len(recent) == len(turns):
+            remaining -= 4
+            for turn in reversed(pending):
+                line = f"- {format_turn(turn)}"
+                if estimate_tokens(line) > remaining:
+                    break
+                older.insert(0, line)
+                remaining -= estimate_tokens(line)
+
+        parts = []
+        if summary:
+            parts.append(f"Resumen de la sesión:\n{summary}")
+        if older:
+            parts.append("Turnos anteriores:\n" + "\n".join(older))
+        if recent:
+            labels = [f"Turno {-n}" for n in range(len(recent), 1, -1)] + ["Último turno"]
+            parts.extend(f"{label}:\n{text}" for label, text in zip(labels, recent))
+        return "\n\n".join(parts)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "turns": len(self.turns) + len(self.pending) + self.summarized,
+                "summarized": self.summarized,
+                "pending": len(self.pending),
+                "errors": self.summary_errors,
+            }
+
+
+MEMORY = ConversationMemory()
 
 
 # ==========================
 # PROMPT DEL AGENTE MEJORADO - VERSIÓN MÁS ESTRICTA
 # ==========================
 
-def get_system_prompt():
-    """Construye el prompt del sistema dinámicamente"""
-    
+def get_system_prompt() -> str:
+    """Prompt del sistema: prefijo fijo byte a byte para que Ollama reutilice su caché.
+
+    El contexto que cambia en cada turno va en el mensaje de usuario
+    (ver build_context_message), nunca aquí.
+    """
+    return _build_system_prompt(USE_SUDO)
+
+
+@functools.lru_cache(maxsize=None)
+def _build_system_prompt(use_sudo: bool) -> str:
     sudo_section = """
 **MANEJO DE PRIVILEGIOS:**
 El usuario tiene privilegios root, no es necesario usar sudo.
 - Ejecuta los comandos directamente sin 'sudo'
-""" if not USE_SUDO else """
+""" if not use_sudo else """
 **MANEJO DE PRIVILEGIOS:**
 El usuario actual necesita usar sudo para algunos comandos.
 - Comandos que requieren sudo: systemctl, docker, apt, journalctl, etc.
@@ -494,26 +2246,39 @@ Tu respuesta debe ser EXCLUSIVAMENTE un objeto JSON válido con esta estructura
 2. SIN placeholders - usa nombres REALES del contexto
 3. SIN markdown - no uses ```json o bloques de código
 4. SIN explicaciones adicionales fuera del JSON
-5. UN SOLO comando por respuesta
+5. UN SOLO comando por respuesta (salvo el MODO PLAN para diagnósticos)
+6. Si el mensaje incluye INFORMACIÓN ACTUAL DEL SISTEMA, usa los nombres EXACTOS que aparecen ahí
 
-**CONTEXTO DE CONTENEDORES DISPONIBLES:**
-Sabemos que existe un contenedor frontend en puerto 3000 llamado 'arkanops-frontend'
-Sabemos que existe un contenedor gateway llamado 'arkanops-gateway'
-Sabemos que existe cloudflared configurado
+**CONTEXTO DE CONTENEDORES Y SERVICIOS:**
+Los contenedores y servicios del host se descubren automáticamente y llegan en el
+mensaje del usuario (INFORMACIÓN ACTUAL DEL SISTEMA). Si no aparece el nombre que
+necesitas, genera primero un comando para listarlos (docker ps -a, systemctl list-units).
 
 **EJEMPLOS CORRECTOS:**
+Contexto: "- frontend: web-frontend (nginx:alpine, running, 0.0.0.0:3000->80/tcp)"
 Usuario: "revisa el log del contenedor frontend"
-Respuesta: {{"command": "docker logs arkanops-frontend", "explanation": "Revisa los logs del contenedor frontend", "dangerous": false, "reasoning": "El contenedor frontend está en puerto 3000 según el contexto"}}
-
-Usuario: "verifica si el servicio está corriendo"
-Respuesta: {{"command": "docker ps | grep arkanops-frontend", "explanation": "Verifica si el contenedor frontend está ejecutándose", "dangerous": false, "reasoning": "Necesito confirmar el estado del contenedor que sirve la aplicación en puerto 3000"}}
+Respuesta: {{"command": "docker logs --tail 100 web-frontend", "explanation": "Revisa los logs del contenedor frontend", "dangerous": false, "reasoning": "El contexto indica que el frontend es web-frontend"}}
+
+Contexto: sin contenedores conocidos
+Usuario: "verifica si el frontend está corriendo"
+Respuesta: {{"command": "docker ps -a", "explanation": "Lista los contenedores y su estado", "dangerous": false, "reasoning": "No conozco el nombre del contenedor frontend, primero hay que listarlos"}}
+
+**MODO PLAN (solo diagnósticos):**
+Si para diagnosticar un problema hacen falta varias comprobaciones, añade "plan":
+una lista ordenada de 2 a {PLAN_MAX_STEPS} comandos de SOLO LECTURA (status, logs --tail, ps,
+ss, df, inspect...). "command" es el primer paso del plan y "dangerous" es false.
+Nunca pongas en un plan comandos que modifiquen el sistema ni que no terminen solos.
+Los pasos se ejecutan en paralelo; si uno solo tiene sentido cuando otro anterior
+funcionó, escríbelo como {{"command": "...", "after": [1]}} (número del paso previo).
+Usuario: "por qué no carga la web del frontend"
+Respuesta: {{"command": "docker ps -a --filter name=web-frontend", "explanation": "Comprueba el contenedor, sus logs y el puerto", "dangerous": false, "reasoning": "Hay que ver si está corriendo, si hay errores y si escucha en 3000", "plan": ["docker ps -a --filter name=web-frontend", "docker logs --tail 50 web-frontend", "ss -tlnp | grep 3000"]}}
 
 {sudo_section}
 
 **SI EL USUARIO REPORTA ERRORES DE CONEXIÓN:**
 - Primero verifica el estado de los contenedores relevantes
 - Luego revisa logs para diagnosticar problemas
-- Usa nombres específicos como 'arkanops-frontend', 'arkanops-gateway'
+- Usa los nombres exactos de INFORMACIÓN ACTUAL DEL SISTEMA, nunca nombres inventados
 
 Tu respuesta debe ser SOLO el JSON, sin ningún otro texto.
 """
@@ -523,6 +2288,261 @@ Tu respuesta debe ser SOLO el JSON, sin ningún otro texto.
 # FUNCIONES LÓGICAS MEJORADAS CON PARSING ROBUSTO
 # ==========================
 
+COMMAND_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "command": {"type": "string"},
+        "explanation": {"type": "string"},
+        "dangerous": {"type": "boolean"},
+        "reasoning": {"type": "string"},
+        "plan": {
+            "type": "array",
+            "maxItems": PLAN_MAX_STEPS,
+            "items": {"anyOf": [
+                {"type": "string"},
+                {
+                    "type": "object",
+                    "properties": {
+                        "command": {"type": "string"},
+                        "after": {"type": "array", "items": {"type": "integer"}},
+                    },
+                    "required": ["command"],
+                },
+            ]},
+        },
+    },
+    "required": ["command", "explanation", "dangerous", "reasoning"],
+}
+
+COMMAND_PLACEHOLDERS = ['[nombre]', '[id]', '[ruta]', 'container_name', 'nombre-del-contenedor', '<comando>']
+
+# Comandos de solo lectura admitidos en un plan; los que tienen subcomandos
+# solo se admiten con los de consulta
+PLAN_READ_ONLY_COMMANDS = {
+    'cat', 'ls', 'ps', 'df', 'du', 'free', 'uptime', 'uname', 'ss', 'netstat', 'ip', 'ping',
+    'curl', 'dig', 'nslookup', 'journalctl', 'systemctl', 'docker', 'grep', 'egrep', 'tail',
+    'head', 'wc', 'find', 'stat', 'date', 'hostname', 'lsblk', 'vcgencmd', 'id', 'whoami',
+    'dmesg', 'lsof', 'last', 'who', 'awk', 'sed', 'sort', 'uniq', 'cut', 'tr', 'getent',
+    'timedatectl', 'hostnamectl', 'nproc', 'lscpu', 'mount', 'echo',
+}
+PLAN_READ_ONLY_SUBCOMMANDS = {
+    'systemctl': {'status', 'is-active', 'is-enabled', 'is-failed', 'list-units', 'list-timers',
+                  'show', 'cat'},
+    'docker': {'ps', 'logs', 'inspect', 'stats', 'images', 'top', 'port', 'version', 'info',
+               'network', 'volume', 'compose', 'system'},
+    'timedatectl': {'status', 'show'},
+    'hostnamectl': {'status', 'show'},
+}
+# Subcomandos de segundo nivel de solo lectura (docker compose ps, docker network ls...)
+PLAN_READ_ONLY_NESTED = {
+    ('docker', 'compose'): {'ps', 'logs', 'config', 'images', 'top', 'ls', 'version', 'port'},
+    ('docker', 'network'): {'ls', 'inspect'},
+    ('docker', 'volume'): {'ls', 'inspect'},
+    ('docker', 'system'): {'df', 'info'},
+}
+# Opciones que modifican el sistema, escriben ficheros o hacen que el comando no termine
+# solo: (letras cortas, que cuentan también agrupadas como -Ei o -so; opciones largas)
+PLAN_UNSAFE_FLAGS = {
+    'sed': ("i", {"--in-place"}),
+    'curl': ("oOTdF", {"--output", "--output-dir", "--remote-name", "--remote-name-all",
+                       "--upload-file", "--data", "--data-raw", "--data-binary",
+                       "--data-urlencode", "--form", "--json"}),
+    'journalctl': ("f", {"--follow", "--vacuum-size", "--vacuum-time", "--vacuum-files",
+                         "--rotate", "--flush", "--sync", "--relinquish-var", "--setup-keys"}),
+    'tail': ("fF", {"--follow", "--retry"}),
+    'date': ("s", {"--set"}),
+    'dmesg': ("cCDEn", {"--clear", "--read-clear", "--console-off", "--console-on",
+                        "--console-level"}),
+    'hostname': ("bF", {"--boot", "--file"}),
+    'docker': ("f", {"--follow"}),
+    'sort': ("o", {"--output"}),
+}
+# find usa acciones con un solo guion
+PLAN_UNSAFE_FIND_ACTIONS = {'-delete', '-exec', '-execdir', '-ok', '-okdir',
+                            '-fprint', '-fprint0', '-fprintf', '-fls'}
+# Guiones de sed que ejecutan (e) o escriben ficheros (w, W), como comando o como flag de s///
+PLAN_UNSAFE_SED_RE = re.compile(
+    r"(?:^|[;{}])\s*(?:\d+|\$|/[^/]*/)?(?:\s*,\s*(?:\d+|\$|/[^/]*/))?\s*!?\s*[ewW](?:\s|$)"
+    r"|s(.)(?:\\.|(?!\1).)*\1(?:\\.|(?!\1).)*\1[gpiImMe\d]*[ewW]"
+)
+# awk puede ejecutar comandos o escribir ficheros
+PLAN_UNSAFE_AWK_RE = re.compile(r"system\s*\(|\|\s*getline|\bprintf?\b[^;}]*[>|]")
+# Expansiones que el análisis por tramos no puede validar
+PLAN_UNSAFE_SHELL_RE = re.compile(r"[\n\r`]|\$\(|[<>]\(")
+# Redirecciones permitidas: a /dev/null y duplicar descriptores
+PLAN_ALLOWED_REDIRECTS_RE = re.compile(r"\d?>>?\s*/dev/null(?![\w/.-])|\d?>&\d")
+PLAN_SEGMENT_OPERATORS = {'|', '||', '&&', ';'}
+
+
+def short_flags(arguments: List[str]) -> set:
+    """Letras de las opciones cortas, también agrupadas (-Ei, -sSo, -n20)"""
+    letters = set()
+    for argument in arguments:
+        match = re.match(r"^-([A-Za-z]+)", argument)
+        if match:
+            letters.update(match.group(1))
+    return letters
+
+
+def curl_request_method(arguments: List[str]) -> str:
+    """Método HTTP que pide curl con -X/--request (GET si no se indica)"""
+    for index, argument in enumerate(arguments):
+        following = arguments[index + 1] if index + 1 < len(arguments) else ""
+        if argument == "--request":
+            return following
+        if argument.startswith("--request="):
+            return argument.split("=", 1)[1]
+        match = re.match(r"^-[A-Za-z]*X(.*)$", argument)
+        if match:
+            return match.group(1) or following
+    return "GET"
+
+
+def has_unsafe_arguments(program: str, arguments: List[str], positional: List[str]) -> bool:
+    """Si los argumentos hacen que un comando de la lista de lectura modifique algo"""
+    letters, long_options = PLAN_UNSAFE_FLAGS.get(program, ("", set()))
+    if set(letters) & short_flags(arguments):
+        return True
+    if any(argument.split("=", 1)[0] in long_options for argument in arguments):
+        return True
+
+    if program == 'find':
+        return any(argument in PLAN_UNSAFE_FIND_ACTIONS for argument in arguments)
+    if program == 'sed':
+        return any(PLAN_UNSAFE_SED_RE.search(argument) for argument in arguments)
+    if program == 'awk':
+        return any(PLAN_UNSAFE_AWK_RE.search(argument) for argument in arguments)
+    if program == 'curl':
+        return curl_request_method(arguments).upper() not in ("GET", "HEAD")
+    if program == 'ip':
+        return bool({'add', 'del', 'delete', 'set', 'flush', 'change', 'replace', 'append'}
+                    & set(positional))
+    if program == 'ping':
+        return 'c' not in short_flags(arguments) and "--count" not in arguments
+    if program == 'hostname':
+        return bool(positional)
+    if program == 'uniq':
+        return len(positional) > 1   # `uniq entrada salida` escribe en el segundo fichero
+    if program == 'mount':
+        return bool(arguments)
+    if program == 'docker':
+        return positional[:1] == ['stats'] and "--no-stream" not in arguments
+    return False
+
+
+def is_read_only_command(command: str) -> bool:
+    """Comprueba que todos los tramos del comando (tuberías, ;, &&, ||) solo consultan.
+
+    Rechaza lo que no se puede validar tramo a tramo: saltos de línea, `&` suelto,
+    sustituciones $( ) y `...`, <( ) y redirecciones a fichero. Los tramos se
+    separan con shlex para respetar las comillas.
+    """
+    if PLAN_UNSAFE_SHELL_RE.search(command):
+        return False
+    lexer = shlex.shlex(PLAN_ALLOWED_REDIRECTS_RE.sub(" ", command), posix=True,
+                        punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        tokens = list(lexer)
+    except ValueError:
+        return False  # comillas sin cerrar
+
+    segments, words = [], []
+    for token in tokens:
+        if token in PLAN_SEGMENT_OPERATORS:
+            segments.append(words)
+            words = []
+        elif token == "<":
+            continue  # `sort < f` lee igual que `sort f`
+        elif token and all(char in "();<>|&" for char in token):
+            return False  # &, >, >>, subshells...
+        else:
+            words.append(token)
+    segments.append(words)
+
+    for words in segments:
+        while words and (words[0] == "sudo" or re.match(r"^\w+=", words[0])):
+            words.pop(0)
+        if not words:
+            continue
+        program, arguments = words[0], words[1:]
+        if program not in PLAN_READ_ONLY_COMMANDS:
+            return False
+        positional = [word for word in arguments if not word.startswith('-')]
+        subcommands = PLAN_READ_ONLY_SUBCOMMANDS.get(program)
+        if subcommands is not None and (not positional or positional[0] not in subcommands):
+            return False
+        nested = PLAN_READ_ONLY_NESTED.get((program, positional[0])) if positional else None
+        if nested is not None and (len(positional) < 2 or positional[1] not in nested):
+            return False
+        if has_unsafe_arguments(program, arguments, positional):
+            return False
+    return True
+
+
+# Intentos de generación (los usa el benchmark de comandos)
+COMMAND_GENERATION_STATS = {"requests": 0, "retries": 0, "failures": 0}
+
+
+def validate_command_object(obj: Any) -> dict:
+    """Valida la respuesta del modelo contra COMMAND_SCHEMA y normaliza los tipos.
+
+    Lanza ValueError con el motivo del rechazo, que se reenvía al modelo en el reintento.
+    """
+    if not isinstance(obj, dict):
+        raise ValueError("la respuesta no es un objeto JSON")
+    command = obj.get("command")
+    if not isinstance(command, str) or not command.strip():
+        raise ValueError("falta 'command' o está vacío")
+    if any(placeholder in command for placeholder in COMMAND_PLACEHOLDERS):
+        raise ValueError(f"'command' usa un placeholder: {command}")
+    dangerous = obj.get("dangerous", False)
+    if isinstance(dangerous, str):
+        dangerous = dangerous.strip().lower() in ("true", "sí", "si", "yes", "1")
+    result = {
+        "command": command.strip(),
+        "explanation": str(obj.get("explanation") or "").strip(),
+        "dangerous": bool(dangerous),
+        "reasoning": str(obj.get("reasoning") or "").strip(),
+    }
+
+    plan = obj.get("plan")
+    if PLAN_MODE_ENABLED and isinstance(plan, list):
+        steps, after = parse_plan_steps(plan)
+        if len(steps) > PLAN_MAX_STEPS:
+            raise ValueError(f"el plan tiene {len(steps)} pasos (máximo {PLAN_MAX_STEPS})")
+        read_only = [is_read_only_command(step) for step in steps]
+        for step, step_read_only in zip(steps, read_only):
+            if any(placeholder in step for placeholder in COMMAND_PLACEHOLDERS):
+                raise ValueError(f"un paso del plan usa un placeholder: {step}")
+            if not step_read_only:
+                raise ValueError(f"el plan solo admite comandos de solo lectura y '{step}' no lo es")
+        if len(steps) > 1:
+            # La validación nunca rebaja el aviso del modelo
+            result.update(command=steps[0], plan=steps,
+                          dangerous=result["dangerous"] or not all(read_only))
+            if any(after):
+                result["plan_after"] = after
+    return result
+
+
+def parse_plan_steps(plan: List[Any]) -> tuple[List[str], List[List[int]]]:
+    """Normaliza los pasos del plan: texto o {"command", "after": [pasos previos, desde 1]}.
+
+    Devuelve los comandos y, por paso, los índices (desde 0) de los que depende.
+    """
+    steps, after = [], []
+    for item in plan:
+        command, requires = (item.get("command"), item.get("after") or []) if isinstance(item, dict) else (item, [])
+        if not isinstance(command, str) or not command.strip():
+            continue
+        if not isinstance(requires, list) or not all(isinstance(n, int) and 1 <= n <= len(steps) for n in requires):
+            raise ValueError(f"'after' del paso {len(steps) + 1} debe referirse a pasos anteriores")
+        steps.append(command.strip())
+        after.append(sorted({n - 1 for n in requires}))
+    return steps, after
+
+
 def clean_json_response(content: str) -> str:
     """Limpia la respuesta del modelo para extraer solo el JSON"""
     content = content.strip()
@@ -562,154 +2582,867 @@ def clean_json_response(content: str) -> str:
     return content
 
 
+# ==========================
+# CACHÉ DE COMANDOS
+# ==========================
+
+# Peticiones que se refieren a turnos anteriores ("sus logs", "ese contenedor"):
+# su comando depende de la conversación y no se busca ni se guarda en las cachés
+CACHE_BACKREFERENCE_RE = re.compile(
+    r"\b(?:sus?|es[aeo]s?|aquel(?:l[ao]s?)?|anterior(?:es)?|antes|ahi|ello"
+    r"|(?:el|la|lo) mism[ao]|otra vez|de nuevo)\b"
+)
+
+
+class CommandCache:
+    """Caché persistente (SQLite) con expiración TTL y desalojo LRU de comandos generados.
+
+    La clave combina la petición normalizada con una huella del contexto que
+    influye en la generación (información extraída, inventario, modelo, versión
+    del prompt y sudo). La memoria de la conversación no forma parte de la clave:
+    las peticiones que dependen de ella no se cachean (ver `is_cacheable`).
+    """
+    def __init__(self, path: str = COMMAND_CACHE_PATH, ttl: int = COMMAND_CACHE_TTL,
+                 max_entries: int = COMMAND_CACHE_MAX_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS command_cache (
+                    key TEXT PRIMARY KEY,
+                    request TEXT NOT NULL,
+                    response TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._conn.commit()
+        return self._conn
+
+    @staticmethod
+    def normalize_request(text: str) -> str:
+        """Minúsculas, sin tildes, sin puntuación sobrante y con espacios colapsados"""
+        text = unicodedata.normalize("NFKD", text.lower())
+        text = "".join(ch for ch in text if not unicodedata.combining(ch))
+        text = re.sub(r"[^\w\s\-./:|]", " ", text)
+        return " ".join(text.split()).strip(".: ")
+
+    @classmethod
+    def is_cacheable(cls, user_request: str) -> bool:
+        """Si la petición se entiende sola, sin los turnos anteriores de la conversación"""
+        return not CACHE_BACKREFERENCE_RE.search(cls.normalize_request(user_request))
+
+    @staticmethod
+    def context_fingerprint() -> str:
+        inventory = INVENTORY.prompt_section() if INVENTORY else ""
+        relevant = {
+            "extracted_info": conversation_context["extracted_info"],
+            "inventory": hashlib.sha256(inventory.encode("utf-8")).hexdigest(),
+            "model": OLLAMA_MODEL,
+            "prompt_version": SYSTEM_PROMPT_VERSION,
+            "sudo": USE_SUDO,
+        }
+        return hashlib.sha256(json.dumps(relevant, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def make_key(self, user_request: str) -> str:
+        raw = self.normalize_request(user_request) + "\x00" + self.context_fingerprint()
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, user_request: str) -> dict | None:
+        key = self.make_key(user_request)
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                row = conn.execute(
+                    "SELECT response, created_at FROM command_cache WHERE key = ?", (key,)
+                ).fetchone()
+                if row and now - row[1] <= self.ttl:
+                    conn.execute(
+                        "UPDATE command_cache SET last_used = ?, hits = hits + 1 WHERE key = ?",
+                        (now, key),
+                    )
+                    conn.commit()
+                    self.hits += 1
+                    return json.loads(row[0])
+                if row:
+                    conn.execute("DELETE FROM command_cache WHERE key = ?", (key,))
+                    conn.commit()
+        except (sqlite3.Error, OSError, json.JSONDecodeError):
+            pass
+        self.misses += 1
+        return None
+
+    def put(self, user_request: str, cmd_obj: dict):
+        key = self.make_key(user_request)
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._connect()
+                conn.execute(
+                    "INSERT OR REPLACE INTO command_cache (key, request, response, created_at, last_used, hits) "
+                    "VALUES (?, ?, ?, ?, ?, 0)",
+                    (key, self.normalize_request(user_request), json.dumps(cmd_obj), now, now),
+                )
+                conn.execute("DELETE FROM command_cache WHERE created_at < ?", (now - self.ttl,))
+                conn.execute(
+                    "DELETE FROM command_cache WHERE key NOT IN "
+                    "(SELECT key FROM command_cache ORDER BY last_used DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+                conn.commit()
+        except (sqlite3.Error, OSError):
+            pass
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+COMMAND_CACHE = CommandCache()
+
+
+# ==========================
+# CACHÉ SEMÁNTICA (EMBEDDINGS)
+# ==========================
+
+class SemanticCache:
+    """Caché de comandos aprobados indexada por embeddings de la petición.
+
+    Encuentra paráfrasis ("muestra los logs del frontend" ~ "revisa el log del
+    contenedor frontend") por similitud coseno. Los vectores normalizados viven
+    en `vectors.npy` y los metadatos en `entries.json`; solo se comparan entradas
+    con la misma huella de contexto que la caché exacta. Los aciertos solo
+    actualizan la memoria: se escriben al guardar una entrada nueva o con `flush`
+    al terminar la sesión (menos escrituras en la tarjeta SD).
+    """
+    HISTOGRAM_BINS = 20
+
+    def __init__(self, path: str = SEMANTIC_CACHE_DIR, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+                 max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES, model: str = OLLAMA_EMBED_MODEL):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.model = model
+        self.available = np is not None
+        self.hits = 0
+        self.misses = 0
+        self.histogram = [0] * self.HISTOGRAM_BINS   # mejor similitud de cada consulta
+        self._vectors = None
+        self._entries = None
+        self._last_query = (None, None)              # (petición normalizada, vector)
+        self._dirty = False                          # aciertos aún sin escribir
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._entries is not None:
+            return
+        self._entries = []
+        self._vectors = None
+        try:
+            with open(os.path.join(self.path, "entries.json"), encoding="utf-8") as f:
+                entries = json.load(f)
+            vectors = np.load(os.path.join(self.path, "vectors.npy"))
+            if len(entries) == len(vectors):
+                self._entries, self._vectors = entries, vectors
+        except (OSError, ValueError):
+            pass
+
+    def _save(self):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # Escritura atómica: primero a temporales, luego os.replace
+            vectors_tmp = os.path.join(self.path, "vectors.tmp.npy")
+            entries_tmp = os.path.join(self.path, "entries.json.tmp")
+            np.save(vectors_tmp, self._vectors)
+            with open(entries_tmp, "w", encoding="utf-8") as f:
+                json.dump(self._entries, f, ensure_ascii=False)
+            os.replace(vectors_tmp, os.path.join(self.path, "vectors.npy"))
+            os.replace(entries_tmp, os.path.join(self.path, "entries.json"))
+        except OSError as e:
+            # Disco lleno o de solo lectura: la caché sigue funcionando en memoria
+            print_warning(f"No se pudo guardar la caché semántica: {e}")
+            return
+        self._dirty = False
+
+    def flush(self):
+        """Escribe los aciertos pendientes (last_used, hits)"""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def _embed(self, text: str):
+        """Vector normalizado de la petición (se reutiliza si es la última consultada)"""
+        if self._last_query[0] == text:
+            return self._last_query[1]
+        try:
+            vector = np.asarray(OLLAMA_CLIENT.embed(text, self.model), dtype=np.float32)
+        except (requests.exceptions.RequestException, KeyError, ValueError) as e:
+            self.available = False
+            print_warning(f"Caché semántica desactivada: sin embeddings de {self.model} ({e})")
+            return None
+        norm = np.linalg.norm(vector)
+        if norm == 0:
+            return None
+        vector /= norm
+        self._last_query = (text, vector)
+        return vector
+
+    def get(self, user_request: str) -> tuple[dict | None, float]:
+        """Devuelve (respuesta, similitud) si hay una entrada por encima del umbral"""
+        if not self.available:
+            return None, 0.0
+        text = CommandCache.normalize_request(user_request)
+        query = self._embed(text)
+        if query is None:
+            return None, 0.0
+
+        with self._lock:
+            self._load()
+            context = CommandCache.context_fingerprint()
+            best, best_sim = None, 0.0
+            if self._entries:
+                sims = self._vectors @ query
+                mask = np.array([entry["context"] == context for entry in self._entries])
+                if mask.any():
+                    sims = np.where(mask, sims, -1.0)
+                    best = int(np.argmax(sims))
+                    best_sim = float(sims[best])
+
+            bin_index = min(int(max(best_sim, 0.0) * self.HISTOGRAM_BINS), self.HISTOGRAM_BINS - 1)
+            self.histogram[bin_index] += 1
+            if best is None or best_sim < self.threshold:
+                self.misses += 1
+                return None, best_sim
+
+            entry = self._entries[best]
+            entry["last_used"] = time.time()
+            entry["hits"] += 1
+            self.hits += 1
+            self._dirty = True
+            return json.loads(entry["response"]), best_sim
+
+    def put(self, user_request: str, response: dict):
+        """Guarda un comando aprobado por el usuario (expulsa el menos usado si se llena)"""
+        if not self.available:
+            return
+        text = CommandCache.normalize_request(user_request)
+        vector = self._embed(text)
+        if vector is None:
+            return
+        now = time.time()
+        entry = {
+            "request": text,
+            "response": json.dumps({k: v for k, v in response.items() if k != "source"}, ensure_ascii=False),
+            "context": CommandCache.context_fingerprint(),
+            "created_at": now,
+            "last_used": now,
+            "hits": 0,
+        }
+
+        with self._lock:
+            self._load()
+            for i, existing in enumerate(self._entries):
+                if existing["request"] == text and existing["context"] == entry["context"]:
+                    self._entries[i] = entry
+                    self._vectors[i] = vector
+                    break
+            else:
+                self._entries.append(entry)
+                row = vector[np.newaxis, :]
+                self._vectors = row if self._vectors is None else np.vstack([self._vectors, row])
+
+            if len(self._entries) > self.max_entries:
+                keep = sorted(range(len(self._entries)),
+                              key=lambda i: self._entries[i]["last_used"])[-self.max_entries:]
+                keep.sort()
+                self._entries = [self._entries[i] for i in keep]
+                self._vectors = self._vectors[keep]
+            self._save()
+
+    def histogram_lines(self) -> List[str]:
+        """Histograma de la mejor similitud por consulta, para ajustar el umbral"""
+        lines = []
+        total = sum(self.histogram)
+        width = 1 / self.HISTOGRAM_BINS
+        threshold_bin = min(round(self.threshold * self.HISTOGRAM_BINS, 6), self.HISTOGRAM_BINS - 1)
+        for i, count in enumerate(self.histogram):
+            if not count:
+                continue
+            low = i * width
+            marker = " ◀ umbral" if i == int(threshold_bin) else ""
+            bar = "█" * max(1, round(30 * count / total))
+            lines.append(f"{low:.2f}-{low + width:.2f} {bar} {count}{marker}")
+        return lines
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+SEMANTIC_CACHE = SemanticCache()
+
+
+# ==========================
+# RUTA RÁPIDA: ENRUTADOR DE INTENCIONES LOCAL
+# ==========================
+
+INTENT_CONTAINERS = r"\b(?:contenedores|containers)\b|\bdocker ps\b"
+# Peticiones que incluyen contenedores parados: `docker ps` sin -a los ocultaría
+INTENT_ALL_CONTAINERS = (r"\b(?:todos|todas|parados|detenidos|apagados|fallaron|fallidos|caidos"
+                         r"|muertos|terminados|salieron|exited|stopped)\b|\bdocker ps (?:-a|--all)\b")
+
+# (nombre, patrón sobre la petición normalizada, plantilla, explicación, ámbito)
+# Ámbito: "host" (se descarta si la petición habla de un contenedor), "docker",
+# o "container" (solo vale si se identifica un contenedor conocido).
+INTENT_RULES = [
+    ("listar_contenedores", rf"^(?!.*(?:{INTENT_ALL_CONTAINERS})).*(?:{INTENT_CONTAINERS})",
+     "docker ps", "Lista los contenedores en ejecución", "docker"),
+    ("listar_todos_contenedores", rf"^(?=.*(?:{INTENT_ALL_CONTAINERS})).*(?:{INTENT_CONTAINERS})",
+     "docker ps -a", "Lista todos los contenedores, también los parados", "docker"),
+    ("logs_contenedor", r"\b(?:logs?|registros?)\b",
+     "docker logs --tail {lines} {container}", "Muestra las últimas {lines} líneas de log de {container}", "container"),
+    ("estado_contenedor", r"\b(?:estado|status|corriendo|ejecutandose|funcionando)\b",
+     "docker ps -a --filter name={container}", "Muestra el estado del contenedor {container}", "container"),
+    ("estado_servicio", r"\b(?:estado|status)\b.*\bservicio\s+(?:de\s+|del\s+)?(?P<service>[a-z0-9@._-]+)$",
+     "systemctl status {service} --no-pager", "Muestra el estado del servicio {service}", "host"),
+    ("uso_disco", r"\b(?:disco|espacio|almacenamiento)\b",
+     "df -h", "Muestra el uso de disco por sistema de archivos", "host"),
+    ("memoria", r"\b(?:memoria|ram)\b",
+     "free -h", "Muestra la memoria usada y libre", "host"),
+    ("puertos", r"\bpuertos?\b",
+     "ss -tulpn", "Lista los puertos TCP/UDP en escucha", "host"),
+    ("temperatura", r"\btemperatura\b",
+     "vcgencmd measure_temp", "Muestra la temperatura de la CPU", "host"),
+]
+
+# Verbos que cambian el sistema o piden razonamiento, y matices que ninguna
+# plantilla recoge (ventana de tiempo, filtro, tamaño): siempre van al modelo
+INTENT_VETO_RE = re.compile(
+    r"\b(?:borra\w*|elimina\w*|limpia\w*|reinici\w*|para|deten(?:er|lo|la|los|las|ga|gan)?|"
+    r"instala\w*|actualiza\w*|cambia\w*|modifica\w*|crea\w*|mata\w*|configura\w*|"
+    r"por que|porque|como|si|"
+    r"desde|hasta|ayer|hoy|horas?|minutos?|segundos?|dias?|semanas?|"
+    r"errore?s?|warnings?|avisos?|busca\w*|filtra\w*|contien\w*|"
+    r"tamano|ocupa\w*|pesa\w*|cuanto)\b"
+)
+INTENT_MAX_WORDS = 12
+INTENT_FUZZY_CUTOFF = 0.75   # similitud mínima (difflib) con un contenedor conocido
+INTENT_FUZZY_MARGIN = 0.1    # ventaja mínima sobre el segundo candidato
+
+
+class IntentRouter:
+    """Resuelve peticiones frecuentes a comandos sin pasar por el LLM.
+
+    Solo responde cuando exactamente una regla encaja sin ambigüedad; en
+    cualquier otro caso devuelve None y la petición sigue hacia la caché y Ollama.
+    """
+    def __init__(self, rules=INTENT_RULES, fuzzy_cutoff: float = INTENT_FUZZY_CUTOFF):
+        self.rules = [(name, re.compile(pattern), template, explanation, scope)
+                      for name, pattern, template, explanation, scope in rules]
+        self.fuzzy_cutoff = fuzzy_cutoff
+        self.hits = 0
+        self.misses = 0
+
+    def match_container(self, text: str, containers: Dict[str, str]) -> str | None:
+        """Busca en la petición el contenedor conocido más parecido (por nombre, partes o tipo)"""
+        aliases = {}
+        for container_type, name in containers.items():
+            for alias in [name, container_type, *re.split(r"[-_.]", name)]:
+                if len(alias) >= 3:
+                    aliases.setdefault(alias.lower(), set()).add(name)
+
+        scores = {}
+        for word in text.split():
+            if len(word) < 3:
+                continue
+            for alias in difflib.get_close_matches(word, aliases, n=3, cutoff=self.fuzzy_cutoff):
+                ratio = difflib.SequenceMatcher(None, word, alias).ratio()
+                for name in aliases[alias]:
+                    scores[name] = max(scores.get(name, 0.0), ratio)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+        if not ranked:
+            return None
+        if len(ranked) > 1 and ranked[0][1] - ranked[1][1] < INTENT_FUZZY_MARGIN:
+            return None
+        return ranked[0][0]
+
+    def route(self, user_request: str, containers: Dict[str, str] | None = None) -> dict | None:
+        text = CommandCache.normalize_request(user_request)
+        result = self._resolve(text, containers or {})
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def _resolve(self, text: str, containers: Dict[str, str]) -> dict | None:
+        if len(text.split()) > INTENT_MAX_WORDS or INTENT_VETO_RE.search(text):
+            return None
+
+        container = self.match_container(text, containers) if containers else None
+        mentions_container = container is not None or re.search(r"\bcontenedor\b|\bdocker\b", text)
+
+        candidates = []
+        for name, pattern, template, explanation, scope in self.rules:
+            match = pattern.search(text)
+            if not match:
+                continue
+            if scope == "container" and container is None:
+                continue
+            if scope == "host" and mentions_container:
+                continue
+            fields = {"lines": 100, "container": container, **match.groupdict()}
+            lines = re.search(r"\bultimas?\s+(\d+)\b", text)
+            if lines:
+                fields["lines"] = int(lines.group(1))
+            candidates.append((name, template.format(**fields), explanation.format(**fields)))
+
+        if len(candidates) != 1:
+            return None
+        name, command, explanation = candidates[0]
+        return {
+            "command": command,
+            "explanation": explanation,
+            "dangerous": False,
+            "reasoning": f"Regla local '{name}'" + (f" (contenedor {container})" if container else ""),
+            "source": "ruta rápida",
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+INTENT_ROUTER = IntentRouter()
+
+
 def ask_ollama_for_command(user_request: str) -> dict:
+    """Pide a Ollama que genere el comando a ejecutar (consultando antes la ruta rápida y la caché)"""
+    if INTENT_ROUTER_ENABLED:
+        routed = INTENT_ROUTER.route(user_request, conversation_context["extracted_info"].get("containers"))
+        if routed is not None:
+            return routed
+
+    # "muestra sus logs" depende de lo hablado antes: se genera siempre de nuevo
+    cacheable = CommandCache.is_cacheable(user_request)
+    if COMMAND_CACHE_ENABLED and cacheable:
+        cached = COMMAND_CACHE.get(user_request)
+        if cached is not None:
+            return dict(cached, source="caché")
+
+    if SEMANTIC_CACHE_ENABLED and cacheable:
+        cached, similarity = SEMANTIC_CACHE.get(user_request)
+        if cached is not None:
+            return dict(cached, source=f"caché semántica ({similarity:.2f})")
+
+    cmd_obj = generate_command_with_ollama(user_request)
+    # Los comandos peligrosos no se cachean: siempre pasan de nuevo por el modelo
+    if (COMMAND_CACHE_ENABLED and cacheable and cmd_obj is not None
+            and not cmd_obj.get("dangerous", False)):
+        COMMAND_CACHE.put(user_request, cmd_obj)
+    return cmd_obj
+
+
+def render_generation_context() -> str:
+    """Contexto variable que acompaña a la petición al generar el comando"""
+    # Inventario: descubrimiento en segundo plano más las salidas estructuradas
+    context_info = INVENTORY.prompt_section() if INVENTORY else ""
+
+    memory = MEMORY.render(MEMORY_COMMAND_TOKENS)
+    if memory:
+        context_info += f"\n**CONVERSACIÓN HASTA AHORA:**\n{memory}\n"
+    return context_info
+
+
+def generate_command_with_ollama(user_request: str) -> dict:
     """Pide a Ollama que genere el comando a ejecutar"""
 
-    def build_context_prompt():
-        """Construye el prompt considerando el contexto de conversación"""
-        base_prompt = get_system_prompt()
-        
-        # Agregar información extraída del contexto
-        context_info = ""
-        if conversation_context["extracted_info"].get("containers"):
-            containers = conversation_context["extracted_info"]["containers"]
-            context_info += f"\n\n**CONTENEDORES CONOCIDOS:**\n"
-            for container_type, container_name in containers.items():
-                context_info += f"- {container_type}: {container_name}\n"
-        
-        if conversation_context["last_output"]:
-            context_info += f"\n**ÚLTIMA SALIDA (resumen):**\n{conversation_context['last_output'][:500]}..."
-        
-        if context_info:
-            base_prompt += f"""
-
-**INFORMACIÓN ACTUAL DEL SISTEMA:**{context_info}
-
-**RECUERDA:** Usa los nombres EXACTOS de los contenedores mostrados arriba.
-"""
+    def build_context_message(instruction: str) -> str:
+        """Mensaje de usuario con el contexto variable del turno seguido de la instrucción"""
+        context_info = render_generation_context()
+        if not context_info:
+            return instruction
+        return f"""**INFORMACIÓN ACTUAL DEL SISTEMA:**{context_info}
 
-        return base_prompt
+**RECUERDA:** Usa los nombres EXACTOS de los contenedores y servicios mostrados arriba.
 
-    def call_ollama() -> str:
-        system_msg = build_context_prompt()
+{instruction}"""
+
+    def call_ollama(instruction: str) -> str:
+        """Genera en streaming y corta en cuanto el JSON del comando está completo"""
         payload = {
             "model": OLLAMA_MODEL,
-            "stream": False,
             "messages": [
-                {"role": "system", "content": system_msg},
-                {
-                    "role": "user", 
-                    "content": f"Instrucción: {user_request}\n\nResponde SOLO con el JSON requerido:"
-                },
+                {"role": "system", "content": get_system_prompt()},
+                {"role": "user", "content": build_context_message(instruction)},
             ],
         }
-        
+        if COMMAND_SCHEMA_ENABLED:
+            payload["format"] = COMMAND_SCHEMA
+
+        extractor = IncrementalJSONExtractor()
         try:
-            resp = requests.post(OLLAMA_URL, json=payload, timeout=120)
-            resp.raise_for_status()
-            data = resp.json()
-            return data["message"]["content"].strip()
+            return ollama_chat(payload, stop_when=lambda piece: extractor.feed(piece) is not None)
         except Exception as e:
             print_error(f"Error al llamar a Ollama: {e}")
             raise
 
-    def parse_response(content: str) -> dict | None:
-        """Intenta parsear la respuesta del modelo"""
+    def parse_response(content: str) -> dict:
+        """Extrae y valida el objeto del modelo; ValueError con el motivo si no sirve"""
         if not content:
-            return None
-            
-        # Limpiar la respuesta
-        cleaned = clean_json_response(content)
-        
-        # Intentar parsear como JSON
-        try:
-            obj = json.loads(cleaned)
-            if isinstance(obj, dict) and 'command' in obj:
-                # Validar que no use placeholders
-                command = obj.get('command', '')
-                if any(placeholder in command for placeholder in 
-                       ['[nombre]', '[id]', '[ruta]', 'container_name', 'nombre-del-contenedor']):
-                    return None
-                return obj
-        except json.JSONDecodeError:
-            pass
-            
-        return None
+            raise ValueError("respuesta vacía")
+
+        # Primer objeto balanceado con 'command' (ignora lo que venga después)
+        obj = IncrementalJSONExtractor().feed(content)
+        if obj is None:
+            # Limpiar la respuesta
+            cleaned = clean_json_response(content)
+            try:
+                obj = json.loads(cleaned)
+            except json.JSONDecodeError:
+                raise ValueError("no era JSON válido") from None
+        return validate_command_object(obj)
 
-    # Primer intento
+    COMMAND_GENERATION_STATS["requests"] += 1
     try:
-        content1 = call_ollama()
-        cmd_obj = parse_response(content1)
-        
-        if cmd_obj is not None:
-            return cmd_obj
+        # Primer intento
+        content1 = call_ollama(f"Instrucción: {user_request}\n\nResponde SOLO con el JSON requerido:")
+        try:
+            return parse_response(content1)
+        except ValueError as e:
+            reason = str(e)
 
-        print_warning("Primer intento falló - respuesta no válida")
+        print_warning(f"Primer intento falló - {reason}")
         print_output_block(content1, "RESPUESTA CRUDA")
-        
+
         # Segundo intento con instrucciones más estrictas
+        COMMAND_GENERATION_STATS["retries"] += 1
         print_info("Reintentando con instrucciones más estrictas...")
-        strict_prompt = get_system_prompt() + """
-
-**ERROR CRÍTICO - SEGUNDO INTENTO:**
-Tu respuesta anterior fue rechazada porque:
-- NO era JSON válido O
-- Usaba placeholders como [nombre] O  
-- Incluía texto adicional fuera del JSON
+        # El aviso va en el mensaje de usuario para no romper el prefijo cacheado
+        strict_instruction = f"""**ERROR CRÍTICO - SEGUNDO INTENTO:**
+Tu respuesta anterior fue rechazada porque {reason}.
+Recuerda: nada de placeholders como [nombre] ni texto fuera del JSON.
 
 **RESPONDE EXACTAMENTE ASÍ:**
-{"command": "comando específico", "explanation": "breve explicación", "dangerous": false, "reasoning": "razonamiento"}
-"""
-        
-        payload = {
-            "model": OLLAMA_MODEL,
-            "stream": False,
-            "messages": [
-                {"role": "system", "content": strict_prompt},
-                {"role": "user", "content": f"Instrucción: {user_request}\n\nRESPONDE SOLO CON JSON:"},
-            ],
-        }
-        
-        content2 = requests.post(OLLAMA_URL, json=payload, timeout=120).json()["message"]["content"].strip()
-        cmd_obj = parse_response(content2)
-        
-        if cmd_obj is not None:
-            return cmd_obj
-
-        print_error("Segundo intento también falló")
-        return None
+{{"command": "comando específico", "explanation": "breve explicación", "dangerous": false, "reasoning": "razonamiento"}}
+
+Instrucción: {user_request}
+
+RESPONDE SOLO CON JSON:"""
+
+        content2 = call_ollama(strict_instruction)
+        try:
+            return parse_response(content2)
+        except ValueError as e:
+            print_error(f"Segundo intento también falló - {e}")
+            COMMAND_GENERATION_STATS["failures"] += 1
+            return None
 
     except Exception as e:
         print_error(f"Error en la comunicación: {e}")
+        COMMAND_GENERATION_STATS["failures"] += 1
         return None
 
 
-def connect_ssh(password: str | None = None) -> paramiko.SSHClient:
+# ==========================
+# CONEXIONES SSH E INVENTARIO DE HOSTS
+# ==========================
+
+def default_target() -> Dict[str, Any]:
+    """Host configurado en RPI_HOST/RPI_USER como entrada de inventario"""
+    return {
+        "name": RPI_HOST,
+        "host": RPI_HOST,
+        "user": RPI_USER,
+        "use_ssh_key": USE_SSH_KEY,
+        "ssh_key_path": SSH_KEY_PATH,
+        "tags": [],
+    }
+
+
+def connect_ssh(password: str | None = None, target: Dict[str, Any] | None = None,
+                quiet: bool = False) -> paramiko.SSHClient:
     """Abre una conexión SSH al servidor."""
+    target = target or default_target()
+    host, user = target["host"], target["user"]
     client = paramiko.SSHClient()
     client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
 
-    if USE_SSH_KEY:
-        print_info(f"Conectando a {RPI_USER}@{RPI_HOST} con clave SSH...")
+    if target.get("use_ssh_key"):
+        if not quiet:
+            print_info(f"Conectando a {user}@{host} con clave SSH...")
         client.connect(
-            RPI_HOST,
-            username=RPI_USER,
-            key_filename=SSH_KEY_PATH,
+            host,
+            username=user,
+            key_filename=target.get("ssh_key_path"),
             look_for_keys=False,
             allow_agent=True,
         )
     else:
-        print_info(f"Conectando a {RPI_USER}@{RPI_HOST} con contraseña...")
+        if not quiet:
+            print_info(f"Conectando a {user}@{host} con contraseña...")
         if password is None:
-            password = getpass.getpass(f"{BLUE}?{WHITE} Contraseña SSH ➜ {RESET}")
-        client.connect(RPI_HOST, username=RPI_USER, password=password)
-
-    print_success("Conexión SSH establecida")
+            # Solo se pregunta desde el hilo principal: los hilos del fan-out o del
+            # spinner pisarían el prompt y la animación
+            if threading.current_thread() is not threading.main_thread():
+                raise ValueError(f"falta la contraseña SSH de {user}@{host}")
+            password = getpass.getpass(f"{BLUE}?{WHITE} Contraseña SSH para {user}@{host} ➜ {RESET}")
+        client.connect(host, username=user, password=password)
+
+    if not quiet:
+        print_success("Conexión SSH establecida")
     return client
 
 
-def explain_output_with_ollama(command: str, stdout: str, stderr: str) -> str:
+class SSHConnectionPool:
+    """Conexiones SSH reutilizables por (host, usuario, autenticación).
+
+    Activa keepalives en el transporte, comprueba su salud antes de
+    reutilizarlo y reconecta de forma transparente si se ha caído.
+    """
+    def __init__(self, keepalive_interval: int = SSH_KEEPALIVE_INTERVAL):
+        self.keepalive_interval = keepalive_interval
+        self._lock = threading.Lock()
+        self._entries: Dict[tuple, Dict[str, Any]] = {}
+
+    @staticmethod
+    def make_key(target: Dict[str, Any]) -> tuple:
+        if target.get("use_ssh_key"):
+            return (target["host"], target["user"], "key", target.get("ssh_key_path") or "")
+        return (target["host"], target["user"], "password", "")
+
+    @staticmethod
+    def is_healthy(client: paramiko.SSHClient) -> bool:
+        transport = client.get_transport()
+        if transport is None or not transport.is_active() or not transport.is_authenticated():
+            return False
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+        return True
+
+    def acquire(self, target: Dict[str, Any], password: str | None = None,
+                quiet: bool = True) -> paramiko.SSHClient:
+        key = self.make_key(target)
+        with self._lock:
+            entry = self._entries.setdefault(key, {"client": None, "lock": threading.Lock()})
+
+        with entry["lock"]:
+            client = entry["client"]
+            if client is not None and not self.is_healthy(client):
+                if not quiet:
+                    print_warning(f"Conexión con {target['host']} caída, reconectando...")
+                client.close()
+                client = None
+
+            if client is None:
+                client = connect_ssh(password, target, quiet)
+                transport = client.get_transport()
+                if transport is not None and self.keepalive_interval > 0:
+                    transport.set_keepalive(self.keepalive_interval)
+                entry["client"] = client
+            return client
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            if entry["client"] is not None:
+                try:
+                    entry["client"].close()
+                except Exception:
+                    pass
+
+
+SSH_POOL = SSHConnectionPool()
+
+
+def load_host_inventory(path: str = HOST_INVENTORY_PATH) -> Dict[str, Any]:
+    """Carga el inventario JSON de hosts.
+
+    Formato:
+    {
+      "hosts": {"rpi-salon": {"host": "192.168.1.96", "user": "pi", "tags": ["docker"],
+                              "use_ssh_key": true, "ssh_key_path": "~/.ssh/id_ed25519"}},
+      "groups": {"produccion": ["rpi-salon", "rpi-garaje"]}
+    }
+    """
+    if not os.path.exists(path):
+        return {"hosts": {}, "groups": {}}
+
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+
+    hosts = {}
+    for name, entry in data.get("hosts", {}).items():
+        hosts[name] = {
+            "name": name,
+            "host": entry.get("host", name),
+            "user": entry.get("user", RPI_USER),
+            "use_ssh_key": entry.get("use_ssh_key", USE_SSH_KEY),
+            "ssh_key_path": os.path.expanduser(entry.get("ssh_key_path", SSH_KEY_PATH)),
+            "tags": entry.get("tags", []),
+        }
+    return {"hosts": hosts, "groups": data.get("groups", {})}
+
+
+def resolve_targets(selector: str, inventory: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Resuelve un selector ('all', grupo, 'tag:x', nombre de host; separados por comas)"""
+    hosts = inventory["hosts"]
+    selected: Dict[str, Dict[str, Any]] = {}
+
+    for token in filter(None, (t.strip() for t in selector.split(','))):
+        if token == "all":
+            names = list(hosts)
+        elif token.startswith("tag:"):
+            tag = token[4:]
+            names = [name for name, entry in hosts.items() if tag in entry["tags"]]
+        elif token in inventory["groups"]:
+            names = inventory["groups"][token]
+        elif token in hosts:
+            names = [token]
+        else:
+            raise ValueError(f"Host, grupo o tag desconocido: {token}")
+
+        for name in names:
+            if name not in hosts:
+                raise ValueError(f"El grupo hace referencia a un host inexistente: {name}")
+            selected[name] = hosts[name]
+
+    return list(selected.values())
+
+
+def split_fanout_request(user_request: str) -> tuple[str | None, str]:
+    """Separa '@selector petición' en (selector, petición)"""
+    if not user_request.startswith('@'):
+        return None, user_request
+    selector, _, rest = user_request[1:].partition(' ')
+    return selector, rest.strip()
+
+
+# ==========================
+# EJECUCIÓN EN PARALELO (FAN-OUT)
+# ==========================
+
+# Contraseñas SSH de los hosts del inventario sin clave, por (host, usuario)
+FLEET_PASSWORDS: Dict[tuple, str] = {}
+
+
+def collect_fleet_passwords(targets: List[Dict[str, Any]],
+                            default_password: str | None) -> Dict[str, str | None]:
+    """Pide en el hilo principal, antes del fan-out, la contraseña de cada host sin clave SSH.
+
+    La contraseña por defecto solo vale para RPI_USER@RPI_HOST; el resto se
+    pide una vez por host y usuario. Devuelve {nombre del host: contraseña}.
+    """
+    default_key = SSHConnectionPool.make_key(default_target())
+    if default_password is not None:
+        FLEET_PASSWORDS.setdefault(default_key, default_password)
+
+    passwords = {}
+    for target in targets:
+        if target.get("use_ssh_key"):
+            passwords[target["name"]] = None
+            continue
+        key = SSHConnectionPool.make_key(target)
+        if key not in FLEET_PASSWORDS:
+            FLEET_PASSWORDS[key] = getpass.getpass(
+                f"{BLUE}?{WHITE} Contraseña SSH para {target['user']}@{target['host']} ➜ {RESET}")
+        passwords[target["name"]] = FLEET_PASSWORDS[key]
+    return passwords
+
+
+def run_on_target(target: Dict[str, Any], command: str, password: str | None) -> Dict[str, Any]:
+    """Ejecuta el comando en un host del inventario usando el pool de conexiones"""
+    result = {"target": target, "exit_code": None, "time": 0.0,
+              "stdout": OutputCapture(), "stderr": OutputCapture(), "error": None}
+    start_time = time.time()
+    try:
+        client = SSH_POOL.acquire(target, password)
+        stdout, stderr, exit_code, exec_time = run_remote_command(client, command, quiet=True)
+        result.update(stdout=stdout, stderr=stderr, exit_code=exit_code, time=exec_time)
+    except paramiko.AuthenticationException as e:
+        # Se vuelve a pedir en la siguiente petición
+        FLEET_PASSWORDS.pop(SSHConnectionPool.make_key(target), None)
+        result.update(error=f"autenticación fallida: {e}", time=time.time() - start_time)
+    except Exception as e:
+        result.update(error=str(e), time=time.time() - start_time)
+    return result
+
+
+def run_fanout(targets: List[Dict[str, Any]], command: str,
+               passwords: Dict[str, str | None]) -> List[Dict[str, Any]]:
+    """Ejecuta el comando en paralelo (pool de hilos acotado); resultados en el orden de `targets`.
+
+    `passwords` viene de collect_fleet_passwords: los hilos nunca piden credenciales.
+    """
+    workers = max(1, min(FANOUT_MAX_WORKERS, len(targets)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(
+            lambda target: run_on_target(target, command, passwords.get(target["name"])), targets))
+
+
+def print_fanout_table(results: List[Dict[str, Any]]):
+    """Tabla resumen por host: estado, código de salida, tiempo y líneas"""
+    print(f"{BLUE}│{RESET}")
+    print(f"{BLUE}│{WHITE} {'HOST':<22} {'ESTADO':<12} {'CÓDIGO':>6} {'TIEMPO':>8} {'LÍNEAS':>8}{RESET}")
+    for result in results:
+        name = result["target"]["name"][:22]
+        if result["error"]:
+            status, color, code = "SIN CONEXIÓN", RED, "-"
+        elif result["exit_code"] == 0:
+            status, color, code = "ÉXITO", GREEN, "0"
+        else:
+            status, color, code = "FALLÓ", RED, str(result["exit_code"])
+        lines = result["stdout"].line_count + result["stderr"].line_count
+        print(f"{BLUE}│{RESET} {name:<22} {color}{status:<12}{RESET} {code:>6} "
+              f"{result['time']:>7.2f}s {lines:>8}")
+
+
+def combine_fanout_output(results: List[Dict[str, Any]]) -> tuple[str, str]:
+    """Une las salidas por host en un único texto para el análisis IA"""
+    stdout_parts, stderr_parts = [], []
+    for result in results:
+        name = result["target"]["name"]
+        if result["error"]:
+            stderr_parts.append(f"=== {name} (sin conexión) ===\n{result['error']}")
+            continue
+        stdout_parts.append(f"=== {name} (código {result['exit_code']}) ===\n{result['stdout'].text()}")
+        if result["stderr"]:
+            stderr_parts.append(f"=== {name} ===\n{result['stderr'].text()}")
+    return '\n\n'.join(stdout_parts), '\n\n'.join(stderr_parts)
+
+
+def explain_output_with_ollama(command: str, stdout: str, stderr: str,
+                               on_token: Callable[[str], None] | None = None) -> str:
     """Pide a Ollama que explique el resultado del comando"""
+    stdout, stderr = compress_command_output(stdout, stderr, ANALYSIS_CONTEXT_TOKENS)
     user_msg = f"""
 Analiza estos resultados técnicos:
 
@@ -730,7 +3463,6 @@ Sé conciso y técnico.
 
     payload = {
         "model": OLLAMA_MODEL,
-        "stream": False,
         "messages": [
             {"role": "system", "content": "Eres un experto DevOps. Analiza resultados técnicos de forma estructurada y práctica."},
             {"role": "user", "content": user_msg},
@@ -738,21 +3470,22 @@ Sé conciso y técnico.
     }
 
     try:
-        resp = requests.post(OLLAMA_URL, json=payload, timeout=120)
-        resp.raise_for_status()
-        data = resp.json()
-        return data["message"]["content"].strip()
+        return ollama_chat(payload, on_token)
     except Exception as e:
         return f"Error al generar análisis: {e}"
 
 
-def ask_followup_question(question: str, context: dict) -> str:
-    """Permite hacer preguntas de seguimiento"""
+def ask_followup_question(question: str, memory: ConversationMemory = MEMORY,
+                          on_token: Callable[[str], None] | None = None) -> str:
+    """Permite hacer preguntas de seguimiento (con la memoria de la conversación)"""
+    # Lo que el inventario sabe de lo mencionado en la pregunta o en los últimos comandos
+    related = INVENTORY.lookup(" ".join([question] + memory.recent_commands()))
+    inventory = "".join(f"\n- {record.summary()}" for record in related)
+    if inventory:
+        inventory = f"\n\nInventario relacionado:{inventory}"
     user_msg = f"""
 Contexto anterior:
-- Comando: {context['last_command']}
-- Salida: {context['last_output'][:800]}...
-- Análisis: {context['last_analysis'][:400]}...
+{memory.render(MEMORY_FOLLOWUP_TOKENS)}{inventory}
 
 Pregunta: {question}
 
@@ -761,7 +3494,6 @@ Responde basándote en el contexto anterior.
 
     payload = {
         "model": OLLAMA_MODEL,
-        "stream": False,
         "messages": [
             {"role": "system", "content": "Responde preguntas técnicas basándote en el contexto proporcionado."},
             {"role": "user", "content": user_msg},
@@ -769,23 +3501,437 @@ Responde basándote en el contexto anterior.
     }
 
     try:
-        resp = requests.post(OLLAMA_URL, json=payload, timeout=120)
-        resp.raise_for_status()
-        data = resp.json()
-        return data["message"]["content"].strip()
+        return ollama_chat(payload, on_token)
     except Exception as e:
         return f"Error: {e}"
 
 
+# ==========================
+# MODO PLAN: VARIOS COMANDOS EN UN SOLO CANAL
+# ==========================
+
+PLAN_SKIPPED_MESSAGE = "omitido: depende de un paso que falló"
+PLAN_CANCELLED_MESSAGE = "omitido: plan cancelado"
+
+
+def new_plan_results(steps: List[str]) -> List[Dict[str, Any]]:
+    return [{"command": step, "stdout": OutputCapture(), "stderr": OutputCapture(),
+             "exit_code": None, "time": None} for step in steps]
+
+
+def build_plan_script(steps: List[str], sentinel: str, non_interactive: bool = False,
+                      after: List[List[int]] | None = None) -> str:
+    """Script que ejecuta los pasos en orden, delimitados por líneas centinela.
+
+    Antes de cada paso se escribe "<centinela> N" en stdout y stderr, y al
+    terminar "<centinela> N rc=<código>" en stdout ("N skip" si un paso del que
+    depende falló). Cada paso va en un subshell sin stdin para que un `cd` o un
+    `exit` no afecte a los siguientes.
+    """
+    after = after or [[] for _ in steps]
+    parts = []
+    for index, step in enumerate(steps):
+        run = (f"( {wrap_command_with_sudo(step, non_interactive, step=index)} ) </dev/null; "
+               f"rc_{index}=$?; echo '{sentinel} {index} rc='$rc_{index}")
+        if after[index]:
+            condition = " && ".join(f'[ "$rc_{n}" = 0 ]' for n in after[index])
+            run = f"if {condition}; then {run}; else rc_{index}=1; echo '{sentinel} {index} skip'; fi"
+        parts.append(f"echo '{sentinel} {index}'; echo '{sentinel} {index}' >&2; {run}")
+    return "; ".join(parts)
+
+
+def collect_plan_output(channel: paramiko.Channel, steps: List[str], sentinel: str,
+                        live: bool = True, pty: bool = False) -> tuple[List[Dict[str, Any]], int, bool]:
+    """Reparte la salida del script entre los pasos según las líneas centinela.
+
+    Devuelve (resultados por paso, código de salida del canal, si llegó salida).
+    """
+    results = new_plan_results(steps)
+    marker = re.compile(rf"^{re.escape(sentinel)} (\d+)(?: rc=(\d+)| (skip))?$")
+    current = {"stdout": None, "stderr": None}
+    started = {}
+    on_line = print_live_line if live and STREAM_OUTPUT else None
+    try:
+        for stream, line in iter_channel_output(channel, pty=pty):
+            match = marker.match(line)
+            if match:
+                index = int(match.group(1))
+                if match.group(2) is not None:
+                    results[index]["exit_code"] = int(match.group(2))
+                    results[index]["time"] = time.time() - started[index]
+                    current["stdout"] = None
+                elif match.group(3):
+                    results[index]["stderr"].add(PLAN_SKIPPED_MESSAGE)
+                    current["stdout"] = None
+                elif current[stream] != index:
+                    current[stream] = index
+                    started.setdefault(index, time.time())
+                    if on_line and stream == "stdout":
+                        print(f"{BLUE}│{RESET} {MAGENTA}▶ [{index + 1}/{len(steps)}] {steps[index]}{RESET}")
+                continue
+            if current[stream] is None:
+                continue  # nada fuera de los pasos (p. ej. la prueba de sudo)
+            results[current[stream]][stream].add(line)
+            if on_line:
+                on_line(stream, line)
+        exit_code = channel.recv_exit_status()
+    except KeyboardInterrupt:
+        channel.close()
+        print_warning("Plan cancelado por el usuario (Ctrl+C)")
+        exit_code = -1
+    finally:
+        for result in results:
+            result["stdout"].close()
+            result["stderr"].close()
+    received = any(r["exit_code"] is not None or r["stdout"] or r["stderr"] for r in results)
+    return results, exit_code, received
+
+
+def run_plan(client: paramiko.SSHClient, steps: List[str], live: bool = True,
+             after: List[List[int]] | None = None) -> tuple[List[Dict[str, Any]], float]:
+    """Ejecuta los pasos del plan en una única sesión remota y devuelve los resultados por paso"""
+    sentinel = f"__rpi_agent_plan_{secrets.token_hex(4)}__"
+    collect = functools.partial(collect_plan_output, steps=steps, sentinel=sentinel, live=live)
+    build = functools.partial(build_plan_script, steps, sentinel, after=after)
+    start_time = time.time()
+
+    if USE_SUDO and SUDO_PASSWORD and any(wrap_command_with_sudo(step) != step for step in steps):
+        # Una sola contraseña para todo el plan: los pasos comparten terminal
+        results, _, rejected = SUDO_EXECUTOR.execute(
+            client, build, lambda channel, pty: collect(channel, pty=pty), quiet=not live)
+        if rejected:
+            for result in results:
+                if result["exit_code"] is None:
+                    result["stderr"].add("sudo: contraseña rechazada (revisa la contraseña sudo)")
+    else:
+        stdin, stdout, stderr = client.exec_command(build(False))
+        results, _, _ = collect(stdout.channel)
+    return results, time.time() - start_time
+
+
+def run_plan_parallel(client: paramiko.SSHClient, steps: List[str], after: List[List[int]] | None = None,
+                      max_channels: int = SSH_MAX_CHANNELS_PER_HOST,
+                      on_step: Callable[[int, Dict[str, Any]], None] | None = None
+                      ) -> tuple[List[Dict[str, Any]], float]:
+    """Ejecuta el plan como un grafo: cada paso en su propio canal del mismo transporte SSH.
+
+    Un paso arranca en cuanto terminan bien los pasos de los que depende (los
+    independientes, a la vez) sin superar `max_channels` canales abiertos; si
+    alguno falla, el paso se omite. Los resultados se devuelven en el orden del plan.
+    """
+    after = after or [[] for _ in steps]
+    results = new_plan_results(steps)
+    pending = list(range(len(steps)))
+    running: Dict[Any, int] = {}
+    start_time = time.time()
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_channels, len(steps))))
+    # Ctrl+C: en el hilo principal llega como KeyboardInterrupt; desde la sesión
+    # asíncrona, como canales cerrados por OPEN_CHANNELS.close_all
+    cancelled = threading.Event()
+    cancellations = OPEN_CHANNELS.cancelled
+
+    def run_step(index: int):
+        step_start = time.time()
+        if cancelled.is_set():
+            return OutputCapture(), OutputCapture(), -1, 0.0
+        stdout, stderr, exit_code, _ = run_remote_command(client, steps[index], quiet=True)
+        return stdout, stderr, exit_code, time.time() - step_start
+
+    try:
+        while pending or running:
+            if OPEN_CHANNELS.cancelled != cancellations:
+                cancelled.set()
+            if cancelled.is_set():
+                # No se lanza nada más: los pasos en marcha terminan al cerrarse su canal
+                for index in pending:
+                    results[index].update(time=0.0)
+                    results[index]["stderr"].add(PLAN_CANCELLED_MESSAGE)
+                pending.clear()
+            for index in list(pending):
+                if any(results[n]["exit_code"] is None and results[n]["time"] is None for n in after[index]):
+                    continue  # alguna dependencia sigue en marcha
+                pending.remove(index)
+                if any(results[n]["exit_code"] != 0 for n in after[index]):
+                    results[index].update(time=0.0)
+                    results[index]["stderr"].add(PLAN_SKIPPED_MESSAGE)
+                    if on_step:
+                        on_step(index, results[index])
+                    continue
+                running[executor.submit(run_step, index)] = index
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=running.get):
+                index = running.pop(future)
+                try:
+                    stdout, stderr, exit_code, elapsed = future.result()
+                    results[index].update(stdout=stdout, stderr=stderr, exit_code=exit_code, time=elapsed)
+                except Exception as e:
+                    results[index]["stderr"].add(f"Error: {e}")
+                    results[index]["time"] = 0.0
+                if on_step:
+                    on_step(index, results[index])
+    except KeyboardInterrupt:
+        cancelled.set()
+        # Cerrar los canales de los pasos en marcha detiene sus comandos remotos
+        OPEN_CHANNELS.close_all(client.get_transport())
+        print_warning("Plan cancelado por el usuario (Ctrl+C)")
+        for future in running:
+            future.cancel()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    return results, time.time() - start_time
+
+
+def print_plan_table(results: List[Dict[str, Any]]):
+    """Tabla resumen por paso: código de salida, tiempo y líneas"""
+    print(f"{BLUE}│{RESET}")
+    print(f"{BLUE}│{WHITE} {'#':>2} {'COMANDO':<44} {'CÓDIGO':>6} {'TIEMPO':>8} {'LÍNEAS':>7}{RESET}")
+    for index, result in enumerate(results, 1):
+        code = result["exit_code"]
+        color = GREEN if code == 0 else RED
+        lines = result["stdout"].line_count + result["stderr"].line_count
+        command = result["command"] if len(result["command"]) <= 44 else result["command"][:41] + "..."
+        elapsed = "-" if result["time"] is None else f"{result['time']:.2f}s"
+        print(f"{BLUE}│{RESET} {index:>2} {command:<44} {color}{'-' if code is None else code:>6}{RESET} "
+              f"{elapsed:>8} {lines:>7}")
+
+
+def combine_plan_output(results: List[Dict[str, Any]]) -> tuple[str, str]:
+    """Une las salidas de los pasos para un único análisis, repartiendo el presupuesto de tokens"""
+    budget = ANALYSIS_CONTEXT_TOKENS // max(1, len(results)) - 20  # margen para las cabeceras
+    stdout_parts, stderr_parts = [], []
+    for index, result in enumerate(results, 1):
+        code = "sin terminar" if result["exit_code"] is None else f"código {result['exit_code']}"
+        stdout, stderr = compress_command_output(result["stdout"].text(), result["stderr"].text(), budget)
+        stdout_parts.append(f"=== [{index}] {result['command']} ({code}) ===\n{stdout}")
+        if stderr.strip():
+            stderr_parts.append(f"=== [{index}] {result['command']} ===\n{stderr}")
+    return '\n\n'.join(stdout_parts), '\n\n'.join(stderr_parts)
+
+
+# ==========================
+# NÚCLEO ASÍNCRONO
+# ==========================
+
+def run_in_daemon_thread(func: Callable, *args, **kwargs) -> asyncio.Future:
+    """Ejecuta una función bloqueante en un hilo daemon y devuelve un future del bucle actual.
+
+    A diferencia de asyncio.to_thread, el hilo no retrasa la salida del programa
+    si la sesión se interrumpe mientras espera (input(), Ollama, SSH).
+    """
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve(setter, value):
+        if not future.done():
+            setter(value)
+
+    def run():
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            outcome = (future.set_exception, e)
+        else:
+            outcome = (future.set_result, result)
+        try:
+            loop.call_soon_threadsafe(resolve, *outcome)
+        except RuntimeError:  # el bucle ya se cerró
+            pass
+
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+async def spin(message: str):
+    """Spinner como tarea asyncio: anima hasta que se cancela"""
+    for char in itertools.cycle(SPINNER_CHARS):
+        sys.stdout.write(f"\r{BLUE}│{RESET} {CYAN}{char} {message}{RESET}")
+        sys.stdout.flush()
+        await asyncio.sleep(0.1)
+
+
+async def run_with_spinner(message: str, func: Callable, *args, **kwargs):
+    """Versión asíncrona de print_loading: el spinner es una tarea y `func` corre en un hilo"""
+    spinner = asyncio.create_task(spin(message))
+    status = "Error!"
+    try:
+        result = await run_in_daemon_thread(func, *args, **kwargs)
+        status = "Listo!"
+        return result
+    except asyncio.CancelledError:
+        status = None
+        raise
+    finally:
+        spinner.cancel()
+        sys.stdout.write("\r" + " " * 80 + "\r")
+        if status:
+            print(f"{BLUE}│{RESET} {GREEN}✓ {status}{RESET}")
+
+
+async def run_cancellable(message: str, func: Callable, *args, **kwargs):
+    """Ejecuta en un hilo una función que lee canales SSH sin bloquear el bucle.
+
+    Mientras corre, Ctrl+C cierra los canales abiertos (el comando remoto
+    termina y la función devuelve lo leído hasta entonces) en vez de
+    interrumpir la sesión. `message` se muestra al cancelar.
+    """
+    loop = asyncio.get_running_loop()
+    cancelled = False
+
+    def on_interrupt():
+        nonlocal cancelled
+        cancelled = True
+        OPEN_CHANNELS.close_all()
+
+    try:
+        loop.add_signal_handler(signal.SIGINT, on_interrupt)
+        installed = True
+    except (NotImplementedError, RuntimeError, ValueError):
+        installed = False  # sin señales en el bucle (Windows): Ctrl+C termina la sesión
+    try:
+        return await run_in_daemon_thread(func, *args, **kwargs)
+    finally:
+        if installed:
+            loop.remove_signal_handler(signal.SIGINT)
+        if cancelled:
+            print_warning(message)
+
+
+class InventoryDiscoverer:
+    """Refresca el inventario del host en segundo plano durante toda la sesión.
+
+    Cada INVENTORY_DISCOVERY_INTERVAL segundos lanza INVENTORY_DISCOVERY_COMMAND
+    por la conexión del pool, así generar un comando nunca espera a un descubrimiento.
+    """
+    def __init__(self, interval: float = INVENTORY_DISCOVERY_INTERVAL):
+        self.interval = interval
+        self.errors = 0
+        self._task = None
+        self._idle = asyncio.Event()
+
+    def start(self, target: Dict[str, Any], password: str | None):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run(target, password))
+
+    async def _run(self, target: Dict[str, Any], password: str | None):
+        while True:
+            self._idle.clear()
+            try:
+                client = await run_in_daemon_thread(SSH_POOL.acquire, target, password)
+                await run_in_daemon_thread(discover_inventory, client)
+            except Exception:
+                self.errors += 1  # es oportunista: un fallo aquí no debe interrumpir la sesión
+            finally:
+                self._idle.set()
+            await asyncio.sleep(self.interval)
+
+    async def wait(self, timeout: float):
+        """Espera como mucho `timeout` segundos a que termine un refresco en curso"""
+        if self._task is not None and not self._idle.is_set():
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
 # ==========================
 # PROGRAMA PRINCIPAL
 # ==========================
 
-def main():
+def execute_on_fleet(targets: List[Dict[str, Any]], command: str,
+                     passwords: Dict[str, str | None]) -> tuple[str, str]:
+    """Ejecuta en paralelo en varios hosts, muestra la tabla y devuelve la salida combinada"""
+    print_command_header(command)
+    start_time = time.time()
+    results = print_loading(f"Ejecutando en {len(targets)} hosts...",
+                            run_fanout, targets, command, passwords)
+    elapsed = time.time() - start_time
+
+    print_result_header()
+    print_fanout_table(results)
+    for result in results:
+        if result["error"]:
+            continue
+        name = result["target"]["name"]
+        print_output_block(result["stdout"].text(), f"SALIDA {name}", max_lines=10)
+        print_output_block(result["stderr"].text(), f"ERRORES {name}", max_lines=10)
+
+    failed = [r for r in results if r["error"] or r["exit_code"] != 0]
+    print_footer(0 if not failed else 1, elapsed)
+    if failed:
+        print_warning(f"{len(failed)} de {len(results)} hosts con error")
+
+    return combine_fanout_output(results)
+
+
+def execute_plan(plan: List[str], ssh_password: str | None,
+                 after: List[List[int]] | None = None) -> tuple[str, str]:
+    """Ejecuta el plan en el host por defecto, muestra el resumen y devuelve la salida combinada"""
+    client = SSH_POOL.acquire(default_target(), ssh_password, quiet=False)
+    parallel = PLAN_PARALLEL and SSH_MAX_CHANNELS_PER_HOST > 1
+    mode = f"hasta {SSH_MAX_CHANNELS_PER_HOST} canales en paralelo" if parallel else "una sesión"
+    print_command_header(f"plan de {len(plan)} comandos ({mode})")
+    structured = [find_output_parser(step) if STRUCTURED_OUTPUT_ENABLED else None for step in plan]
+    steps = [parsed[2] if parsed else step for step, parsed in zip(plan, structured)]
+
+    if parallel:
+        def on_step(index: int, result: Dict[str, Any]):
+            ok = result["exit_code"] == 0
+            mark, color = ("✓", GREEN) if ok else ("✗", RED)
+            print(f"{BLUE}│{RESET} {color}{mark} [{index + 1}/{len(plan)}] {plan[index]} "
+                  f"({result['time']:.2f}s){RESET}")
+
+        results, elapsed = run_plan_parallel(client, steps, after, on_step=on_step)
+    elif STREAM_OUTPUT:
+        print_info("Salida en vivo (Ctrl+C para cancelar)")
+        results, elapsed = run_plan(client, steps, after=after)
+    else:
+        results, elapsed = print_loading("Ejecutando plan...", run_plan, client, steps, False, after)
+
+    for result, step, parsed in zip(results, plan, structured):
+        result["command"] = step
+        rendered = apply_structured_output(parsed[0], parsed[1], result["stdout"].text())[0] if parsed else None
+        if rendered is not None:
+            result["stdout"] = OutputCapture()
+            for line in rendered.split("\n"):
+                result["stdout"].add(line)
+
+    print_result_header()
+    print_plan_table(results)
+    # Salidas en el orden del plan, no en el de llegada (en vivo, los pasos
+    # estructurados se vieron en JSON: se muestra su tabla)
+    for index, result in enumerate(results, 1):
+        if parallel or not STREAM_OUTPUT or structured[index - 1]:
+            print_output_block(result["stdout"].text(), f"SALIDA [{index}] {result['command']}", max_lines=15)
+            print_output_block(result["stderr"].text(), f"ERRORES [{index}]", max_lines=10)
+
+    failed = [r for r in results if r["exit_code"] != 0]
+    print_footer(0 if not failed else 1, elapsed)
+    if failed:
+        print_warning(f"{len(failed)} de {len(results)} pasos con error")
+    return combine_plan_output(results)
+
+
+async def agent_session():
+    """Sesión interactiva: las esperas (entrada, Ollama, SSH) son awaits, así el
+    descubrimiento de contenedores avanza mientras el usuario escribe.
+
+    Las ejecuciones SSH corren en hilos con run_cancellable: Ctrl+C cierra sus
+    canales y la sesión sigue; durante el resto de esperas termina la sesión.
+    """
     global SUDO_PASSWORD
     
     print_banner()
 
+    # Precarga del modelo mientras se piden credenciales y se conecta SSH
+    KEEP_WARM.start()
+
     # Configurar credenciales
     ssh_password = None
     if not USE_SSH_KEY:
@@ -796,14 +3942,32 @@ def main():
 
     # Conectar SSH
     try:
-        client = print_loading("Conectando SSH...", connect_ssh, ssh_password)
+        await run_with_spinner("Conectando SSH...", SSH_POOL.acquire, default_target(), ssh_password, False)
     except Exception as e:
         print_error(f"Error al conectar SSH: {e}")
         return
 
+    try:
+        inventory = load_host_inventory()
+        if inventory["hosts"]:
+            print_info(f"Inventario: {len(inventory['hosts'])} hosts, {len(inventory['groups'])} grupos "
+                       f"(usa '@grupo petición' para ejecutar en varios)", "🗂️ ")
+    except (OSError, ValueError) as e:
+        print_warning(f"No se pudo cargar el inventario {HOST_INVENTORY_PATH}: {e}")
+        inventory = {"hosts": {}, "groups": {}}
+
+    if KEEP_WARM.warm_up_time is not None:
+        print_info(f"Modelo {OLLAMA_MODEL} precargado en {KEEP_WARM.warm_up_time:.2f}s", "🔥")
+    elif KEEP_WARM.error is not None:
+        print_warning(f"No se pudo precargar el modelo: {KEEP_WARM.error}")
+    else:
+        print_info(f"Precargando {OLLAMA_MODEL} en segundo plano...", "🔥")
+
+    discoverer = InventoryDiscoverer()
+    discoverer.start(default_target(), ssh_password)
     try:
         while True:
-            user_request = user_prompt()
+            user_request = await run_in_daemon_thread(user_prompt)
             if user_request.lower() in ("salir", "exit", "quit", "q"):
                 print(f"\n{BLUE}┌{WHITE} 🏁 SESIÓN TERMINADA {'─' * 45}{RESET}")
                 print(f"{BLUE}│{RESET}")
@@ -811,17 +3975,36 @@ def main():
                 print(f"{BLUE}└{'─' * 70}{RESET}")
                 break
 
+            # Ejecución en varios hosts: "@selector petición"
+            selector, user_request = split_fanout_request(user_request)
+            targets = []
+            if selector:
+                try:
+                    targets = resolve_targets(selector, inventory)
+                except ValueError as e:
+                    print_error(str(e))
+                    continue
+                if not targets or not user_request:
+                    print_error("Indica hosts válidos y una petición: @grupo petición")
+                    continue
+                print_info(f"Destino: {', '.join(t['name'] for t in targets)}", "🌐")
+
             # Preguntas de seguimiento
-            is_followup = (conversation_context["last_analysis"] and 
+            is_followup = (not targets and MEMORY.has_analysis() and 
                           any(keyword in user_request.lower() for keyword in 
                               ['cómo', 'por qué', 'qué', 'cuándo', 'dónde', 'explica', 'analiza', '?']))
             
             if is_followup:
                 print_info("Procesando pregunta de seguimiento...")
                 try:
-                    followup_response = ask_followup_question(user_request, conversation_context)
-                    print_section("RESPUESTA DE SEGUIMIENTO", "💬")
-                    print_analysis_block(followup_response, "ANÁLISIS")
+                    printer = StreamingAnalysisPrinter("RESPUESTA DE SEGUIMIENTO", "💬",
+                                                       spinner_message="Pensando...")
+                    printer.start()
+                    followup_response = await run_in_daemon_thread(ask_followup_question, user_request,
+                                                                   on_token=printer.feed)
+                    printer.finish(followup_response)
+                    if not followup_response.startswith("Error: "):
+                        MEMORY.add_followup(user_request, followup_response)
                     conversation_context["follow_up_count"] += 1
                     continue
                 except Exception as e:
@@ -829,9 +4012,10 @@ def main():
 
             conversation_context["follow_up_count"] = 0
 
-            # Obtener comando
+            # Obtener comando (con el inventario recién descubierto si llega a tiempo)
+            await discoverer.wait(INVENTORY_DISCOVERY_WAIT)
             try:
-                cmd_obj = print_loading("Generando comando...", ask_ollama_for_command, user_request)
+                cmd_obj = await run_with_spinner("Generando comando...", ask_ollama_for_command, user_request)
             except Exception as e:
                 print_error(f"Error: {e}")
                 continue
@@ -844,11 +4028,26 @@ def main():
             explanation = cmd_obj.get("explanation", "").strip()
             dangerous = bool(cmd_obj.get("dangerous", False))
             reasoning = cmd_obj.get("reasoning", "").strip()
+            plan = cmd_obj.get("plan") if PLAN_MODE_ENABLED else None
+            if plan and targets:
+                print_warning("El modo plan se ejecuta en un solo host: en varios hosts solo se lanza el primer paso")
+                plan = None
 
             print_section("PROPUESTA DE COMANDO", "🎯")
-            print_kv("Comando", command, GREEN)
+            if plan:
+                mode = ("en canales paralelos de una conexión SSH"
+                        if PLAN_PARALLEL and SSH_MAX_CHANNELS_PER_HOST > 1 else "en una sola sesión SSH")
+                print_kv("Plan", f"{len(plan)} comandos de solo lectura {mode}", GREEN)
+                after = cmd_obj.get("plan_after") or [[] for _ in plan]
+                for index, step in enumerate(plan, 1):
+                    requires = f" {CYAN}(tras {', '.join(str(n + 1) for n in after[index - 1])})" if after[index - 1] else ""
+                    print_kv(f"  {index}.", step + requires, GREEN)
+            else:
+                print_kv("Comando", command, GREEN)
             print_kv("Explicación", explanation, WHITE)
             print_kv("Peligroso", f"{RED}🚨 ALTO RIESGO" if dangerous else f"{GREEN}✅ SEGURO", WHITE)
+            if cmd_obj.get("source"):
+                print_kv("Origen", f"⚡ {cmd_obj['source']}", MAGENTA)
             
             if reasoning:
                 print(f"{BLUE}│{RESET}")
@@ -862,51 +4061,131 @@ def main():
                 continue
 
             # Confirmación
-            if dangerous and not yes_no_prompt("⚠️  ALTO RIESGO. ¿Continuar?"):
+            if dangerous and not await run_in_daemon_thread(yes_no_prompt, "⚠️  ALTO RIESGO. ¿Continuar?"):
                 print_warning("Cancelado.")
                 continue
-            elif not dangerous and not yes_no_prompt("¿Ejecutar comando?"):
+            elif not dangerous and not await run_in_daemon_thread(
+                    yes_no_prompt, "¿Ejecutar plan?" if plan else "¿Ejecutar comando?"):
                 print_warning("Cancelado.")
                 continue
 
-            # Ejecutar
-            try:
-                stdout, stderr, exit_code, exec_time = print_loading(
-                    "Ejecutando...", run_remote_command, client, command
-                )
-            except Exception as e:
-                print_error(f"Error ejecutando: {e}")
-                continue
+            # Solo los comandos aprobados entran en la caché semántica
+            if (SEMANTIC_CACHE_ENABLED and not dangerous and CommandCache.is_cacheable(user_request)
+                    and cmd_obj.get("source") in (None, "caché")):
+                SEMANTIC_CACHE.put(user_request, cmd_obj)
 
-            # Actualizar contexto
-            conversation_context["last_command"] = command
-            conversation_context["last_output"] = stdout + "\n" + stderr
-            update_context_with_extracted_info(stdout + stderr, command)
+            if targets:
+                try:
+                    # Credenciales en el hilo principal, antes de lanzar los hilos
+                    passwords = collect_fleet_passwords(targets, ssh_password)
+                    stdout, stderr = await run_cancellable("Comando cancelado por el usuario (Ctrl+C)",
+                                                           execute_on_fleet, targets, command, passwords)
+                except Exception as e:
+                    print_error(f"Error ejecutando: {e}")
+                    continue
+                MEMORY.add_command(user_request, command, stdout + "\n" + stderr)
+            elif plan:
+                try:
+                    stdout, stderr = await run_cancellable("Plan cancelado por el usuario (Ctrl+C)", execute_plan,
+                                                           plan, ssh_password, cmd_obj.get("plan_after"))
+                except Exception as e:
+                    print_error(f"Error ejecutando: {e}")
+                    continue
+                # Un único análisis para todos los pasos
+                command = "; ".join(plan)
+                MEMORY.add_command(user_request, command, stdout + "\n" + stderr)
+            else:
+                # Ejecutar
+                # docker ps, systemctl status, ss y df se piden en formato estructurado
+                structured = find_output_parser(command) if STRUCTURED_OUTPUT_ENABLED else None
+                exec_command = structured[2] if structured else command
+                transfer = None if structured else OUTPUT_SIZE_ESTIMATOR.choose(command)
+                live = STREAM_OUTPUT and not transfer and not structured
+                runner = run_remote_command
+                if structured:
+                    print_info(f"Formato estructurado: {exec_command}", "🧩")
+                elif transfer:
+                    # Solo viaja lo que se mostraría: cabecera, líneas relevantes y cola
+                    runner = functools.partial(run_remote_command_filtered, compress=transfer["compress"])
+                    print_info(f"Salida estimada de {format_bytes(transfer['estimate'])}: se filtra"
+                               f"{' y comprime' if transfer['compress'] else ''} en la Pi", "📦")
+                def execute():
+                    client = SSH_POOL.acquire(default_target(), ssh_password, quiet=False)
+                    if live:
+                        return runner(client, exec_command)
+                    return print_loading("Ejecutando...", runner, client, exec_command, quiet=True)
+
+                if live:
+                    print_info("Salida en vivo (Ctrl+C para cancelar)")
+                else:
+                    print_command_header(exec_command)
+                try:
+                    stdout_capture, stderr_capture, exit_code, exec_time = await run_cancellable(
+                        "Comando cancelado por el usuario (Ctrl+C)", execute)
+                except Exception as e:
+                    print_error(f"Error ejecutando: {e}")
+                    continue
 
-            # Mostrar resultados
-            print_result_header()
+                wire_bytes = stdout_capture.wire_bytes + stderr_capture.wire_bytes
+                remote_bytes = stdout_capture.remote_bytes
+                if exit_code != -1:
+                    OUTPUT_SIZE_ESTIMATOR.record(command, remote_bytes if remote_bytes is not None
+                                                 else stdout_capture.byte_count + stderr_capture.byte_count)
+                if remote_bytes is not None:
+                    OUTPUT_SIZE_ESTIMATOR.record_transfer(wire_bytes, remote_bytes)
+
+                # Texto acotado: cabecera + líneas relevantes + cola
+                stdout = stdout_capture.text()
+                stderr = stderr_capture.text()
+                if structured:
+                    # Registros al inventario; al usuario y al análisis, la tabla legible
+                    rendered, count = apply_structured_output(structured[0], structured[1], stdout)
+                    if rendered is not None:
+                        stdout = rendered
+                        print_info(f"{count} registros añadidos al inventario")
+
+                # Actualizar la memoria de la conversación
+                MEMORY.add_command(user_request, command, stdout + "\n" + stderr)
+
+                # Mostrar resultados
+                print_result_header()
             
-            if stdout.strip():
-                print_output_block(stdout.strip(), "SALIDA")
-            elif not stderr.strip():
-                print_info("Comando ejecutado (sin salida)")
-
-            if stderr.strip():
-                print_output_block(stderr.strip(), "ERRORES")
-
-            print_footer(exit_code, exec_time)
+                if live:
+                    # La salida ya se mostró en vivo: solo el resumen
+                    if stdout_capture or stderr_capture:
+                        print_info(f"{stdout_capture.line_count} líneas de salida, "
+                                   f"{stderr_capture.line_count} líneas de errores "
+                                   f"({(stdout_capture.byte_count + stderr_capture.byte_count) / 1024:.1f} KB)")
+                    else:
+                        print_info("Comando ejecutado (sin salida)")
+                else:
+                    if stdout.strip():
+                        print_output_block(stdout.strip(), "SALIDA")
+                    elif not stderr.strip():
+                        print_info("Comando ejecutado (sin salida)")
+
+                    if stderr.strip():
+                        print_output_block(stderr.strip(), "ERRORES")
+
+                for capture in (stdout_capture, stderr_capture):
+                    if capture.spill_path and capture.omitted_lines > 0:
+                        print_info(f"Salida completa guardada en {capture.spill_path}", "💾")
+
+                print_footer(exit_code, exec_time, wire_bytes, remote_bytes)
 
             # Análisis
-            if yes_no_prompt("¿Análisis IA?", default_no=False):
+            if await run_in_daemon_thread(yes_no_prompt, "¿Análisis IA?", default_no=False):
                 try:
-                    analysis = print_loading("Analizando...", explain_output_with_ollama, command, stdout, stderr)
-                    conversation_context["last_analysis"] = analysis
-                    print_section("ANÁLISIS IA", "🧠")
-                    print_analysis_block(analysis, "ANÁLISIS")
+                    printer = StreamingAnalysisPrinter("ANÁLISIS IA", "🧠")
+                    printer.start()
+                    analysis = await run_in_daemon_thread(explain_output_with_ollama, command, stdout, stderr,
+                                                          on_token=printer.feed)
+                    printer.finish(analysis)
+                    MEMORY.set_analysis(analysis)
                 except Exception as e:
                     print_error(f"Error en análisis: {e}")
 
-    except KeyboardInterrupt:
+    except (KeyboardInterrupt, asyncio.CancelledError):
         print(f"\n{BLUE}┌{WHITE} ⚠️  SESIÓN INTERRUMPIDA {'─' * 42}{RESET}")
         print(f"{BLUE}│{RESET}")
         print(f"{BLUE}│{YELLOW} Sesión terminada{RESET}")
@@ -914,8 +4193,60 @@ def main():
     except Exception as e:
         print_error(f"Error: {e}")
     finally:
+        KEEP_WARM.stop()
+        await discoverer.stop()
+        if SEMANTIC_CACHE_ENABLED:
+            SEMANTIC_CACHE.flush()
+        for line in OLLAMA_CLIENT.metrics_summary():
+            print_info(line, "📈")
+        if COMMAND_CACHE_ENABLED:
+            stats = COMMAND_CACHE.stats()
+            print_info(
+                f"Caché de comandos: {stats['hits']} aciertos, {stats['misses']} fallos "
+                f"({stats['hit_rate']:.0%})", "⚡"
+            )
+        if SEMANTIC_CACHE_ENABLED and SEMANTIC_CACHE.hits + SEMANTIC_CACHE.misses:
+            stats = SEMANTIC_CACHE.stats()
+            print_info(
+                f"Caché semántica: {stats['hits']} aciertos, {stats['misses']} fallos "
+                f"({stats['hit_rate']:.0%}); similitud máxima por consulta:", "⚡"
+            )
+            for line in SEMANTIC_CACHE.histogram_lines():
+                print_kv("", line, CYAN)
+        if INTENT_ROUTER_ENABLED and INTENT_ROUTER.hits + INTENT_ROUTER.misses:
+            stats = INTENT_ROUTER.stats()
+            print_info(
+                f"Ruta rápida: {stats['hits']} de {stats['hits'] + stats['misses']} peticiones "
+                f"resueltas sin LLM ({stats['hit_rate']:.0%})", "⚡"
+            )
+        if INVENTORY.refreshes:
+            print_info(
+                f"Inventario: {len(INVENTORY.containers)} contenedores, {len(INVENTORY.services)} servicios, "
+                f"{len(INVENTORY.sockets)} puertos, {len(INVENTORY.filesystems)} discos "
+                f"({INVENTORY.refreshes} refrescos, {INVENTORY.version} con cambios)", "🗂️ "
+            )
+        if MEMORY.summarized or MEMORY.summary_errors:
+            stats = MEMORY.stats()
+            print_info(
+                f"Memoria: {stats['turns']} turnos, {stats['summarized']} resumidos, "
+                f"{stats['pending']} pendientes ({stats['errors']} errores al resumir, "
+                f"{OLLAMA_SLOT.preempted} resúmenes aplazados por peticiones)", "🧾"
+            )
+        if OUTPUT_SIZE_ESTIMATOR.filtered:
+            print_info(
+                f"Filtrado remoto: {OUTPUT_SIZE_ESTIMATOR.filtered} comandos, "
+                f"{format_bytes(OUTPUT_SIZE_ESTIMATOR.wire_bytes)} transferidos de "
+                f"{format_bytes(OUTPUT_SIZE_ESTIMATOR.remote_bytes)} generados en la Pi", "📦"
+            )
+        if SUDO_EXECUTOR.commands:
+            stats = SUDO_EXECUTOR.stats()
+            print_info(
+                f"Sudo: {stats['commands']} comandos, contraseña enviada {stats['passwords_sent']} veces, "
+                f"{stats['cached']} con credenciales vigentes; {stats['saved']:.1f}s ahorrados "
+                f"frente a la espera fija de {SUDO_LEGACY_WAIT}s", "🔑"
+            )
         try:
-            client.close()
+            SSH_POOL.close_all()
             print(f"\n{BLUE}{'═' * 70}{RESET}")
             print(f"{BLUE}║{WHITE}{'🔌 Conexión cerrada':^68}{BLUE}║{RESET}")
             print(f"{BLUE}{'═' * 70}{RESET}")
@@ -923,5 +4254,26 @@ def main():
             pass
 
 
+def main():
+    """Ejecuta la sesión en un bucle asyncio propio.
+
+    No se usa asyncio.run: su manejador de SIGINT solo cancela la tarea y Ctrl+C
+    dejaría de interrumpir las partes síncronas (salida en vivo, streaming).
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    session = loop.create_task(agent_session())
+    try:
+        loop.run_until_complete(session)
+    except KeyboardInterrupt:
+        # Ctrl+C mientras el bucle esperaba (entrada, Ollama): se cancela la sesión
+        session.cancel()
+        loop.run_until_complete(session)
+    finally:
+        loop.close()
+
+
 if __name__ == "__main__":
+    if "--measure-prompt" in sys.argv[1:]:
+        MEASURE_PROMPT_EVAL = True
     main()
\ No newline at end of file
@@ -0,0 +1,42 @@
+"""Lógica compartida por el agente de terminal y el agente web"""
+import json
+
+from agent_common import IncrementalJSONExtractor, compress_output
+
+
+def test_compress_output_keeps_short_text():
+    assert compress_output("uno\ndos", 100) == "uno\ndos"
+
+
+def test_repeated_lines_keep_last_position():
+    text = "\n".join(["start"] + [f"retry {i} connection refused" for i in range(200)] + ["done"])
+    assert compress_output(text, 20).splitlines() == [
+        "start", "retry 199 connection refused  (×200)", "done"]
+
+
+def words(i):
+    """Línea distinta para cada i (los números no cuentan al deduplicar)"""
+    return "".join(chr(97 + int(digit)) for digit in str(i)) + " served " + "x" * 80
+
+
+def test_keyword_lines_survive_budget():
+    text = "\n".join([f"request {words(i)}" for i in range(500)]
+                     + ["permission denied for user pi"]
+                     + [f"request {words(i)}" for i in range(500, 1000)])
+    compressed = compress_output(text, 300)
+    assert "permission denied for user pi" in compressed
+    assert "líneas omitidas" in compressed
+
+
+def test_extractor_finds_object_across_chunks():
+    extractor = IncrementalJSONExtractor()
+    payload = json.dumps({"command": "echo '{}'", "dangerous": False})
+    results = [extractor.feed(payload[i:i + 5]) for i in range(0, len(payload), 5)]
+    assert results[-1] == {"command": "echo '{}'", "dangerous": False}
+    assert all(result is None for result in results[:-1])
+
+
+def test_extractor_block_parser():
+    extractor = IncrementalJSONExtractor(block_parser=lambda text: {"command": "uptime"})
+    assert extractor.feed("<json>comando: uptime</js") is None
+    assert extractor.feed("on>") == {"command": "uptime"}
@@ -0,0 +1,35 @@
+"""Clave de la caché de comandos: petición más contexto, sin la memoria de la conversación"""
+import pytest
+
+import rpi_agent
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(rpi_agent, "MEMORY", rpi_agent.ConversationMemory())
+    return rpi_agent.CommandCache(path=str(tmp_path / "cache.sqlite3"))
+
+
+def test_hit_after_other_turns(cache):
+    command = {"command": "docker ps", "explanation": "lista", "dangerous": False}
+    cache.put("docker ps", command)
+    rpi_agent.MEMORY.add_command("revisa el disco", "df -h", "/dev/root 40%")
+    assert cache.get("Docker PS") == command
+
+
+def test_key_changes_with_sudo(cache, monkeypatch):
+    cache.put("docker ps", {"command": "docker ps"})
+    monkeypatch.setattr(rpi_agent, "USE_SUDO", not rpi_agent.USE_SUDO)
+    assert cache.get("docker ps") is None
+
+
+@pytest.mark.parametrize("request_text, cacheable", [
+    ("docker ps", True),
+    ("revisa el log del frontend", True),
+    ("muestra sus logs", False),
+    ("reinicia ese contenedor", False),
+    ("repite lo mismo", False),
+    ("hazlo otra vez", False),
+])
+def test_backreferences_are_not_cached(request_text, cacheable):
+    assert rpi_agent.CommandCache.is_cacheable(request_text) is cacheable
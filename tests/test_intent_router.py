@@ -0,0 +1,37 @@
+"""Ruta rápida: comandos locales o None (la petición sigue hacia Ollama)"""
+import pytest
+
+from rpi_agent import IntentRouter
+
+CONTAINERS = {"frontend": "web-frontend", "gateway": "api-gateway"}
+
+
+@pytest.mark.parametrize("request_text, command", [
+    # Contenedores en ejecución frente a todos (también parados o caídos)
+    ("lista los contenedores", "docker ps"),
+    ("docker ps", "docker ps"),
+    ("lista todos los contenedores", "docker ps -a"),
+    ("ver contenedores parados", "docker ps -a"),
+    ("contenedores detenidos", "docker ps -a"),
+    ("contenedores que fallaron", "docker ps -a"),
+    ("contenedores caídos", "docker ps -a"),
+    ("docker ps -a", "docker ps -a"),
+    # Logs simples de un contenedor conocido
+    ("revisa el log del frontend", "docker logs --tail 100 web-frontend"),
+    ("ultimas 20 lineas de log del gateway", "docker logs --tail 20 api-gateway"),
+    # Ventana de tiempo, filtro o tamaño: ninguna plantilla los recoge
+    ("los logs del frontend desde ayer", None),
+    ("errores en los logs del frontend en la ultima hora", None),
+    ("logs del frontend de los ultimos 10 minutos", None),
+    ("tamaño de los logs del frontend", None),
+    ("cuánto ocupa el log del frontend", None),
+    # Verbos que cambian el sistema
+    ("detén el contenedor frontend", None),
+    ("reinicia el gateway", None),
+    # Host
+    ("uso de disco", "df -h"),
+    ("memoria libre", "free -h"),
+])
+def test_route(request_text, command):
+    routed = IntentRouter().route(request_text, CONTAINERS)
+    assert (routed and routed["command"]) == command
@@ -0,0 +1,17 @@
+"""Analizadores de salida estructurada"""
+import pytest
+
+from rpi_agent import OUTPUT_PARSERS, OutputParser
+
+
+def test_incomplete_parser_fails_at_instantiation():
+    class RewriteOnly(OutputParser):
+        def rewrite(self, args):
+            return None
+
+    with pytest.raises(TypeError):
+        RewriteOnly()
+
+
+def test_registered_parsers_are_complete():
+    assert all(isinstance(parser, OutputParser) for parser in OUTPUT_PARSERS.values())
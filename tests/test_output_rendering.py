@@ -0,0 +1,55 @@
+"""Selección de líneas de print_output_block en salidas largas"""
+import rpi_agent
+from rpi_agent import print_output_block, select_output_lines
+
+
+def numbered(n):
+    return "\n".join(f"linea {i}" for i in range(n))
+
+
+def test_short_output_is_kept_whole():
+    assert select_output_lines(numbered(5), 10) == [f"linea {i}" for i in range(5)]
+
+
+def test_long_output_keeps_head_and_tail():
+    lines = select_output_lines(numbered(100), 10)
+    assert lines[:5] == [f"linea {i}" for i in range(5)]
+    assert lines[-5:] == [f"linea {i}" for i in range(95, 100)]
+    assert "90 líneas omitidas" in lines[5]
+    assert len(lines) == 11
+
+
+def test_keyword_lines_are_retained_in_order():
+    text = "\n".join(["ok"] * 40 + ["Error: disk full"] + ["ok"] * 40
+                     + ["Active: failed", "connection REFUSED"] + ["ok"] * 40)
+    assert select_output_lines(text, 10) == ["Error: disk full", "Active: failed", "connection REFUSED"]
+
+
+def test_keyword_lines_are_truncated_with_marker():
+    text = "\n".join(f"warn {i}" for i in range(30))
+    lines = select_output_lines(text, 10)
+    assert lines[:10] == [f"warn {i}" for i in range(10)]
+    assert "20 líneas adicionales omitidas" in lines[10]
+
+
+def test_keyword_matching_with_case_changing_characters():
+    # "İ" cambia de longitud al pasar a minúsculas: se usa la búsqueda por líneas
+    text = "\n".join(["İ ok"] * 20 + ["FAIL here"])
+    assert select_output_lines(text, 4) == ["FAIL here"]
+
+
+def test_print_output_block_bounds_printed_lines(capsys):
+    print_output_block(numbered(100_000), "SALIDA", max_lines=20)
+    out = capsys.readouterr().out.splitlines()
+    assert len(out) <= 2 + 20 + 10
+    assert any("linea 0" in line for line in out)
+    assert any("linea 99999" in line for line in out)
+
+
+def test_print_output_block_ignores_blank_output(capsys):
+    print_output_block("  \n\n ")
+    assert capsys.readouterr().out == ""
+
+
+def test_important_keywords_include_denials():
+    assert {"denied", "refused", "timeout"} <= set(rpi_agent.IMPORTANT_KEYWORDS)
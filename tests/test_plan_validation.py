@@ -0,0 +1,64 @@
+"""Validación de los pasos de un plan: solo se admiten comandos de consulta"""
+import pytest
+
+from rpi_agent import is_read_only_command, validate_command_object
+
+
+@pytest.mark.parametrize("command", [
+    "df -h",
+    "docker ps -a",
+    "docker logs --tail 50 web-frontend 2>&1 | grep -i error",
+    "systemctl status cloudflared --no-pager",
+    "journalctl -u ssh -n 100 --no-pager",
+    "timedatectl status",
+    "timedatectl show",
+    "hostnamectl status",
+    "sort -k2 -n /etc/hosts",
+    "sort -r /var/log/syslog | uniq -c",
+    "uniq /tmp/a",
+    "curl -sI http://localhost:3000",
+])
+def test_read_only_commands_are_accepted(command):
+    assert is_read_only_command(command)
+
+
+@pytest.mark.parametrize("command", [
+    # Cambian la hora o el nombre del host
+    "timedatectl set-time 2020-01-01",
+    "timedatectl set-ntp false",
+    "hostnamectl set-hostname x",
+    # Escriben en un fichero
+    "sort -o /etc/hosts f",
+    "sort -ro /etc/hosts f",
+    "sort --output=/etc/x f",
+    "sort --output /etc/x f",
+    "uniq /tmp/a /etc/hosts",
+    "sed -i s/a/b/ /etc/hosts",
+    "curl -o /tmp/x http://localhost",
+    "df -h > /tmp/df.txt",
+    # No terminan solos o no son de consulta
+    "tail -f /var/log/syslog",
+    "docker stats",
+    "systemctl restart ssh",
+    "rm -rf /tmp/x",
+])
+def test_state_changing_commands_are_rejected(command):
+    assert not is_read_only_command(command)
+
+
+@pytest.mark.parametrize("step", [
+    "timedatectl set-time 2020-01-01",
+    "hostnamectl set-hostname x",
+    "sort -o /etc/hosts f",
+    "sort --output=/etc/x f",
+    "uniq /tmp/a /etc/hosts",
+])
+def test_plan_with_state_changing_step_is_rejected(step):
+    with pytest.raises(ValueError, match="solo lectura"):
+        validate_command_object({
+            "command": "timedatectl status",
+            "explanation": "diagnóstico",
+            "dangerous": False,
+            "reasoning": "varios pasos de consulta",
+            "plan": ["timedatectl status", step],
+        })
@@ -0,0 +1,49 @@
+"""Caché semántica: aciertos sin escribir en disco y errores de disco sin excepción"""
+import pytest
+
+import rpi_agent
+
+pytest.importorskip("numpy")
+
+VECTORS = {
+    "revisa el log del frontend": [1.0, 0.0, 0.0],
+    "muestra los logs del frontend": [0.99, 0.05, 0.0],
+    "uso de disco": [0.0, 1.0, 0.0],
+}
+COMMAND = {"command": "docker logs --tail 100 web-frontend", "explanation": "logs", "dangerous": False}
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(rpi_agent.OLLAMA_CLIENT, "embed", lambda text, model: VECTORS[text])
+    return rpi_agent.SemanticCache(path=str(tmp_path / "semantic"))
+
+
+def test_paraphrase_hits_without_writing(cache, monkeypatch):
+    cache.put("revisa el log del frontend", COMMAND)
+    saves = []
+    monkeypatch.setattr(cache, "_save", lambda: saves.append(1))
+    response, similarity = cache.get("muestra los logs del frontend")
+    assert response == COMMAND and similarity > cache.threshold
+    assert cache.get("uso de disco") == (None, pytest.approx(0.0, abs=0.1))
+    assert saves == []
+    cache.flush()
+    assert saves == [1]
+
+
+def test_hits_are_persisted_on_flush(cache, tmp_path):
+    cache.put("revisa el log del frontend", COMMAND)
+    cache.get("muestra los logs del frontend")
+    cache.flush()
+    reloaded = rpi_agent.SemanticCache(path=cache.path)
+    reloaded._load()
+    assert reloaded._entries[0]["hits"] == 1
+
+
+def test_unwritable_disk_only_warns(cache, tmp_path, capsys):
+    blocker = tmp_path / "semantic"
+    blocker.write_text("no soy un directorio")
+    cache.put("revisa el log del frontend", COMMAND)
+    assert "No se pudo guardar la caché semántica" in capsys.readouterr().out
+    assert cache.get("muestra los logs del frontend")[0] == COMMAND
+    cache.flush()